@@ -10,6 +10,35 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "xui_bot_password")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 
+# === ПУЛ СОЕДИНЕНИЙ БД ===
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_MAX_QUERIES = int(os.getenv('DB_POOL_MAX_QUERIES', '50000'))  # после N запросов соединение пересоздается
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_POOL_MAX_INACTIVE_LIFETIME', '300'))  # секунд простоя до закрытия
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '10'))
+
+# === КЭШ ПОЛЬЗОВАТЕЛЕЙ ===
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))  # максимум записей (LRU)
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '60'))  # секунд жизни записи
+
+# === КЭШ QR-КОДОВ ===
+QR_CACHE_MAX_BYTES = int(os.getenv('QR_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))  # байт PNG в памяти (LRU)
+QR_CACHE_PERSIST = os.getenv('QR_CACHE_PERSIST', 'False').lower() == 'true'  # хранить PNG в Postgres
+QR_FILE_ID_TTL = float(os.getenv('QR_FILE_ID_TTL', str(7 * 24 * 3600)))  # секунд хранения file_id отправленного QR
+QR_RENDER_EXECUTOR = os.getenv('QR_RENDER_EXECUTOR', 'thread').lower()  # thread / process / inline
+QR_RENDER_WORKERS = int(os.getenv('QR_RENDER_WORKERS', '2'))  # воркеров пула кодирования QR
+QR_RENDER_MAX_QUEUE = int(os.getenv('QR_RENDER_MAX_QUEUE', '32'))  # задач кодирования в пуле одновременно
+QR_RENDER_MODE = os.getenv('QR_RENDER_MODE', 'classic').lower()  # classic / compact
+QR_TARGET_SIZE = int(os.getenv('QR_TARGET_SIZE', '512'))  # пикселей стороны QR в режиме compact
+
+# === ХРАНИЛИЩЕ FSM ===
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'postgres').lower()  # postgres / memory
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', '86400'))  # секунд простоя до удаления состояния
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))  # состояний в локальном кэше
+FSM_CACHE_TTL = float(os.getenv('FSM_CACHE_TTL', '5'))  # секунд доверия локальному кэшу (несколько процессов)
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.1'))  # секунд накопления записей в пачку
+FSM_FLUSH_BATCH = int(os.getenv('FSM_FLUSH_BATCH', '500'))  # записей, при которых пачка пишется сразу
+
 # === НАСТРОЙКИ 3x-ui ===
 XUI_PANEL_URL = os.getenv('XUI_PANEL_URL')
 XUI_USERNAME = os.getenv('XUI_USERNAME')
@@ -19,9 +48,53 @@ DATA_LIMIT_GB = int(os.getenv('DATA_LIMIT_GB', '0'))
 EXPIRY_TIME = int(os.getenv('EXPIRY_TIME', '30'))
 XUI_EXTERNAL_IP = os.getenv('XUI_EXTERNAL_IP')
 SERVER_PORT = os.getenv('SERVER_PORT', '443')
+XUI_MAX_CONCURRENCY = int(os.getenv('XUI_MAX_CONCURRENCY', '10'))  # параллельных запросов к панели
+XUI_SESSION_TTL = float(os.getenv('XUI_SESSION_TTL', '3000'))  # секунд до плановой переавторизации
+INBOUND_CACHE_TTL = float(os.getenv('INBOUND_CACHE_TTL', '30'))  # секунд жизни снимка инбаунда
+XUI_CONFIRM_DEADLINE = float(os.getenv('XUI_CONFIRM_DEADLINE', '5'))  # секунд ожидания нового клиента
+XUI_CONFIRM_INITIAL_DELAY = float(os.getenv('XUI_CONFIRM_INITIAL_DELAY', '0.1'))
+XUI_CONFIRM_MAX_DELAY = float(os.getenv('XUI_CONFIRM_MAX_DELAY', '1'))
+XUI_ADD_BATCH_WINDOW = float(os.getenv('XUI_ADD_BATCH_WINDOW', '0.05'))  # секунд сбора новых клиентов в пачку (0 - без пачек)
+XUI_ADD_BATCH_MAX = int(os.getenv('XUI_ADD_BATCH_MAX', '50'))  # клиентов в пачке, при которых она отправляется сразу
+SUBSCRIPTION_STALE_AFTER = float(os.getenv('SUBSCRIPTION_STALE_AFTER', '3600'))  # секунд до сверки подписки с панелью
+RECONCILE_ENABLED = os.getenv('RECONCILE_ENABLED', 'True').lower() == 'true'
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', '600'))  # секунд между сверками панели и БД
+
+# === ОТКЛЮЧЕНИЕ ИСТЕКШИХ КЛИЕНТОВ ===
+SWEEP_ENABLED = os.getenv('SWEEP_ENABLED', 'True').lower() == 'true'
+SWEEP_INTERVAL = float(os.getenv('SWEEP_INTERVAL', '3600'))  # секунд между проходами
+SWEEP_ACTION = os.getenv('SWEEP_ACTION', 'disable').lower()  # disable / delete
+SWEEP_BATCH = int(os.getenv('SWEEP_BATCH', '200'))  # подписок за пачку
+SWEEP_CONCURRENCY = int(os.getenv('SWEEP_CONCURRENCY', '4'))  # параллельных запросов к панели
+SWEEP_RATE = float(os.getenv('SWEEP_RATE', '10'))  # запросов к панели в секунду
+
+# === НАПОМИНАНИЯ ОБ ОКОНЧАНИИ ПОДПИСКИ ===
+EXPIRY_REMINDERS_ENABLED = os.getenv('EXPIRY_REMINDERS_ENABLED', 'True').lower() == 'true'
+EXPIRY_REMINDER_HOURS = [int(h) for h in os.getenv('EXPIRY_REMINDER_HOURS', '72,24,2').split(',') if h.strip()]
+EXPIRY_RELOAD_INTERVAL = float(os.getenv('EXPIRY_RELOAD_INTERVAL', '21600'))  # секунд между полными загрузками из БД
+EXPIRY_REMINDER_RATE = float(os.getenv('EXPIRY_REMINDER_RATE', '20'))  # сообщений в секунду
+
+# === СТАТИСТИКА ТРАФИКА ===
+TRAFFIC_ENABLED = os.getenv('TRAFFIC_ENABLED', 'True').lower() == 'true'
+TRAFFIC_COLLECT_INTERVAL = float(os.getenv('TRAFFIC_COLLECT_INTERVAL', '300'))  # секунд между сборами счетчиков
+TRAFFIC_RETENTION_5M_DAYS = int(os.getenv('TRAFFIC_RETENTION_5M_DAYS', '2'))  # хранение 5-минутных точек
+TRAFFIC_RETENTION_1H_DAYS = int(os.getenv('TRAFFIC_RETENTION_1H_DAYS', '30'))  # хранение часовых точек
+TRAFFIC_RETENTION_1D_DAYS = int(os.getenv('TRAFFIC_RETENTION_1D_DAYS', '400'))  # хранение суточных точек
 
 # === НАСТРОЙКИ TELEGRAM ===
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()  # polling / webhook
+BOT_WEBHOOK_URL = os.getenv('BOT_WEBHOOK_URL', '')  # внешний адрес сервера, например https://bot.example.com
+BOT_WEBHOOK_PATH = os.getenv('BOT_WEBHOOK_PATH', '/telegram/webhook')
+BOT_WEBHOOK_SECRET = os.getenv('BOT_WEBHOOK_SECRET', '')  # заголовок X-Telegram-Bot-Api-Secret-Token
+BOT_WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('BOT_WEBHOOK_MAX_IN_FLIGHT', '100'))  # параллельно обрабатываемых апдейтов
+BOT_WEBHOOK_MAX_CONNECTIONS = int(os.getenv('BOT_WEBHOOK_MAX_CONNECTIONS', '40'))  # соединений со стороны Telegram
+
+# === ОГРАНИЧЕНИЕ ЧАСТОТЫ НАЖАТИЙ ===
+THROTTLE_PANEL_RATE = float(os.getenv('THROTTLE_PANEL_RATE', '20'))  # действий с панелью в секунду на всех
+THROTTLE_PANEL_BURST = int(os.getenv('THROTTLE_PANEL_BURST', '40'))
+THROTTLE_CACHE_SIZE = int(os.getenv('THROTTLE_CACHE_SIZE', '10000'))  # пользователей в таблице лимитов
+ACTION_MAX_INFLIGHT = int(os.getenv('ACTION_MAX_INFLIGHT', '10000'))  # одновременных создание/продление/trial
 
 # === TRIAL СИСТЕМА ===
 TRIAL_ENABLED = os.getenv('TRIAL_ENABLED', 'False').lower() == 'true'
@@ -40,6 +113,13 @@ PAYMENT_AMOUNT = float(os.getenv('PAYMENT_AMOUNT', '100.0'))
 PAYMENT_YOOMONEY = os.getenv('PAYMENT_YOOMONEY', 'False').lower() == 'true'
 PAYMENT_SBP = os.getenv('PAYMENT_SBP', 'False').lower() == 'true'
 PAYMENT_CARD = os.getenv('PAYMENT_CARD', 'False').lower() == 'true'
+PAYMENT_WEBHOOK_ENABLED = os.getenv('PAYMENT_WEBHOOK_ENABLED', 'False').lower() == 'true'
+PAYMENT_WEBHOOK_PATH = os.getenv('PAYMENT_WEBHOOK_PATH', '/payments/webhook')
+PAYMENT_WEBHOOK_SECRET = os.getenv('PAYMENT_WEBHOOK_SECRET', '')  # ?token=... в URL уведомления
+
+# === HTTP-СЕРВЕР (вебхуки) ===
+HTTP_SERVER_HOST = os.getenv('HTTP_SERVER_HOST', '0.0.0.0')
+HTTP_SERVER_PORT = int(os.getenv('HTTP_SERVER_PORT', '8081'))
 
 # === ТЕКСТЫ И ОПИСАНИЯ ===
 WELCOME_MESSAGE = """
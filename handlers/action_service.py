@@ -1,14 +1,18 @@
 import logging
-from typing import Dict
+from typing import Dict, Optional
 
 from services.database import save_user, get_user, update_user_balance, \
-    get_trial_status, mark_trial_used, get_connection_string
+    claim_trial, release_trial, get_connection_string, \
+    create_payment_record, get_payment_record, mark_payment_paid, \
+    claim_payment_activation, finish_payment_activation
 from services.vpn_service import create_vpn_account, get_vpn_status, renew_vpn_account
 from services.payment import create_payment, check_payment, is_payment_enabled, get_available_providers, \
-    create_payment_config, \
+    is_payment_polling, create_payment_config, PAYMENT_ACTIVATION_TIMEOUT, \
     create_payment_item
 from services.onboarding import onboarding_service
-from config import PAYMENT_AMOUNT, EXPIRY_TIME, TRIAL_ENABLED, TRIAL_DAYS
+from services.single_flight import SingleFlight
+from services.traffic import get_user_traffic, format_traffic
+from config import PAYMENT_AMOUNT, EXPIRY_TIME, TRIAL_ENABLED, TRIAL_DAYS, ACTION_MAX_INFLIGHT
 
 logger = logging.getLogger(__name__)
 
@@ -22,12 +26,18 @@ class ActionService:
 
     def __init__(self):
         # ⚠️ ИНИЦИАЛИЗАЦИЯ ЭКЗЕМПЛЯРА
-        pass
+        # Повторное нажатие, пока действие пользователя выполняется, получает тот же результат
+        self.flights = SingleFlight("actions", max_keys=ACTION_MAX_INFLIGHT)
 
     async def handle_get_vpn(self, telegram_id: int, username: str = None) -> Dict:
         """
         📍 ТОЧКА ВХОДА: Получение VPN услуги - С ПОДТВЕРЖДЕНИЕМ ПЕРЕЗАПИСИ
         """
+        return await self.flights.run(
+            ("get_vpn", telegram_id), lambda: self._get_vpn(telegram_id, username)
+        )
+
+    async def _get_vpn(self, telegram_id: int, username: str = None) -> Dict:
         try:
             # Сохраняем пользователя если нужно
             if username:
@@ -98,6 +108,9 @@ class ActionService:
         """
         📍 ТОЧКА ВХОДА: Продление VPN услуги - ДОБАВЛЕННЫЙ МЕТОД
         """
+        return await self.flights.run(("renew_vpn", telegram_id), lambda: self._renew_vpn(telegram_id))
+
+    async def _renew_vpn(self, telegram_id: int) -> Dict:
         try:
             # Если оплата включена - возвращаем информацию для оплаты
             if is_payment_enabled():
@@ -143,6 +156,11 @@ class ActionService:
         """
         📍 ТОЧКА ВХОДА: Бесплатный trial период - УЛУЧШЕННАЯ ВЕРСИЯ
         """
+        return await self.flights.run(
+            ("free_trial", telegram_id), lambda: self._free_trial(telegram_id, username)
+        )
+
+    async def _free_trial(self, telegram_id: int, username: str = None) -> Dict:
         try:
             # Проверяем включен ли trial
             if not TRIAL_ENABLED:
@@ -151,9 +169,14 @@ class ActionService:
                     "message": "❌ Бесплатный период временно недоступен"
                 }
 
-            # Проверяем использовал ли уже trial
-            trial_used = await get_trial_status(telegram_id)
-            if trial_used:
+            # Один запрос: сохраняет пользователя и занимает trial, если он еще свободен
+            claimed = await claim_trial(telegram_id, username)
+            if claimed is None:
+                return {
+                    "type": "error",
+                    "message": "❌ Ошибка при активации бесплатного периода"
+                }
+            if not claimed:
                 return {
                     "type": "error",
                     "message": (
@@ -162,29 +185,28 @@ class ActionService:
                     )
                 }
 
-            # Сохраняем пользователя если нужно
-            if username:
-                await save_user(telegram_id, username)
-
-            # 🔄 ЗАПУСК ONBOARDING ПЕРЕД СОЗДАНИЕМ VPN
-            onboarding_result = await onboarding_service.execute_steps(telegram_id)
-            if not onboarding_result["completed"]:
-                return {
-                    "type": "onboarding_required",
-                    "message": onboarding_result["message"],
-                    "next_action": onboarding_result["next_action"]
-                }
+            try:
+                # 🔄 ЗАПУСК ONBOARDING ПЕРЕД СОЗДАНИЕМ VPN
+                onboarding_result = await onboarding_service.execute_steps(telegram_id)
+                if not onboarding_result["completed"]:
+                    await release_trial(telegram_id)
+                    return {
+                        "type": "onboarding_required",
+                        "message": onboarding_result["message"],
+                        "next_action": onboarding_result["next_action"]
+                    }
 
-            # Создаем VPN на trial период
-            result = await create_vpn_account(telegram_id, is_trial=True)
+                # Создаем VPN на trial период
+                result = await create_vpn_account(telegram_id, is_trial=True)
+            except BaseException:
+                # Компенсация: подписка не создана - trial остается доступным
+                await release_trial(telegram_id)
+                raise
 
             # 🔴 УЛУЧШЕНИЕ: Детальная проверка результата
             logger.info(f"🔍 Детальный результат создания trial VPN: {result}")
 
             if result and result.get("success"):
-                # Отмечаем trial как использованный
-                await mark_trial_used(telegram_id)
-
                 # Начисляем баллы за активацию trial
                 await update_user_balance(telegram_id, 5)
 
@@ -200,6 +222,9 @@ class ActionService:
                     "qrcode_buffer": result.get('qrcode_buffer')
                 }
             else:
+                # Компенсация: подписка не создана - trial остается доступным
+                await release_trial(telegram_id)
+
                 # 🔴 УЛУЧШЕНИЕ: Более информативное сообщение об ошибке
                 error_detail = result.get("error", "Неизвестная ошибка") if result else "VPN сервер недоступен"
 
@@ -257,7 +282,7 @@ class ActionService:
 
             # Создаем QR-код
             from services.vpn_service import create_qrcode
-            qrcode_buffer = create_qrcode(connection_string, str(telegram_id))
+            qrcode_buffer = await create_qrcode(connection_string, str(telegram_id))
 
             return {
                 "type": "success",
@@ -292,6 +317,16 @@ class ActionService:
 
             if result and result.get("success"):
                 status_text = "✅ Активна" if result["lease_is_active"] else "❌ Неактивна"
+
+                # Трафик из локальной статистики - один запрос к БД
+                traffic = await get_user_traffic(telegram_id)
+                traffic_text = ""
+                if traffic:
+                    traffic_text = (
+                        f"\n• Трафик сегодня: {format_traffic(traffic['today'])}\n"
+                        f"• Трафик за {traffic['days']} дней: {format_traffic(traffic['total'])}"
+                    )
+
                 return {
                     "type": "success",
                     "message": (
@@ -299,6 +334,7 @@ class ActionService:
                         f"• Состояние: {status_text}\n"
                         f"• Осталось дней: {result['expiry_days']}\n"
                         f"• ID: {telegram_id}"
+                        f"{traffic_text}"
                     )
                 }
             else:
@@ -406,12 +442,18 @@ class ActionService:
 
             user_data = {
                 "telegram_id": telegram_id,
-                "username": "user"  # Будет передано из хендлера
+                "username": "user",  # Будет передано из хендлера
+                "action": action
             }
 
             payment = await create_payment(provider, config, user_data)
 
             if payment:
+                # Платеж сохраняется в БД - переживает рестарт и активируется ровно один раз
+                await create_payment_record(
+                    provider, payment['payment_id'], telegram_id, action,
+                    payment['amount'], payment['currency']
+                )
                 return {
                     "type": "payment_created",
                     "message": (
@@ -446,34 +488,56 @@ class ActionService:
         ВЫХОД: {type: str, message: str}
         """
         try:
-            if await check_payment(payment_id, provider):
-                # Выполняем действие в зависимости от типа
-                if action == "create_vpn":
-                    vpn_result = await create_vpn_account(telegram_id)
-                elif action == "renew_vpn":
-                    vpn_result = await renew_vpn_account(telegram_id)
-                else:
-                    vpn_result = None
-
-                # Начисляем баллы за оплату
-                await update_user_balance(telegram_id, 10)
-
-                if vpn_result and vpn_result.get("success"):
-                    return {
-                        "type": "success",
-                        "message": "✅ Оплата подтверждена! VPN услуга активирована."
-                    }
-                else:
+            # Один запрос по уникальному индексу вместо обращения к провайдеру
+            payment = await get_payment_record(provider, payment_id)
+            if payment and payment['telegram_id'] != telegram_id:
+                payment = None
+
+            if not payment:
+                # Платеж создан до появления таблицы payments - сохраняем из данных FSM
+                await create_payment_record(provider, payment_id, telegram_id, action, PAYMENT_AMOUNT)
+                status = "pending"
+            else:
+                status = payment['status']
+
+            if status == "activated":
+                return self._activated_result()
+
+            if status == "activating":
+                # Зависшая (прерванная рестартом) активация забирается заново, идущая - не трогается
+                result = await self.activate_paid_service(provider, payment_id)
+                return result or await self._claimed_elsewhere_result(provider, payment_id)
+
+            if status == "expired":
+                # Оплата могла прийти после истечения счета - спрашиваем провайдера
+                if not await check_payment(payment_id, provider):
                     return {
-                        "type": "success",
-                        "message": "✅ Оплата подтверждена! Но возникла ошибка при активации услуги."
+                        "type": "error",
+                        "message": "❌ Счет истек. Создайте новый платеж."
                     }
-            else:
+                await mark_payment_paid(provider, payment_id)
+                result = await self.activate_paid_service(provider, payment_id, provider_confirmed=True)
+                return result or await self._claimed_elsewhere_result(provider, payment_id)
+
+            # Статус проверяет фоновый опрос - провайдера из хендлера не дергаем
+            if status == "pending" and is_payment_polling():
                 return {
                     "type": "error",
-                    "message": "❌ Оплата не найдена. Попробуйте позже."
+                    "message": "⏳ Оплата еще не поступила. Мы пришлем сообщение, как только она подтвердится."
                 }
 
+            # Статус еще не пришел вебхуком - спрашиваем провайдера
+            if status == "pending":
+                if not await check_payment(payment_id, provider):
+                    return {
+                        "type": "error",
+                        "message": "❌ Оплата не найдена. Попробуйте позже."
+                    }
+                await mark_payment_paid(provider, payment_id)
+
+            result = await self.activate_paid_service(provider, payment_id, provider_confirmed=(status == "pending"))
+            return result or await self._claimed_elsewhere_result(provider, payment_id)
+
         except Exception as e:
             logger.error(f"❌ Ошибка проверки платежа: {e}")
             return {
@@ -481,6 +545,103 @@ class ActionService:
                 "message": "❌ Ошибка при проверке платежа"
             }
 
+    @staticmethod
+    def _activated_result() -> Dict:
+        return {
+            "type": "success",
+            "message": "✅ Оплата уже подтверждена, VPN услуга активирована."
+        }
+
+    async def _claimed_elsewhere_result(self, provider: str, payment_id: str) -> Dict:
+        """Платеж забрал другой обработчик: активирован или активация еще идет"""
+        payment = await get_payment_record(provider, payment_id)
+        if payment and payment['status'] == "activated":
+            return self._activated_result()
+        return {
+            "type": "success",
+            "message": (
+                "⏳ Оплата подтверждена, VPN услуга активируется.\n"
+                "Нажмите «Проверить оплату» еще раз через минуту"
+            )
+        }
+
+    async def handle_payment_notification(self, notification: Dict) -> Optional[Dict]:
+        """
+        📍 ТОЧКА ВХОДА: Уведомление провайдера об оплате
+        ВЫЗЫВАЕТСЯ ИЗ: handlers.webhooks.payment_webhook()
+        ВХОД: {payment_id, provider, paid, telegram_id, action}
+        ВЫХОД: результат activate_paid_service() или None если активировать нечего
+        """
+        if not notification["paid"]:
+            return None
+
+        provider = notification["provider"]
+        payment_id = notification["payment_id"]
+
+        # Платеж неизвестен БД (создан до таблицы payments) - восстанавливаем из метаданных
+        if not await get_payment_record(provider, payment_id):
+            if not notification["telegram_id"] or not notification["action"]:
+                logger.warning(f"⚠️ Уведомление о неизвестном платеже {provider}:{payment_id}")
+                return None
+            await create_payment_record(
+                provider, payment_id, notification["telegram_id"], notification["action"], PAYMENT_AMOUNT
+            )
+
+        await mark_payment_paid(provider, payment_id)
+        return await self.activate_paid_service(provider, payment_id, provider_confirmed=True)
+
+    async def activate_paid_service(self, provider: str, payment_id: str,
+                                    provider_confirmed: bool = False) -> Optional[Dict]:
+        """
+        📍 ТОЧКА ВХОДА: Активация услуги по оплаченному платежу - РОВНО ОДИН РАЗ
+        ВЫЗЫВАЕТСЯ ИЗ: handle_check_payment(), handle_payment_notification(),
+                       фоновый опрос services.payment.payment_poller
+        ВХОД: provider, payment_id, provider_confirmed (провайдер только что подтвердил - подходит и истекший счет)
+        ВЫХОД: {type, message, qrcode_buffer, telegram_id} или None если платеж уже активируется/активирован
+        """
+        # Атомарный захват: вебхук и повторные нажатия не активируют платеж второй раз
+        # (activating старше PAYMENT_ACTIVATION_TIMEOUT считается прерванным и забирается заново)
+        payment = await claim_payment_activation(provider, payment_id, provider_confirmed, PAYMENT_ACTIVATION_TIMEOUT)
+        if not payment:
+            return None
+
+        telegram_id = payment['telegram_id']
+        action = payment['action']
+
+        # Выполняем действие в зависимости от типа
+        if action == "create_vpn":
+            vpn_result = await create_vpn_account(telegram_id)
+        elif action == "renew_vpn":
+            vpn_result = await renew_vpn_account(telegram_id)
+        else:
+            vpn_result = None
+
+        success = bool(vpn_result and vpn_result.get("success"))
+        await finish_payment_activation(provider, payment_id, success)
+
+        if success:
+            # Начисляем баллы за оплату
+            await update_user_balance(telegram_id, 10)
+
+            return {
+                "type": "success",
+                "message": (
+                    f"✅ Оплата подтверждена! VPN услуга активирована.\n"
+                    f"• Подключение: <code>{vpn_result['connection_string']}</code>"
+                ),
+                "qrcode_buffer": vpn_result.get('qrcode_buffer'),
+                "telegram_id": telegram_id
+            }
+        else:
+            return {
+                "type": "success",
+                "message": (
+                    "✅ Оплата подтверждена! Но возникла ошибка при активации услуги.\n"
+                    "Нажмите «Проверить оплату» еще раз позже"
+                ),
+                "telegram_id": telegram_id
+            }
+
 
 # =============================================
 # 🎯 ГЛОБАЛЬНЫЙ ЭКЗЕМПЛЯР ДЛЯ ИСПОЛЬЗОВАНИЯ
@@ -527,15 +688,30 @@ action_service = ActionService()
 
 7. handle_check_payment(payment_id, provider, action, telegram_id)
    • НАЗНАЧЕНИЕ: Проверка статуса оплаты
-   • ИСПОЛЬЗУЕТ: services.payment.check_payment()
+   • ИСПОЛЬЗУЕТ: services.payment.check_payment() (только если фоновый опрос выключен)
    • ВОЗВРАЩАЕТ: {type, message}
 
+8. handle_payment_notification(notification)
+   • НАЗНАЧЕНИЕ: Обработка уведомления провайдера (вебхук)
+   • ИСПОЛЬЗУЕТ: services.database.mark_payment_paid()
+   • ВОЗВРАЩАЕТ: результат activate_paid_service() или None
+
+9. activate_paid_service(provider, payment_id)
+   • НАЗНАЧЕНИЕ: Однократная активация услуги по оплаченному платежу
+   • ИСПОЛЬЗУЕТ: services.database.claim_payment_activation()
+   • ВОЗВРАЩАЕТ: {type, message, qrcode_buffer, telegram_id} или None
+
 🔄 ТИПЫ ВОЗВРАЩАЕМЫХ РЕЗУЛЬТАТОВ:
 • "success" - операция выполнена успешно
 • "error" - произошла ошибка
 • "payment_required" - требуется оплата
 • "onboarding_required" - требуется пройти onboarding
 
+🔒 ПОВТОРНЫЕ НАЖАТИЯ:
+• handle_get_vpn(), handle_renew_vpn(), handle_free_trial() выполняются один раз на пользователя
+• Параллельный вызов того же действия ждет и получает тот же результат
+• Счетчики: action_service.flights.get_stats()
+
 🎯 ИНТЕГРАЦИЯ С ONBOARDING:
 • handle_get_vpn() автоматически запускает onboarding
 • Настройка шагов в services.onboarding.py
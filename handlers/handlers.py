@@ -1,12 +1,14 @@
 from aiogram import Router, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, BufferedInputFile
+from aiogram.types import Message
 from aiogram.fsm.state import State, StatesGroup
 import logging
 
 from services.registration_service import registration_manager, RegistrationStates
 from handlers.action_service import action_service
+from handlers.throttling import ThrottleRule, throttling_middleware
+from handlers.notifications import send_qrcode
 from handlers.keyboards import (
     get_main_menu, get_profile_menu, get_subs_menu, get_instructions_menu,
     get_payment_methods, get_back_only, get_payment_check, get_confirmation_keyboard
@@ -18,6 +20,13 @@ from config import (
 
 logger = logging.getLogger(__name__)
 router = Router()
+router.message.middleware(throttling_middleware)
+
+# Лимиты нажатий: токенов в секунду на пользователя, запас нажатий подряд
+STATUS_THROTTLE = ThrottleRule("status", rate=1 / 10, burst=2, panel=True)
+CONNECTION_THROTTLE = ThrottleRule("connection", rate=1 / 10, burst=2, panel=True)
+VPN_ACTION_THROTTLE = ThrottleRule("vpn_action", rate=1 / 5, burst=2, panel=True)
+PAYMENT_CHECK_THROTTLE = ThrottleRule("payment_check", rate=1 / 5, burst=2)
 
 # 🔴 ДОБАВЛЯЕМ: Создаем класс состояний
 class ConfirmationStates(StatesGroup):
@@ -109,7 +118,7 @@ async def handle_main_menu(message: Message, state: FSMContext):
     await message.answer("🏠 Главное меню:", reply_markup=get_main_menu())
 
 
-@router.message(F.text == "🎁 Воспользоваться бесплатным периодом")
+@router.message(F.text == "🎁 Воспользоваться бесплатным периодом", flags={"throttle": VPN_ACTION_THROTTLE})
 async def handle_free_period(message: Message):
     """
     📍 ТОЧКА ВХОДА: Кнопка "🎁 Воспользоваться бесплатным периодом"
@@ -127,12 +136,11 @@ async def handle_free_period(message: Message):
 
     # Отправляем QR-код если есть (из памяти)
     if result.get("qrcode_buffer"):
-        photo = BufferedInputFile(result["qrcode_buffer"].getvalue(), filename="qrcode.png")
-        await message.answer_photo(photo, caption="📱 QR-код для подключения")
+        await send_qrcode(message.bot, message.chat.id, result["qrcode_buffer"])
 
 
-@router.message(F.text == "🚀 Приобрести подписку на VPN")
-@router.message(F.text == "🛒 Получить подписку")
+@router.message(F.text == "🚀 Приобрести подписку на VPN", flags={"throttle": VPN_ACTION_THROTTLE})
+@router.message(F.text == "🛒 Получить подписку", flags={"throttle": VPN_ACTION_THROTTLE})
 async def handle_get_vpn_unified(message: Message, state: FSMContext):
     """
     📍 ТОЧКА ВХОДА: Унифицированный обработчик получения VPN
@@ -159,8 +167,7 @@ async def handle_get_vpn_unified(message: Message, state: FSMContext):
     else:
         await message.answer(result["message"], reply_markup=get_main_menu(), parse_mode="HTML")
         if result.get("qrcode_buffer"):
-            photo = BufferedInputFile(result["qrcode_buffer"].getvalue(), filename="qrcode.png")
-            await message.answer_photo(photo, caption="📱 QR-код для подключения")
+            await send_qrcode(message.bot, message.chat.id, result["qrcode_buffer"])
 
 
 @router.message(StateFilter(ConfirmationStates.waiting_for_confirmation))
@@ -200,8 +207,7 @@ async def handle_confirmation(message: Message, state: FSMContext):
 
                 # Отправляем QR-код если есть
                 if result.get("qrcode_buffer"):
-                    photo = BufferedInputFile(result["qrcode_buffer"].getvalue(), filename="qrcode.png")
-                    await message.answer_photo(photo, caption="📱 QR-код для подключения")
+                    await send_qrcode(message.bot, message.chat.id, result["qrcode_buffer"])
 
                 await state.clear()
 
@@ -228,7 +234,7 @@ async def handle_confirmation(message: Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, выберите вариант из клавиатуры:")
 
 
-@router.message(F.text == "📱 Получить подключение")
+@router.message(F.text == "📱 Получить подключение", flags={"throttle": CONNECTION_THROTTLE})
 async def handle_get_connection(message: Message):
     """
     📍 ТОЧКА ВХОДА: Кнопка "📱 Получить подключение"
@@ -244,11 +250,10 @@ async def handle_get_connection(message: Message):
 
     # Отправляем QR-код если есть (из памяти)
     if result.get("qrcode_buffer"):
-        photo = BufferedInputFile(result["qrcode_buffer"].getvalue(), filename="qrcode.png")
-        await message.answer_photo(photo, caption="📱 QR-код для подключения")
+        await send_qrcode(message.bot, message.chat.id, result["qrcode_buffer"])
 
 
-@router.message(F.text == "📊 Узнать статус")
+@router.message(F.text == "📊 Узнать статус", flags={"throttle": STATUS_THROTTLE})
 async def handle_status(message: Message):
     """
     📍 ТОЧКА ВХОДА: Кнопка "📊 Узнать статус"
@@ -283,8 +288,7 @@ async def handle_confirmation(message: Message, state: FSMContext):
         else:
             await message.answer(result["message"], reply_markup=get_main_menu(), parse_mode="HTML")
             if result.get("qrcode_buffer"):
-                photo = BufferedInputFile(result["qrcode_buffer"].getvalue(), filename="qrcode.png")
-                await message.answer_photo(photo, caption="📱 QR-код для подключения")
+                await send_qrcode(message.bot, message.chat.id, result["qrcode_buffer"])
             await state.clear()
 
     elif message.text == "❌ Нет, отменить":
@@ -297,7 +301,7 @@ async def handle_confirmation(message: Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, выберите вариант из клавиатуры:")
 
 
-@router.message(F.text == "🔄 Продлить подписку")
+@router.message(F.text == "🔄 Продлить подписку", flags={"throttle": VPN_ACTION_THROTTLE})
 async def handle_renew(message: Message, state: FSMContext):
     """
     📍 ТОЧКА ВХОДА: Кнопка "🔄 Продлить подписку" - ИСПРАВЛЕННАЯ ВЕРСИЯ
@@ -314,8 +318,7 @@ async def handle_renew(message: Message, state: FSMContext):
     else:
         await message.answer(result["message"], reply_markup=get_main_menu(), parse_mode="HTML")
         if result.get("qrcode_buffer"):
-            photo = BufferedInputFile(result["qrcode_buffer"].getvalue(), filename="qrcode.png")
-            await message.answer_photo(photo, caption="📱 QR-код для подключения")
+            await send_qrcode(message.bot, message.chat.id, result["qrcode_buffer"])
 
 
 # =============================================
@@ -426,7 +429,7 @@ async def handle_payment_method(message: Message, state: FSMContext):
         await message.answer(result["message"], reply_markup=get_payment_methods())
 
 
-@router.message(F.state == "waiting_for_payment_confirmation")
+@router.message(F.state == "waiting_for_payment_confirmation", flags={"throttle": PAYMENT_CHECK_THROTTLE})
 async def handle_payment_confirmation(message: Message, state: FSMContext):
     """
     📍 ТОЧКА ВХОДА: Состояние подтверждения оплаты
@@ -447,7 +450,9 @@ async def handle_payment_confirmation(message: Message, state: FSMContext):
 
         # ВСЯ логика в ActionService
         result = await action_service.handle_check_payment(payment_id, provider, action, telegram_id)
-        await message.answer(result["message"], reply_markup=get_main_menu())
+        await message.answer(result["message"], reply_markup=get_main_menu(), parse_mode="HTML")
+        if result.get("qrcode_buffer"):
+            await send_qrcode(message.bot, message.chat.id, result["qrcode_buffer"])
         await state.clear()
     else:
         await message.answer("Нажмите «Проверить оплату» после завершения оплаты")
@@ -574,6 +579,10 @@ async def _process_registration_field(message: Message, state: FSMContext, field
 • waiting_for_payment_confirmation - Подтверждение оплаты
 • RegistrationStates.*           - Сбор данных регистрации
 
+⏳ ОГРАНИЧЕНИЕ ЧАСТОТЫ (handlers.throttling):
+• Лимит задается флагом throttle у хендлера (*_THROTTLE в начале файла)
+• panel=True - дополнительно общий лимит обращений к панели 3x-ui
+
 🔄 ПОТОК ДАННЫХ:
-Пользователь → Handler → ActionService → Services → База/API
+Пользователь → Throttling → Handler → ActionService → Services → База/API
 """
\ No newline at end of file
@@ -0,0 +1,77 @@
+import hashlib
+import logging
+from io import BytesIO
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile
+
+from handlers.keyboards import get_subs_menu
+from services.cache import TTLCache, MISSING
+from config import USER_CACHE_SIZE, QR_FILE_ID_TTL
+
+logger = logging.getLogger(__name__)
+
+QR_CAPTION = "📱 QR-код для подключения"
+
+# file_id уже загруженного QR по пользователю: telegram_id -> (sha256 PNG, file_id)
+qr_file_ids = TTLCache("qr_file_ids", max_size=USER_CACHE_SIZE, ttl=QR_FILE_ID_TTL)
+
+
+# =============================================
+# 📱 QR-КОДЫ ПОДКЛЮЧЕНИЯ
+# =============================================
+
+async def send_qrcode(bot: Bot, chat_id: int, qrcode_buffer: BytesIO, caption: str = QR_CAPTION):
+    """
+    📍 ТОЧКА ВХОДА: Отправка QR-кода подключения
+    ВЫЗЫВАЕТСЯ ИЗ: handlers.handlers, handlers.webhooks
+    РЕЗУЛЬТАТ: Повторная отправка того же QR - по file_id, без загрузки картинки
+    PNG - функция строки подключения: новая строка дает новый хэш, старый file_id не используется
+    """
+    png = qrcode_buffer.getvalue()
+    digest = hashlib.sha256(png).digest()
+
+    cached = qr_file_ids.get(chat_id)
+    if cached is not MISSING and cached[0] == digest:
+        try:
+            return await bot.send_photo(chat_id, cached[1], caption=caption)
+        except TelegramBadRequest as e:
+            logger.warning(f"⚠️ file_id QR-кода {chat_id} не принят, загружаем заново: {e}")
+            qr_file_ids.invalidate(chat_id)
+
+    sent = await bot.send_photo(chat_id, BufferedInputFile(png, filename="qrcode.png"), caption=caption)
+    if sent.photo:
+        # Самый крупный размер - тот, что был загружен
+        qr_file_ids.set(chat_id, (digest, sent.photo[-1].file_id))
+    return sent
+
+
+# =============================================
+# ⏳ НАПОМИНАНИЯ ОБ ОКОНЧАНИИ ПОДПИСКИ
+# =============================================
+
+def format_time_left(hours: int) -> str:
+    """72 -> "3 дн.", 2 -> "2 ч." """
+    if hours % 24 == 0:
+        return f"{hours // 24} дн."
+    return f"{hours} ч."
+
+
+async def send_expiry_reminder(bot: Bot, telegram_id: int, offset_hours: int, expiry_time: int):
+    """
+    📍 ТОЧКА ВХОДА: Напоминание об окончании подписки
+    ВЫЗЫВАЕТСЯ ИЗ: services.expiry_notifier (main.py передает bot)
+    РЕЗУЛЬТАТ: Сообщение пользователю с клавиатурой подписок
+    """
+    await bot.send_message(
+        telegram_id,
+        (
+            f"⏳ <b>Подписка скоро закончится</b>\n"
+            f"• Осталось: {format_time_left(offset_hours)}\n\n"
+            f"Продлите подписку заранее, чтобы VPN не отключился: «🔄 Продлить подписку»"
+        ),
+        reply_markup=get_subs_menu(),
+        parse_mode="HTML"
+    )
+    logger.info(f"✅ Напоминание об окончании подписки отправлено {telegram_id} (за {offset_hours} ч)")
@@ -0,0 +1,150 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message
+
+from services.cache import TTLCache, MISSING
+from config import THROTTLE_PANEL_RATE, THROTTLE_PANEL_BURST, THROTTLE_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ThrottleRule:
+    """
+    Лимит нажатий для хендлера (флаг throttle)
+    rate  - токенов в секунду (1/10 = одно нажатие в 10 секунд)
+    burst - запас нажатий подряд
+    panel - хендлер ходит в панель 3x-ui (дополнительно общий лимит на всех)
+    """
+    key: str
+    rate: float
+    burst: int = 1
+    panel: bool = False
+    reply: str = "⏳ Слишком часто. Подождите немного и попробуйте снова."
+
+
+class TokenBucket:
+    """Классический token bucket"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        # Пользователь уже получил ответ о лимите за текущее ожидание
+        self.notified = False
+
+    def available(self) -> bool:
+        """Есть ли токен (без списания)"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens >= 1
+
+    def take(self):
+        """Списывает токен (только после available() == True)"""
+        self.tokens -= 1
+        self.notified = False
+
+    def consume(self) -> bool:
+        if self.available():
+            self.take()
+            return True
+        return False
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    ОГРАНИЧЕНИЕ ЧАСТОТЫ НАЖАТИЙ
+    • Корзина токенов на пользователя и хендлер (флаг throttle)
+    • Общая корзина для всех хендлеров, обращающихся к панели
+    • При превышении - готовый текст без обращения к сервисам, один раз за ожидание
+    """
+
+    def __init__(self, panel_rate: float = 20, panel_burst: int = 40, max_users: int = 10000):
+        self.panel_bucket = TokenBucket(panel_rate, panel_burst)
+        self._buckets = TTLCache("throttling", max_size=max_users, ttl=60)
+
+        # Счетчики
+        self.passed = 0
+        self.throttled: Dict[str, int] = {}
+        self.panel_throttled = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any]
+    ) -> Any:
+        rule = get_flag(data, "throttle")
+        if rule is None or event.from_user is None:
+            return await handler(event, data)
+
+        key = (event.from_user.id, rule.key)
+        bucket = self._buckets.get(key)
+        if bucket is MISSING:
+            bucket = TokenBucket(rule.rate, rule.burst)
+        # Запись живет, пока корзина не наполнится заново - дальше она не нужна
+        self._buckets.set(key, bucket, ttl=rule.burst / rule.rate)
+
+        # Сначала проверяются обе корзины: отказ по одной не должен списывать токен другой
+        if not bucket.available():
+            self.throttled[rule.key] = self.throttled.get(rule.key, 0) + 1
+            return await self._reject(event, bucket, rule.reply)
+
+        if rule.panel and not self.panel_bucket.available():
+            self.panel_throttled += 1
+            logger.warning(f"⚠️ Общий лимит запросов к панели исчерпан ({rule.key})")
+            return await self._reject(event, bucket, "⏳ Сервис перегружен. Попробуйте через минуту.")
+
+        bucket.take()
+        if rule.panel:
+            self.panel_bucket.take()
+        self.passed += 1
+        return await handler(event, data)
+
+    @staticmethod
+    async def _reject(event: Message, bucket: TokenBucket, text: str):
+        # Повторные нажатия в том же ожидании просто игнорируются
+        if not bucket.notified:
+            bucket.notified = True
+            await event.answer(text)
+
+    def get_stats(self) -> Dict:
+        """Счетчики пропущенных и отклоненных апдейтов"""
+        return {
+            "passed": self.passed,
+            "throttled": dict(self.throttled),
+            "throttled_total": sum(self.throttled.values()),
+            "panel_throttled": self.panel_throttled,
+            "tracked_users": len(self._buckets)
+        }
+
+
+# Глобальный экземпляр (подключается в handlers.handlers)
+throttling_middleware = ThrottlingMiddleware(
+    panel_rate=THROTTLE_PANEL_RATE,
+    panel_burst=THROTTLE_PANEL_BURST,
+    max_users=THROTTLE_CACHE_SIZE
+)
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from handlers.throttling import ThrottleRule, throttling_middleware
+
+router.message.middleware(throttling_middleware)
+
+STATUS_THROTTLE = ThrottleRule("status", rate=1 / 10, burst=2, panel=True)
+
+@router.message(F.text == "📊 Узнать статус", flags={"throttle": STATUS_THROTTLE})
+async def handle_status(message: Message):
+    ...
+
+print(throttling_middleware.get_stats())
+'''
@@ -0,0 +1,264 @@
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from services.payment import process_notification
+from handlers.action_service import action_service
+from handlers.keyboards import get_main_menu
+from handlers.notifications import send_qrcode
+from config import PAYMENT_WEBHOOK_PATH, PAYMENT_WEBHOOK_SECRET, HTTP_SERVER_HOST, HTTP_SERVER_PORT, \
+    BOT_WEBHOOK_URL, BOT_WEBHOOK_PATH, BOT_WEBHOOK_SECRET, BOT_WEBHOOK_MAX_IN_FLIGHT, BOT_WEBHOOK_MAX_CONNECTIONS
+
+logger = logging.getLogger(__name__)
+
+# Ключи приложения aiohttp
+BOT_KEY = web.AppKey("bot", Bot)
+DISPATCHER_KEY = web.AppKey("dispatcher", Dispatcher)
+
+# Фоновые активации (ссылки держим, чтобы задачи не собрал GC)
+_background_tasks = set()
+
+
+# =============================================
+# 💰 УВЕДОМЛЕНИЯ ПЛАТЕЖНЫХ ПРОВАЙДЕРОВ
+# =============================================
+
+async def payment_webhook(request: web.Request) -> web.Response:
+    """
+    📍 ТОЧКА ВХОДА: POST {PAYMENT_WEBHOOK_PATH}/{provider}
+    ЗАПУСК: HTTP-уведомление ЮMoney / карты / СБП (Tinkoff)
+    РЕЗУЛЬТАТ: Быстрый ответ провайдеру + активация услуги в фоне
+    """
+    provider = request.match_info["provider"]
+
+    # Общий секрет в URL (провайдеры ЮKassa не подписывают уведомления)
+    if PAYMENT_WEBHOOK_SECRET:
+        token = request.query.get("token", "")
+        if not hmac.compare_digest(token, PAYMENT_WEBHOOK_SECRET):
+            logger.warning(f"⚠️ Уведомление {provider} с неверным токеном от {request.remote}")
+            return web.Response(status=403)
+
+    try:
+        if request.content_type == "application/json":
+            payload = await request.json()
+        else:
+            payload = dict(await request.post())
+    except Exception as e:
+        logger.warning(f"⚠️ Некорректное тело уведомления {provider}: {e}")
+        return web.Response(status=400)
+
+    notification = await process_notification(provider, payload)
+    if not notification:
+        return web.Response(status=400)
+
+    if notification["paid"]:
+        task = asyncio.create_task(_activate_and_notify(request.app[BOT_KEY], notification))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    # Tinkoff ждет тело "OK", ЮKassa - любой 200
+    return web.Response(text="OK")
+
+
+async def _activate_and_notify(bot: Bot, notification: dict):
+    """Активация услуги и сообщение пользователю (в фоне)"""
+    try:
+        result = await action_service.handle_payment_notification(notification)
+        if not result:
+            # Платеж уже активирован (повтор уведомления или кнопка «Проверить оплату»)
+            return
+
+        await _notify_user(bot, result)
+        logger.info(f"✅ Платеж {notification['payment_id']} обработан по уведомлению")
+    except Exception as e:
+        logger.error(f"❌ Ошибка активации по уведомлению {notification['payment_id']}: {e}")
+
+
+async def activate_and_notify(bot: Bot, provider: str, payment_id: str):
+    """
+    Активация уже оплаченного платежа и сообщение пользователю
+    ВЫЗЫВАЕТСЯ ИЗ: фонового опроса services.payment.payment_poller
+    """
+    result = await action_service.activate_paid_service(provider, payment_id, provider_confirmed=True)
+    if result:
+        await _notify_user(bot, result)
+
+
+async def _notify_user(bot: Bot, result: dict):
+    telegram_id = result["telegram_id"]
+    await bot.send_message(telegram_id, result["message"], reply_markup=get_main_menu(), parse_mode="HTML")
+    if result.get("qrcode_buffer"):
+        await send_qrcode(bot, telegram_id, result["qrcode_buffer"])
+
+
+# =============================================
+# 🤖 АПДЕЙТЫ TELEGRAM (режим BOT_MODE=webhook)
+# =============================================
+
+class UpdateLimiter:
+    """Ограничение числа апдейтов, обрабатываемых одновременно"""
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+        # Счетчики
+        self.in_flight = 0
+        self.received = 0
+        self.processed = 0
+        self.waited = 0
+        self.rejected = 0
+        self.errors = 0
+
+    async def acquire(self):
+        """Ждет свободный слот - пока все заняты, Telegram не получает ответ и не шлет новые апдейты"""
+        if self._semaphore.locked():
+            self.waited += 1
+        await self._semaphore.acquire()
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def get_stats(self) -> dict:
+        """Счетчики обработки апдейтов"""
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "received": self.received,
+            "processed": self.processed,
+            "waited": self.waited,
+            "rejected": self.rejected,
+            "errors": self.errors
+        }
+
+
+update_limiter = UpdateLimiter(BOT_WEBHOOK_MAX_IN_FLIGHT)
+
+
+async def bot_webhook(request: web.Request) -> web.Response:
+    """
+    📍 ТОЧКА ВХОДА: POST {BOT_WEBHOOK_PATH}
+    ЗАПУСК: Telegram доставляет апдейт
+    РЕЗУЛЬТАТ: Апдейт обрабатывается в фоне, Telegram сразу получает 200
+    """
+    if BOT_WEBHOOK_SECRET:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, BOT_WEBHOOK_SECRET):
+            update_limiter.rejected += 1
+            logger.warning(f"⚠️ Апдейт с неверным секретом от {request.remote}")
+            return web.Response(status=401)
+
+    bot = request.app[BOT_KEY]
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        update_limiter.rejected += 1
+        logger.warning(f"⚠️ Некорректный апдейт: {e}")
+        return web.Response(status=400)
+
+    update_limiter.received += 1
+    await update_limiter.acquire()
+    task = asyncio.create_task(_process_update(request.app[DISPATCHER_KEY], bot, update))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return web.Response()
+
+
+async def _process_update(dp: Dispatcher, bot: Bot, update: Update):
+    try:
+        await dp.feed_update(bot, update)
+        update_limiter.processed += 1
+    except Exception as e:
+        update_limiter.errors += 1
+        logger.error(f"❌ Ошибка обработки апдейта {update.update_id}: {e}")
+    finally:
+        update_limiter.release()
+
+
+def setup_bot_webhook(app: web.Application, bot: Bot, dp: Dispatcher):
+    """Регистрирует маршрут апдейтов Telegram в HTTP-приложении"""
+    app[BOT_KEY] = bot
+    app[DISPATCHER_KEY] = dp
+    app.router.add_post(BOT_WEBHOOK_PATH, bot_webhook)
+
+
+async def register_bot_webhook(bot: Bot, dp: Dispatcher):
+    """Сообщает Telegram адрес вебхука (накопленные апдейты не сбрасываются)"""
+    await bot.set_webhook(
+        url=f"{BOT_WEBHOOK_URL.rstrip('/')}{BOT_WEBHOOK_PATH}",
+        secret_token=BOT_WEBHOOK_SECRET or None,
+        max_connections=BOT_WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info(f"✅ Вебхук бота зарегистрирован: {BOT_WEBHOOK_URL}{BOT_WEBHOOK_PATH}")
+
+
+async def drain_updates():
+    """Дожидается фоновых задач перед остановкой"""
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+
+def setup_payment_webhooks(app: web.Application, bot: Bot):
+    """Регистрирует маршруты уведомлений платежей в HTTP-приложении"""
+    app[BOT_KEY] = bot
+    app.router.add_post(f"{PAYMENT_WEBHOOK_PATH}/{{provider}}", payment_webhook)
+
+
+async def start_http_server(app: web.Application) -> web.AppRunner:
+    """Запускает общий HTTP-сервер бота (остановка - runner.cleanup())"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, HTTP_SERVER_HOST, HTTP_SERVER_PORT)
+    await site.start()
+    logger.info(f"✅ HTTP-сервер запущен на {HTTP_SERVER_HOST}:{HTTP_SERVER_PORT}")
+    return runner
+
+
+# =============================================
+# 📋 ДОКУМЕНТАЦИЯ
+# =============================================
+"""
+🏗️ ОБЩИЙ HTTP-СЕРВЕР (HTTP_SERVER_HOST:HTTP_SERVER_PORT):
+
+POST /telegram/webhook                        - апдейты Telegram (BOT_MODE=webhook)
+POST /payments/webhook/{provider}             - уведомления об оплате
+
+🤖 АПДЕЙТЫ TELEGRAM:
+• Секрет проверяется по заголовку X-Telegram-Bot-Api-Secret-Token
+• Каждый апдейт обрабатывается в отдельной задаче, Telegram сразу получает 200
+• Не более BOT_WEBHOOK_MAX_IN_FLIGHT апдейтов одновременно - дальше ответ задерживается
+• Счетчики: update_limiter.get_stats()
+
+🧪 НАГРУЗОЧНАЯ ПРОВЕРКА (синтетические апдейты):
+for i in $(seq 1 1000); do
+  curl -s -X POST "http://localhost:8081/telegram/webhook" \\
+       -H "X-Telegram-Bot-Api-Secret-Token: SECRET" -H "Content-Type: application/json" \\
+       -d '{"update_id": '$i', "message": {"message_id": '$i', "date": 0,
+            "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": false, "first_name": "T"},
+            "text": "/start"}}' &
+done; wait
+
+🏗️ HTTP-УВЕДОМЛЕНИЯ ОБ ОПЛАТЕ:
+
+POST /payments/webhook/yoomoney?token=SECRET  - уведомление ЮMoney (формат ЮKassa)
+POST /payments/webhook/card?token=SECRET      - уведомление ЮKassa (карты)
+POST /payments/webhook/sbp?token=SECRET       - уведомление Tinkoff (подпись Token)
+
+🔒 ПРОВЕРКА:
+• СБП - подпись Token (SHA-256 от значений + Password)
+• ЮMoney/карты - повторный запрос статуса платежа в API провайдера
+• Опционально - общий секрет PAYMENT_WEBHOOK_SECRET в параметре token
+
+🧪 ЛОКАЛЬНАЯ ПРОВЕРКА (имитация провайдера):
+curl -X POST "http://localhost:8081/payments/webhook/sbp?token=SECRET" \\
+     -H "Content-Type: application/json" \\
+     -d '{"TerminalKey": "...", "PaymentId": "123", "Status": "CONFIRMED",
+          "Success": true, "Token": "<SBPProvider.make_notification_token(payload)>"}'
+"""
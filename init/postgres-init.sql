@@ -21,6 +21,102 @@ CREATE TABLE IF NOT EXISTS users (
 -- Индекс для быстрого поиска по username
 CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
 
+-- Платежи (статус переживает рестарт бота, активация - ровно один раз)
+CREATE TABLE IF NOT EXISTS payments (
+    id BIGSERIAL PRIMARY KEY,
+    provider VARCHAR(32) NOT NULL,
+    provider_payment_id VARCHAR(128) NOT NULL,
+    telegram_id BIGINT NOT NULL,
+    action VARCHAR(32) NOT NULL,
+    amount NUMERIC(12, 2) NOT NULL,
+    currency VARCHAR(8) DEFAULT 'RUB',
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    paid_at TIMESTAMP,
+    activated_at TIMESTAMP,
+    claimed_at TIMESTAMP,
+    UNIQUE (provider, provider_payment_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_payments_telegram_id ON payments(telegram_id);
+CREATE INDEX IF NOT EXISTS idx_payments_pending ON payments(created_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_payments_pending_id ON payments(id) WHERE status = 'pending';
+
+-- Подписки: локальная копия клиентов панели 3x-ui
+CREATE TABLE IF NOT EXISTS subscriptions (
+    telegram_id BIGINT PRIMARY KEY,
+    client_uuid VARCHAR(36) NOT NULL,
+    inbound_id INTEGER NOT NULL,
+    expiry_time BIGINT NOT NULL DEFAULT 0,
+    enabled BOOLEAN NOT NULL DEFAULT TRUE,
+    total_gb BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    synced_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_expiry_time ON subscriptions(expiry_time);
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_expired ON subscriptions(telegram_id, expiry_time)
+    WHERE enabled AND expiry_time > 0;
+
+-- Прогресс фоновых проходов (отключение истекших клиентов)
+CREATE TABLE IF NOT EXISTS sweep_state (
+    job VARCHAR(32) PRIMARY KEY,
+    cursor BIGINT NOT NULL DEFAULT 0,
+    processed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+-- Отправленные напоминания об окончании подписки
+CREATE TABLE IF NOT EXISTS expiry_reminders (
+    telegram_id BIGINT NOT NULL,
+    expiry_time BIGINT NOT NULL,
+    offset_hours INTEGER NOT NULL,
+    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (telegram_id, expiry_time, offset_hours)
+);
+
+-- Статистика трафика: последние счетчики панели и временной ряд приращений (5m / 1h / 1d)
+CREATE TABLE IF NOT EXISTS traffic_counters (
+    telegram_id BIGINT PRIMARY KEY,
+    up BIGINT NOT NULL DEFAULT 0,
+    down BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS traffic_stats (
+    telegram_id BIGINT NOT NULL,
+    resolution VARCHAR(2) NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    up BIGINT NOT NULL DEFAULT 0,
+    down BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (telegram_id, resolution, bucket)
+);
+
+CREATE INDEX IF NOT EXISTS idx_traffic_stats_retention ON traffic_stats(resolution, bucket);
+
+-- Состояния FSM бота (переживают рестарт, общие для нескольких процессов)
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key VARCHAR(255) PRIMARY KEY,
+    state VARCHAR(255),
+    data JSONB NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at);
+
+-- Готовые PNG QR-кодов по sha256 строки подключения (QR_CACHE_PERSIST)
+CREATE TABLE IF NOT EXISTS qr_codes (
+    digest BYTEA PRIMARY KEY,
+    png BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Функция и триггер для автоматического обновления updated_at
 CREATE OR REPLACE FUNCTION update_updated_at_column()
 RETURNS TRIGGER AS $$
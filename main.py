@@ -1,9 +1,25 @@
 import asyncio
 import logging
+import signal
+from functools import partial
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from handlers.handlers import router
-from config import BOT_TOKEN
-from services.database import init_database
+from handlers.webhooks import setup_payment_webhooks, start_http_server, activate_and_notify, \
+    setup_bot_webhook, register_bot_webhook, drain_updates
+from config import BOT_TOKEN, BOT_MODE, PAYMENT_WEBHOOK_ENABLED, RECONCILE_ENABLED, TRAFFIC_ENABLED, \
+    EXPIRY_REMINDERS_ENABLED, SWEEP_ENABLED
+from services.database import init_database, close_database
+from services.xui_client import xui_panel
+from services.client_batcher import client_batcher
+from services.qr_renderer import qr_renderer
+from services.fsm_storage import create_fsm_storage
+from services.reconciliation import subscription_reconciler
+from services.traffic import traffic_collector
+from services.expiry_notifier import expiry_notifier
+from services.expiry_sweeper import expiry_sweeper
+from handlers.notifications import send_expiry_reminder
+from services.payment import payment_manager, payment_poller, PAYMENT_POLL_ENABLED
 from handlers.keyboards import setup_menu_button
 
 # Настройка логирования
@@ -14,7 +30,31 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def wait_for_stop_signal():
+    """Ждет SIGTERM/SIGINT - после сигнала main() выходит в finally и останавливает сервисы"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    signals = (signal.SIGTERM, signal.SIGINT)
+    for sig in signals:
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: обработчиков сигналов в цикле нет, Ctrl+C прервет ожидание сам
+            pass
+    try:
+        await stop.wait()
+        logger.info("🛑 Получен сигнал остановки")
+    finally:
+        for sig in signals:
+            try:
+                loop.remove_signal_handler(sig)
+            except NotImplementedError:
+                pass
+
+
 async def main():
+    http_runner = None
+    storage = None
     try:
         logger.info("🚀 Запуск бота...")
 
@@ -25,24 +65,77 @@ async def main():
             logger.error("❌ Не удалось инициализировать базу данных")
             return
 
-        # 2. Создаем бота и диспетчер
+        # 2. HTTP-сессия платежных провайдеров
+        if payment_manager.is_enabled():
+            await payment_manager.start()
+
+        # 2.1 Фоновая сверка подписок с панелью и сбор трафика
+        if RECONCILE_ENABLED:
+            subscription_reconciler.start()
+        if TRAFFIC_ENABLED:
+            traffic_collector.start()
+        if SWEEP_ENABLED:
+            expiry_sweeper.start()
+
+        # 3. Создаем бота и диспетчер
         bot = Bot(token=BOT_TOKEN)
-        dp = Dispatcher()
+        storage = create_fsm_storage()
+        dp = Dispatcher(storage=storage)
 
-        # 3. Настраиваем Menu Button
+        # 4. Настраиваем Menu Button
         logger.info("📋 Настройка меню...")
         await setup_menu_button(bot)
 
-        # 4. Подключаем роутер
+        # 5. Подключаем роутер
         dp.include_router(router)
 
-        # 5. Запускаем бота
-        logger.info("✅ Бот запущен и готов к работе!")
-        await dp.start_polling(bot)
+        # 6. Общий HTTP-сервер: апдейты Telegram и уведомления об оплате
+        if BOT_MODE == "webhook" or PAYMENT_WEBHOOK_ENABLED:
+            app = web.Application()
+            if BOT_MODE == "webhook":
+                setup_bot_webhook(app, bot, dp)
+            if PAYMENT_WEBHOOK_ENABLED:
+                setup_payment_webhooks(app, bot)
+            http_runner = await start_http_server(app)
+
+        # 7. Фоновый опрос неподтвержденных платежей
+        if payment_manager.is_enabled() and PAYMENT_POLL_ENABLED:
+            payment_poller.start(partial(activate_and_notify, bot))
+
+        # 7.1 Напоминания об окончании подписки
+        if EXPIRY_REMINDERS_ENABLED:
+            expiry_notifier.start(partial(send_expiry_reminder, bot))
+
+        # 8. Запускаем бота
+        if BOT_MODE == "webhook":
+            await register_bot_webhook(bot, dp)
+            logger.info("✅ Бот запущен в режиме вебхука!")
+            await wait_for_stop_signal()
+        else:
+            # Вебхук, оставшийся от запуска в режиме webhook, блокирует getUpdates
+            await bot.delete_webhook()
+            logger.info("✅ Бот запущен и готов к работе!")
+            # start_polling сам останавливается по SIGTERM/SIGINT
+            await dp.start_polling(bot)
 
     except Exception as e:
         logger.error(f"❌ Критическая ошибка при запуске: {e}")
     finally:
+        await payment_poller.stop()
+        await subscription_reconciler.stop()
+        await traffic_collector.stop()
+        await expiry_notifier.stop()
+        await expiry_sweeper.stop()
+        if http_runner:
+            await http_runner.cleanup()
+            await drain_updates()
+        if storage:
+            await storage.close()
+        await payment_manager.close()
+        await client_batcher.drain()
+        await xui_panel.close()
+        qr_renderer.close()
+        await close_database()
         logger.info("🛑 Бот остановлен")
 
 
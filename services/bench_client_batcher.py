@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import time
+import uuid
+from typing import List
+
+from py3xui import Client
+
+from services.client_batcher import ClientAddBatcher
+from config import XUI_MAX_CONCURRENCY
+
+
+class FakePanel:
+    """
+    ФЕЙКОВАЯ ПАНЕЛЬ ДЛЯ ЗАМЕРА ПАЧЕК
+    • Как xui_panel.request: не больше concurrency вызовов одновременно
+    • Как inbounds/addClient: один POST на пачку, время ответа растет на per_client за клиента
+    """
+
+    def __init__(self, latency: float, per_client: float, concurrency: int):
+        self.latency = latency
+        self.per_client = per_client
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.posts = 0
+
+    async def submit(self, inbound_id: int, clients: List[Client]):
+        async with self.semaphore:
+            await asyncio.sleep(self.latency + self.per_client * len(clients))
+            self.posts += 1
+
+
+async def run(window: float, signups: int, latency: float, per_client: float, concurrency: int, spread: float):
+    panel = FakePanel(latency, per_client, concurrency)
+    batcher = ClientAddBatcher(window=window, submit=panel.submit)
+    clients = [Client(id=str(uuid.uuid4()), email=str(1000 + i), enable=True) for i in range(signups)]
+
+    waits = []
+
+    async def signup(i, client):
+        # Регистрации приходят равномерно за spread секунд (0 - все разом)
+        await asyncio.sleep(spread * i / signups)
+        started = time.monotonic()
+        await batcher.add(1, client)
+        waits.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*(signup(i, client) for i, client in enumerate(clients)))
+    total = time.monotonic() - started
+
+    waits.sort()
+    print(
+        f"window={window:<5} spread={spread:<4} всего {total:6.2f} с, POST {panel.posts}, "
+        f"ожидание p50 {waits[len(waits) // 2] * 1000:6.0f} мс, "
+        f"p99 {waits[int(len(waits) * 0.99) - 1] * 1000:6.0f} мс, {batcher.get_stats()}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Замер пачек создания клиентов на фейковой панели")
+    parser.add_argument("--signups", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.03, help="секунд на один POST панели")
+    parser.add_argument("--per-client", type=float, default=0.0005, help="секунд панели на каждого клиента пачки")
+    parser.add_argument("--concurrency", type=int, default=XUI_MAX_CONCURRENCY)
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 0.05, 0.1])
+    parser.add_argument("--spreads", type=float, nargs="+", default=[0, 2], help="секунд, за которые приходят регистрации")
+    args = parser.parse_args()
+
+    for spread in args.spreads:
+        for window in args.windows:
+            await run(window, args.signups, args.latency, args.per_client, args.concurrency, spread)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+python -m services.bench_client_batcher
+python -m services.bench_client_batcher --signups 1000 --latency 0.05 --windows 0 0.1
+'''
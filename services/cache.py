@@ -0,0 +1,117 @@
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+# Маркер отсутствия значения (None тоже может быть закэширован)
+MISSING = object()
+
+
+class TTLCache:
+    """
+    УНИВЕРСАЛЬНЫЙ ограниченный LRU-кэш с временем жизни записей
+    Используется как read-through слой перед БД и внешними API
+    """
+
+    def __init__(self, name: str, max_size: int = 10000, ttl: float = 60.0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        # Поколение растет при каждой инвалидации - защищает от записи устаревших данных
+        self._generation = 0
+
+        # Счетчики для подбора размера кэша
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self) -> int:
+        """Текущее поколение кэша (снимать ДО запроса к источнику)"""
+        return self._generation
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """Возвращает значение из кэша или default"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, generation: int = None, ttl: float = None):
+        """
+        Сохраняет значение в кэш
+        Если передан generation и с тех пор была инвалидация - значение не сохраняется
+        """
+        if generation is not None and generation != self._generation:
+            return
+
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """Удаляет запись после изменения данных в источнике"""
+        self._generation += 1
+        self.invalidations += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        """Полная очистка кэша"""
+        self._generation += 1
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_stats(self) -> Dict:
+        """Счетчики попаданий/промахов/вытеснений"""
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.cache import TTLCache, MISSING
+
+cache = TTLCache("users", max_size=10000, ttl=60)
+
+value = cache.get(key)
+if value is MISSING:
+    generation = cache.generation
+    value = await load_from_db(key)
+    cache.set(key, value, generation=generation)
+
+# После изменения данных
+cache.invalidate(key)
+
+print(cache.get_stats())
+'''
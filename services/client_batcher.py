@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from py3xui import Client
+
+from services.xui_client import xui_panel
+from services.inbound_cache import inbound_cache
+from config import XUI_ADD_BATCH_WINDOW, XUI_ADD_BATCH_MAX
+
+logger = logging.getLogger(__name__)
+
+# Ожидающий клиент пачки: (клиент, future вызывающего)
+PendingClient = Tuple[Client, asyncio.Future]
+
+
+async def add_clients_to_panel(inbound_id: int, clients: List[Client]):
+    """
+    Один POST inbounds/addClient на всю пачку: в settings перечислены все клиенты
+    client.add в py3xui шлет по запросу на клиента - поэтому запрос собирается напрямую
+    Панель проверяет email всех клиентов до сохранения: дубликат отклоняет пачку целиком
+    """
+    data = {
+        "id": inbound_id,
+        "settings": json.dumps({
+            "clients": [client.model_dump(by_alias=True, exclude_defaults=True) for client in clients]
+        })
+    }
+    await xui_panel.request(
+        lambda a: a.client._post(a.client._url("panel/api/inbounds/addClient"),
+                                 {"Accept": "application/json"}, data)
+    )
+
+
+class ClientAddBatcher:
+    """
+    ПАЧКИ СОЗДАНИЯ КЛИЕНТОВ
+    • Параллельные создания за окно window уходят на панель одним запросом
+    • Пачка уходит раньше, если набралось max_batch клиентов
+    • Результат (успех или ошибка) раздается каждому ожидающему
+    • Пачка не прошла - клиенты, которых нет в свежем снимке инбаунда, повторяются по одному
+    • Повтор не прошел - перед ошибкой клиент еще раз ищется в снимке (мог создаться до сбоя)
+    submit - отправка пачки (по умолчанию панель, для проверки - фейковая панель)
+    window=0 - каждый клиент отдельным запросом, без пачек
+    """
+
+    def __init__(self, window: float = 0.05, max_batch: int = 50,
+                 submit: Callable[[int, List[Client]], Awaitable[None]] = add_clients_to_panel):
+        self.window = window
+        self.max_batch = max_batch
+        self.submit = submit
+
+        self._pending: Dict[int, List[PendingClient]] = {}
+        self._timers: Dict[int, asyncio.Task] = {}
+        self._flushes: Set[asyncio.Task] = set()
+
+        # Счетчики
+        self.batches = 0
+        self.clients = 0
+        self.largest_batch = 0
+        self.fallbacks = 0
+        self.already_added = 0
+        self.errors = 0
+
+    async def add(self, inbound_id: int, client: Client):
+        """Добавляет клиента в ближайшую пачку и ждет ее отправки (ошибка панели пробрасывается)"""
+        if self.window <= 0:
+            await self._send(inbound_id, [client])
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.setdefault(inbound_id, [])
+        batch.append((client, future))
+
+        if len(batch) >= self.max_batch:
+            timer = self._timers.pop(inbound_id, None)
+            if timer:
+                timer.cancel()
+            self._start_flush(inbound_id)
+        elif len(batch) == 1:
+            self._timers[inbound_id] = asyncio.create_task(self._flush_later(inbound_id))
+
+        await future
+
+    def _start_flush(self, inbound_id: int):
+        batch = self._pending.pop(inbound_id, None)
+        if not batch:
+            return
+        # Отправка не зависит от отмены отдельных вызывающих
+        task = asyncio.create_task(self._flush(inbound_id, batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush_later(self, inbound_id: int):
+        await asyncio.sleep(self.window)
+        self._timers.pop(inbound_id, None)
+        self._start_flush(inbound_id)
+
+    async def _send(self, inbound_id: int, clients: List[Client]):
+        try:
+            await self.submit(inbound_id, clients)
+        finally:
+            # Даже при ошибке часть клиентов могла создаться
+            inbound_cache.invalidate(inbound_id)
+
+    async def _find_added(self, inbound_id: int, clients: List[Client]) -> Set[str]:
+        """Email клиентов, которые уже есть в свежем снимке инбаунда (снимок не скачался - пусто)"""
+        try:
+            snapshot = await inbound_cache.get(inbound_id, force=True)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось проверить клиентов пачки на панели: {e}")
+            return set()
+        if snapshot is None:
+            return set()
+
+        added = set()
+        for client in clients:
+            found = snapshot.get_client(client.email)
+            if found is not None and found.id == client.id:
+                added.add(client.email)
+        self.already_added += len(added)
+        return added
+
+    async def _retry(self, inbound_id: int, clients: List[Client],
+                     error: Exception) -> List[Optional[BaseException]]:
+        """Повтор не прошедшей пачки: созданные до сбоя клиенты не отправляются второй раз"""
+        if len(clients) == 1:
+            return [error]
+
+        added = await self._find_added(inbound_id, clients)
+        retry = [client for client in clients if client.email not in added]
+        errors: Dict[str, Optional[BaseException]] = {}
+        if retry:
+            logger.warning(
+                f"⚠️ Пачка из {len(clients)} клиентов не добавлена ({len(added)} уже на панели), "
+                f"повтор по одному: {error}"
+            )
+            self.fallbacks += 1
+            results = await asyncio.gather(
+                *(self._send(inbound_id, [client]) for client in retry),
+                return_exceptions=True
+            )
+            errors = {client.email: result for client, result in zip(retry, results) if result is not None}
+
+        # Повтор мог упасть на дубликате, если клиент создался, а ответ панели потерялся
+        if errors:
+            failed = [client for client in retry if client.email in errors]
+            for email in await self._find_added(inbound_id, failed):
+                errors.pop(email)
+
+        return [errors.get(client.email) for client in clients]
+
+    async def _flush(self, inbound_id: int, batch: List[PendingClient]):
+        started = time.monotonic()
+        clients = [client for client, _ in batch]
+        self.batches += 1
+        self.clients += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+
+        try:
+            await self._send(inbound_id, clients)
+            errors: List[Optional[BaseException]] = [None] * len(batch)
+        except Exception as e:
+            errors = await self._retry(inbound_id, clients, e)
+
+        for (_, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                self.errors += 1
+                future.set_exception(error)
+
+        logger.info(
+            f"✅ Пачка клиентов отправлена: {len(batch)} шт, {(time.monotonic() - started) * 1000:.0f} мс"
+        )
+
+    async def drain(self):
+        """Отправляет собранные пачки и ждет их при завершении бота"""
+        for inbound_id in list(self._pending):
+            timer = self._timers.pop(inbound_id, None)
+            if timer:
+                timer.cancel()
+            self._start_flush(inbound_id)
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def get_stats(self) -> Dict:
+        """Счетчики пачек"""
+        return {
+            "batches": self.batches,
+            "clients": self.clients,
+            "avg_batch": round(self.clients / self.batches, 1) if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "fallbacks": self.fallbacks,
+            "already_added": self.already_added,
+            "errors": self.errors
+        }
+
+
+# Глобальный экземпляр
+client_batcher = ClientAddBatcher(window=XUI_ADD_BATCH_WINDOW, max_batch=XUI_ADD_BATCH_MAX)
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.client_batcher import client_batcher, ClientAddBatcher
+
+await client_batcher.add(INBOUND_ID, new_client)   # вернется после отправки пачки (или ошибки)
+print(client_batcher.get_stats())
+await client_batcher.drain()                        # при завершении бота
+
+# Проверка с фейковой панелью (без 3x-ui): пачку принимает любая корутина
+async def fake_panel(inbound_id, clients):
+    await asyncio.sleep(0.05)   # один запрос на пачку
+
+batcher = ClientAddBatcher(window=0.05, submit=fake_panel)
+await asyncio.gather(*(batcher.add(1, client) for client in clients))
+
+# Замер: python -m services.bench_client_batcher
+
+# Настройки (.env):
+XUI_ADD_BATCH_WINDOW=0.05  # сек сбора пачки, 0 - каждый клиент отдельным запросом
+XUI_ADD_BATCH_MAX=50       # клиентов, при которых пачка уходит сразу
+'''
@@ -1,29 +1,97 @@
+import asyncio
 import asyncpg
 import logging
-from config import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+from contextlib import asynccontextmanager
+from typing import Optional, Dict
+from services.cache import TTLCache, MISSING
+from config import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, \
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_MAX_QUERIES, \
+    DB_POOL_MAX_INACTIVE_LIFETIME, DB_COMMAND_TIMEOUT, \
+    USER_CACHE_SIZE, USER_CACHE_TTL
 
 logger = logging.getLogger(__name__)
 
+# Общий пул соединений процесса (создается в init_database)
+_pool: Optional[asyncpg.Pool] = None
+_pool_lock = asyncio.Lock()
+
+# Read-through кэш строк пользователей (инвалидируется при каждой записи)
+user_cache = TTLCache("users", max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Read-through кэш подписок (те же настройки размера и TTL)
+subscription_cache = TTLCache("subscriptions", max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
 
 # 🔧 БАЗОВЫЕ ФУНКЦИИ ПОДКЛЮЧЕНИЯ
-async def get_connection():
-    """УНИВЕРСАЛЬНОЕ подключение к БД для любого проекта"""
-    return await asyncpg.connect(
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT,
-        database=DB_NAME
+async def get_pool() -> asyncpg.Pool:
+    """
+    УНИВЕРСАЛЬНЫЙ пул подключений к БД для любого проекта
+    Создается один раз на процесс, при первом обращении
+    """
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    database=DB_NAME,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    max_queries=DB_POOL_MAX_QUERIES,
+                    max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+                    command_timeout=DB_COMMAND_TIMEOUT
+                )
+                logger.info(f"✅ Пул соединений БД создан ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE})")
+    return _pool
+
+
+async def close_database():
+    """Закрывает пул соединений при остановке бота"""
+    global _pool
+    if _pool is None:
+        return
+    try:
+        await asyncio.wait_for(_pool.close(), timeout=10)
+        logger.info("✅ Пул соединений БД закрыт")
+    except Exception as e:
+        logger.error(f"❌ Ошибка закрытия пула БД: {e}")
+        _pool.terminate()
+    finally:
+        _pool = None
+
+
+# 🗄️ КЭШ ПОЛЬЗОВАТЕЛЕЙ
+async def _get_user_row(telegram_id: int):
+    """Строка пользователя из кэша или БД (ошибки БД пробрасываются наверх)"""
+    user = user_cache.get(telegram_id)
+    if user is not MISSING:
+        return user
+
+    generation = user_cache.generation
+    pool = await get_pool()
+    user = await pool.fetchrow(
+        'SELECT * FROM users WHERE telegram_id = $1',
+        telegram_id
     )
+    user_cache.set(telegram_id, user, generation=generation)
+    return user
+
+
+def get_user_cache_stats() -> Dict:
+    """Счетчики кэша пользователей (hit/miss/eviction)"""
+    return user_cache.get_stats()
 
 
 async def init_database():
     """УНИВЕРСАЛЬНАЯ инициализация БД для любого проекта"""
     try:
-        conn = await get_connection()
+        pool = await get_pool()
 
         # УНИВЕРСАЛЬНАЯ таблица пользователей для любого сервиса
-        await conn.execute('''
+        await pool.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 telegram_id BIGINT PRIMARY KEY,
                 username VARCHAR(100),           -- опционально
@@ -44,7 +112,129 @@ async def init_database():
             )
         ''')
 
-        await conn.close()
+        # Платежи: статус хранится в БД, а не в FSM - переживает рестарт
+        await pool.execute('''
+            CREATE TABLE IF NOT EXISTS payments (
+                id BIGSERIAL PRIMARY KEY,
+                provider VARCHAR(32) NOT NULL,
+                provider_payment_id VARCHAR(128) NOT NULL,
+                telegram_id BIGINT NOT NULL,
+                action VARCHAR(32) NOT NULL,
+                amount NUMERIC(12, 2) NOT NULL,
+                currency VARCHAR(8) DEFAULT 'RUB',
+                status VARCHAR(16) NOT NULL DEFAULT 'pending',  -- pending/paid/activating/activated/failed/expired
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                paid_at TIMESTAMP,
+                activated_at TIMESTAMP,
+                claimed_at TIMESTAMP,  -- начало активации (захват истекает через PAYMENT_ACTIVATION_TIMEOUT)
+                UNIQUE (provider, provider_payment_id)
+            )
+        ''')
+        # Таблица могла быть создана до появления claimed_at
+        await pool.execute('ALTER TABLE payments ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP')
+        await pool.execute(
+            'CREATE INDEX IF NOT EXISTS idx_payments_telegram_id ON payments(telegram_id)'
+        )
+        await pool.execute(
+            "CREATE INDEX IF NOT EXISTS idx_payments_pending ON payments(created_at) WHERE status = 'pending'"
+        )
+        await pool.execute(
+            "CREATE INDEX IF NOT EXISTS idx_payments_pending_id ON payments(id) WHERE status = 'pending'"
+        )
+
+        # Подписки: локальная копия клиентов панели - статус без запросов к 3x-ui
+        await pool.execute('''
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                telegram_id BIGINT PRIMARY KEY,
+                client_uuid VARCHAR(36) NOT NULL,
+                inbound_id INTEGER NOT NULL,
+                expiry_time BIGINT NOT NULL DEFAULT 0,   -- ms, 0 = без ограничения
+                enabled BOOLEAN NOT NULL DEFAULT TRUE,
+                total_gb BIGINT NOT NULL DEFAULT 0,      -- лимит трафика в байтах, 0 = без ограничения
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                synced_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP  -- когда данные последний раз сверены с панелью
+            )
+        ''')
+        await pool.execute(
+            'CREATE INDEX IF NOT EXISTS idx_subscriptions_expiry_time ON subscriptions(expiry_time)'
+        )
+
+        # Истекшие подписки для отключения (services.expiry_sweeper)
+        await pool.execute(
+            'CREATE INDEX IF NOT EXISTS idx_subscriptions_expired ON subscriptions(telegram_id, expiry_time) '
+            'WHERE enabled AND expiry_time > 0'
+        )
+        # Прогресс фоновых проходов - продолжение после падения
+        await pool.execute('''
+            CREATE TABLE IF NOT EXISTS sweep_state (
+                job VARCHAR(32) PRIMARY KEY,
+                cursor BIGINT NOT NULL DEFAULT 0,        -- последний обработанный telegram_id
+                processed INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+
+        # Отправленные напоминания об окончании подписки (защита от повторов)
+        await pool.execute('''
+            CREATE TABLE IF NOT EXISTS expiry_reminders (
+                telegram_id BIGINT NOT NULL,
+                expiry_time BIGINT NOT NULL,
+                offset_hours INTEGER NOT NULL,
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (telegram_id, expiry_time, offset_hours)
+            )
+        ''')
+
+        # Статистика трафика (services.traffic): последние счетчики панели + временной ряд приращений
+        await pool.execute('''
+            CREATE TABLE IF NOT EXISTS traffic_counters (
+                telegram_id BIGINT PRIMARY KEY,
+                up BIGINT NOT NULL DEFAULT 0,
+                down BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        await pool.execute('''
+            CREATE TABLE IF NOT EXISTS traffic_stats (
+                telegram_id BIGINT NOT NULL,
+                resolution VARCHAR(2) NOT NULL,          -- 5m / 1h / 1d
+                bucket TIMESTAMPTZ NOT NULL,             -- начало интервала (UTC)
+                up BIGINT NOT NULL DEFAULT 0,
+                down BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (telegram_id, resolution, bucket)
+            )
+        ''')
+        await pool.execute(
+            'CREATE INDEX IF NOT EXISTS idx_traffic_stats_retention ON traffic_stats(resolution, bucket)'
+        )
+
+        # Состояния FSM бота (services.fsm_storage.PostgresStorage)
+        await pool.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key VARCHAR(255) PRIMARY KEY,
+                state VARCHAR(255),
+                data JSONB NOT NULL DEFAULT '{}',
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        await pool.execute(
+            'CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at)'
+        )
+
+        # Готовые PNG QR-кодов по sha256 строки подключения (services.qr_cache, QR_CACHE_PERSIST)
+        await pool.execute('''
+            CREATE TABLE IF NOT EXISTS qr_codes (
+                digest BYTEA PRIMARY KEY,
+                png BYTEA NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
         logger.info("✅ Универсальная база данных инициализирована")
         return True
 
@@ -56,12 +246,12 @@ async def init_database():
 async def save_connection_string(telegram_id: int, connection_string: str):
     """Сохраняет connection_string пользователя"""
     try:
-        conn = await get_connection()
-        await conn.execute(
+        pool = await get_pool()
+        await pool.execute(
             'UPDATE users SET connection_string = $1, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = $2',
             connection_string, telegram_id
         )
-        await conn.close()
+        user_cache.invalidate(telegram_id)
         logger.info(f"✅ Connection_string сохранен для пользователя {telegram_id}")
         return True
     except Exception as e:
@@ -71,13 +261,8 @@ async def save_connection_string(telegram_id: int, connection_string: str):
 async def get_connection_string(telegram_id: int) -> str:
     """Получает connection_string пользователя"""
     try:
-        conn = await get_connection()
-        result = await conn.fetchval(
-            'SELECT connection_string FROM users WHERE telegram_id = $1',
-            telegram_id
-        )
-        await conn.close()
-        return result
+        user = await _get_user_row(telegram_id)
+        return user['connection_string'] if user else None
     except Exception as e:
         logger.error(f"❌ Ошибка получения connection_string: {e}")
         return None
@@ -88,7 +273,7 @@ async def save_user(telegram_id: int, username: str = None, display_name: str =
     УНИВЕРСАЛЬНОЕ сохранение пользователя для любого проекта
     """
     try:
-        conn = await get_connection()
+        pool = await get_pool()
 
         # Базовые поля + любые дополнительные
         all_fields = {
@@ -104,14 +289,15 @@ async def save_user(telegram_id: int, username: str = None, display_name: str =
         }
 
         # Фильтруем только переданные поля (кроме None, но trial_used может быть False)
+        # Непереданный trial_used не трогаем - иначе повторное сохранение сбросит использованный trial
         provided_fields = {}
         for k, v in all_fields.items():
-            if v is not None or k == 'trial_used':  # trial_used может быть False
+            if v is not None:
                 provided_fields[k] = v
 
         if not provided_fields:
             # Минимальное сохранение - только telegram_id
-            await conn.execute(
+            await pool.execute(
                 'INSERT INTO users (telegram_id) VALUES ($1) ON CONFLICT (telegram_id) DO NOTHING',
                 telegram_id
             )
@@ -132,9 +318,9 @@ async def save_user(telegram_id: int, username: str = None, display_name: str =
                 DO UPDATE SET {", ".join(update_parts)}
             '''
 
-            await conn.execute(query, *values)
+            await pool.execute(query, *values)
 
-        await conn.close()
+        user_cache.invalidate(telegram_id)
         logger.info(f"✅ Универсальный пользователь {telegram_id} сохранен")
         return True
 
@@ -146,13 +332,7 @@ async def save_user(telegram_id: int, username: str = None, display_name: str =
 async def get_user(telegram_id: int):
     """УНИВЕРСАЛЬНОЕ получение пользователя"""
     try:
-        conn = await get_connection()
-        user = await conn.fetchrow(
-            'SELECT * FROM users WHERE telegram_id = $1',
-            telegram_id
-        )
-        await conn.close()
-        return user
+        return await _get_user_row(telegram_id)
     except Exception as e:
         logger.error(f"❌ Ошибка получения пользователя: {e}")
         return None
@@ -167,12 +347,12 @@ async def user_exists(telegram_id: int):
 async def update_user_balance(telegram_id: int, amount: int):
     """УНИВЕРСАЛЬНОЕ обновление баланса (баллов)"""
     try:
-        conn = await get_connection()
-        await conn.execute(
+        pool = await get_pool()
+        await pool.execute(
             'UPDATE users SET balance = balance + $1, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = $2',
             amount, telegram_id
         )
-        await conn.close()
+        user_cache.invalidate(telegram_id)
         logger.info(f"✅ Баланс пользователя {telegram_id} обновлен на {amount}")
         return True
     except Exception as e:
@@ -183,12 +363,8 @@ async def update_user_balance(telegram_id: int, amount: int):
 async def get_trial_status(telegram_id: int) -> bool:
     """Проверяет, использовал ли пользователь trial"""
     try:
-        conn = await get_connection()
-        trial_used = await conn.fetchval(
-            'SELECT trial_used FROM users WHERE telegram_id = $1',
-            telegram_id
-        )
-        await conn.close()
+        user = await _get_user_row(telegram_id)
+        trial_used = user['trial_used'] if user else None
         return trial_used if trial_used is not None else False
     except Exception as e:
         logger.error(f"❌ Ошибка проверки trial статуса: {e}")
@@ -197,30 +373,72 @@ async def get_trial_status(telegram_id: int) -> bool:
 async def mark_trial_used(telegram_id: int):
     """Отмечает что пользователь использовал trial"""
     try:
-        conn = await get_connection()
-        await conn.execute(
+        pool = await get_pool()
+        await pool.execute(
             'UPDATE users SET trial_used = TRUE, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = $1',
             telegram_id
         )
-        await conn.close()
+        user_cache.invalidate(telegram_id)
         logger.info(f"✅ Trial отмечен как использованный для пользователя {telegram_id}")
         return True
     except Exception as e:
         logger.error(f"❌ Ошибка отметки trial: {e}")
         return False
 
+async def claim_trial(telegram_id: int, username: str = None) -> Optional[bool]:
+    """
+    Атомарно занимает trial одним запросом (создает пользователя при необходимости)
+    True - trial занят этим вызовом, False - уже использован, None - ошибка БД
+    """
+    try:
+        pool = await get_pool()
+        claimed = await pool.fetchval(
+            '''
+            INSERT INTO users (telegram_id, username, trial_used) VALUES ($1, $2, TRUE)
+            ON CONFLICT (telegram_id) DO UPDATE SET
+                trial_used = TRUE,
+                username = COALESCE(EXCLUDED.username, users.username),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE users.trial_used IS NOT TRUE
+            RETURNING TRUE
+            ''',
+            telegram_id, username
+        )
+        user_cache.invalidate(telegram_id)
+        return bool(claimed)
+    except Exception as e:
+        logger.error(f"❌ Ошибка захвата trial: {e}")
+        return None
+
+
+async def release_trial(telegram_id: int):
+    """Возвращает trial, если после claim_trial не удалось создать подписку"""
+    try:
+        pool = await get_pool()
+        await pool.execute(
+            'UPDATE users SET trial_used = FALSE, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = $1',
+            telegram_id
+        )
+        user_cache.invalidate(telegram_id)
+        logger.info(f"✅ Trial возвращен пользователю {telegram_id}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка возврата trial: {e}")
+        return False
+
+
 async def update_user_metadata(telegram_id: int, key: str, value):
     """
     УНИВЕРСАЛЬНОЕ обновление метаданных пользователя
     Используется для хранения любых дополнительных данных
     """
     try:
-        conn = await get_connection()
-        await conn.execute(
+        pool = await get_pool()
+        await pool.execute(
             'UPDATE users SET metadata = jsonb_set(COALESCE(metadata, \'{}\'), $1, $2), updated_at = CURRENT_TIMESTAMP WHERE telegram_id = $3',
             f'{{{key}}}', f'"{value}"', telegram_id
         )
-        await conn.close()
+        user_cache.invalidate(telegram_id)
         logger.info(f"✅ Метаданные пользователя {telegram_id} обновлены: {key} = {value}")
         return True
     except Exception as e:
@@ -231,25 +449,593 @@ async def update_user_metadata(telegram_id: int, key: str, value):
 async def get_user_balance(telegram_id: int):
     """ТОЧКА ВХОДА - получить баланс пользователя"""
     try:
-        conn = await get_connection()
-        balance = await conn.fetchval(
-            'SELECT balance FROM users WHERE telegram_id = $1',
-            telegram_id
-        )
-        await conn.close()
+        user = await _get_user_row(telegram_id)
+        balance = user['balance'] if user else None
         return balance or 0
     except Exception as e:
         logger.error(f"❌ Ошибка получения баланса: {e}")
         return 0
 
 
+# 💳 ФУНКЦИИ ДЛЯ РАБОТЫ С ПЛАТЕЖАМИ
+async def create_payment_record(provider: str, provider_payment_id: str, telegram_id: int,
+                                action: str, amount: float, currency: str = "RUB"):
+    """Сохраняет созданный платеж (повторное сохранение того же платежа игнорируется)"""
+    try:
+        pool = await get_pool()
+        await pool.execute(
+            '''
+            INSERT INTO payments (provider, provider_payment_id, telegram_id, action, amount, currency)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (provider, provider_payment_id) DO NOTHING
+            ''',
+            provider, str(provider_payment_id), telegram_id, action, amount, currency
+        )
+        logger.info(f"✅ Платеж {provider}:{provider_payment_id} сохранен для пользователя {telegram_id}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения платежа: {e}")
+        return False
+
+
+async def get_payment_record(provider: str, provider_payment_id: str):
+    """Получает платеж по id провайдера (один запрос по уникальному индексу)"""
+    try:
+        pool = await get_pool()
+        return await pool.fetchrow(
+            'SELECT * FROM payments WHERE provider = $1 AND provider_payment_id = $2',
+            provider, str(provider_payment_id)
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения платежа: {e}")
+        return None
+
+
+async def mark_payment_paid(provider: str, provider_payment_id: str) -> bool:
+    """
+    Переводит платеж pending/expired -> paid (вызывать только после подтверждения провайдером)
+    Истекший счет тоже принимается: оплата могла прийти после истечения
+    False - если платеж уже оплачен/активируется/активирован
+    """
+    try:
+        pool = await get_pool()
+        row = await pool.fetchrow(
+            '''
+            UPDATE payments SET status = 'paid', paid_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE provider = $1 AND provider_payment_id = $2 AND status IN ('pending', 'expired')
+            RETURNING id
+            ''',
+            provider, str(provider_payment_id)
+        )
+        return row is not None
+    except Exception as e:
+        logger.error(f"❌ Ошибка отметки оплаты: {e}")
+        return False
+
+
+async def claim_payment_activation(provider: str, provider_payment_id: str, provider_confirmed: bool = False,
+                                   lease_seconds: float = 600):
+    """
+    Атомарно забирает оплаченный платеж на активацию (paid/failed -> activating)
+    provider_confirmed=True - провайдер только что подтвердил оплату: забирается и истекший счет
+    activating дольше lease_seconds - активация прервана (падение/рестарт), платеж забирается заново
+    Возвращает строку платежа только ОДНОМУ вызывающему, остальным - None
+    """
+    statuses = ['paid', 'failed', 'expired'] if provider_confirmed else ['paid', 'failed']
+    try:
+        pool = await get_pool()
+        return await pool.fetchrow(
+            '''
+            UPDATE payments
+            SET status = 'activating', claimed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE provider = $1 AND provider_payment_id = $2
+              AND (status = ANY($3::varchar[])
+                   OR (status = 'activating' AND claimed_at < CURRENT_TIMESTAMP - make_interval(secs => $4)))
+            RETURNING *
+            ''',
+            provider, str(provider_payment_id), statuses, lease_seconds
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка захвата платежа на активацию: {e}")
+        return None
+
+
+async def get_stuck_activations(lease_seconds: float, limit: int = 100):
+    """Платежи, зависшие в activating дольше lease_seconds (активацию прервал рестарт)"""
+    try:
+        pool = await get_pool()
+        return await pool.fetch(
+            '''
+            SELECT provider, provider_payment_id, telegram_id
+            FROM payments
+            WHERE status = 'activating' AND claimed_at < CURRENT_TIMESTAMP - make_interval(secs => $1)
+            ORDER BY claimed_at
+            LIMIT $2
+            ''',
+            lease_seconds, limit
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения зависших активаций: {e}")
+        return []
+
+
+async def finish_payment_activation(provider: str, provider_payment_id: str, success: bool):
+    """Завершает активацию: activating -> activated (или failed для повторной попытки)"""
+    try:
+        pool = await get_pool()
+        await pool.execute(
+            '''
+            UPDATE payments
+            SET status = $3::varchar,
+                activated_at = CASE WHEN $3::varchar = 'activated' THEN CURRENT_TIMESTAMP END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE provider = $1 AND provider_payment_id = $2 AND status = 'activating'
+            ''',
+            provider, str(provider_payment_id), 'activated' if success else 'failed'
+        )
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка завершения активации платежа: {e}")
+        return False
+
+
+async def get_pending_payments(after_id: int = 0, limit: int = 500):
+    """
+    Страница неподтвержденных платежей (keyset по id) с возрастом в секундах
+    after_id - id последнего платежа предыдущей страницы
+    """
+    try:
+        pool = await get_pool()
+        return await pool.fetch(
+            '''
+            SELECT id, provider, provider_payment_id, telegram_id, action,
+                   EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - created_at))::float AS age
+            FROM payments
+            WHERE status = 'pending' AND id > $1
+            ORDER BY id
+            LIMIT $2
+            ''',
+            after_id, limit
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения неподтвержденных платежей: {e}")
+        return []
+
+
+async def get_stale_pending_payments(max_age_seconds: float, limit: int = 500):
+    """Кандидаты на истечение: pending старше max_age_seconds (перед истечением их проверяет провайдер)"""
+    try:
+        pool = await get_pool()
+        return await pool.fetch(
+            '''
+            SELECT id, provider, provider_payment_id, telegram_id
+            FROM payments
+            WHERE status = 'pending' AND created_at < CURRENT_TIMESTAMP - make_interval(secs => $1)
+            ORDER BY created_at
+            LIMIT $2
+            ''',
+            max_age_seconds, limit
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения брошенных счетов: {e}")
+        return []
+
+
+async def expire_payment(provider: str, provider_payment_id: str) -> bool:
+    """Помечает брошенный счет истекшим (pending -> expired). False - если статус уже изменился"""
+    try:
+        pool = await get_pool()
+        row = await pool.fetchrow(
+            '''
+            UPDATE payments SET status = 'expired', updated_at = CURRENT_TIMESTAMP
+            WHERE provider = $1 AND provider_payment_id = $2 AND status = 'pending'
+            RETURNING id
+            ''',
+            provider, str(provider_payment_id)
+        )
+        return row is not None
+    except Exception as e:
+        logger.error(f"❌ Ошибка истечения платежа: {e}")
+        return False
+
+
+# 📦 ФУНКЦИИ ДЛЯ РАБОТЫ С ПОДПИСКАМИ
+async def save_subscription(telegram_id: int, client_uuid: str, inbound_id: int,
+                            expiry_time: int, total_gb: int, enabled: bool = True):
+    """Сохраняет подписку после создания/продления или сверки с панелью"""
+    try:
+        pool = await get_pool()
+        await pool.execute(
+            '''
+            INSERT INTO subscriptions (telegram_id, client_uuid, inbound_id, expiry_time, enabled, total_gb, synced_at)
+            VALUES ($1, $2, $3, $4, $5, $6, CURRENT_TIMESTAMP)
+            ON CONFLICT (telegram_id) DO UPDATE SET
+                client_uuid = EXCLUDED.client_uuid,
+                inbound_id = EXCLUDED.inbound_id,
+                expiry_time = EXCLUDED.expiry_time,
+                enabled = EXCLUDED.enabled,
+                total_gb = EXCLUDED.total_gb,
+                updated_at = CURRENT_TIMESTAMP,
+                synced_at = CURRENT_TIMESTAMP
+            ''',
+            telegram_id, client_uuid, inbound_id, expiry_time, enabled, total_gb
+        )
+        subscription_cache.invalidate(telegram_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения подписки {telegram_id}: {e}")
+        return False
+
+
+async def get_subscription(telegram_id: int):
+    """Подписка пользователя из кэша или БД (None если подписки нет)"""
+    try:
+        subscription = subscription_cache.get(telegram_id)
+        if subscription is not MISSING:
+            return subscription
+
+        generation = subscription_cache.generation
+        pool = await get_pool()
+        subscription = await pool.fetchrow(
+            'SELECT * FROM subscriptions WHERE telegram_id = $1',
+            telegram_id
+        )
+        subscription_cache.set(telegram_id, subscription, generation=generation)
+        return subscription
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения подписки {telegram_id}: {e}")
+        return None
+
+
+async def get_db_timestamp():
+    """Текущее время сервера БД (в том же виде, что и updated_at)"""
+    pool = await get_pool()
+    return await pool.fetchval('SELECT LOCALTIMESTAMP')
+
+
+async def get_inbound_subscriptions(inbound_id: int):
+    """Все подписки инбаунда одним запросом (для сверки с панелью)"""
+    pool = await get_pool()
+    return await pool.fetch(
+        'SELECT * FROM subscriptions WHERE inbound_id = $1',
+        inbound_id
+    )
+
+
+async def apply_subscription_sync(upserts, unchanged_ids, missing_ids, connection_strings, started_at):
+    """
+    Применяет результат сверки с панелью одной транзакцией
+    upserts            - [(telegram_id, client_uuid, inbound_id, expiry_time, enabled, total_gb)]
+    unchanged_ids      - подписки без изменений (только отметка synced_at)
+    missing_ids        - подписки, клиентов которых нет на панели (отключаются)
+    connection_strings - [(telegram_id, connection_string, client_uuid)] при смене UUID
+    started_at         - начало сверки (get_db_timestamp): строки, измененные позже, не трогаются
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if upserts:
+                await conn.executemany(
+                    '''
+                    INSERT INTO subscriptions (telegram_id, client_uuid, inbound_id, expiry_time, enabled, total_gb, synced_at)
+                    VALUES ($1, $2, $3, $4, $5, $6, CURRENT_TIMESTAMP)
+                    ON CONFLICT (telegram_id) DO UPDATE SET
+                        client_uuid = EXCLUDED.client_uuid,
+                        inbound_id = EXCLUDED.inbound_id,
+                        expiry_time = EXCLUDED.expiry_time,
+                        enabled = EXCLUDED.enabled,
+                        total_gb = EXCLUDED.total_gb,
+                        updated_at = CURRENT_TIMESTAMP,
+                        synced_at = CURRENT_TIMESTAMP
+                    WHERE subscriptions.updated_at < $7
+                    ''',
+                    [values + (started_at,) for values in upserts]
+                )
+            if unchanged_ids:
+                await conn.execute(
+                    '''
+                    UPDATE subscriptions SET synced_at = CURRENT_TIMESTAMP
+                    WHERE telegram_id = ANY($1::bigint[]) AND updated_at < $2
+                    ''',
+                    unchanged_ids, started_at
+                )
+            if missing_ids:
+                await conn.execute(
+                    '''
+                    UPDATE subscriptions SET enabled = FALSE, updated_at = CURRENT_TIMESTAMP, synced_at = CURRENT_TIMESTAMP
+                    WHERE telegram_id = ANY($1::bigint[]) AND updated_at < $2
+                    ''',
+                    missing_ids, started_at
+                )
+            if connection_strings:
+                # Строка меняется, только если подписка теперь указывает на тот же UUID
+                await conn.executemany(
+                    '''
+                    UPDATE users SET connection_string = $2, updated_at = CURRENT_TIMESTAMP
+                    WHERE telegram_id = $1
+                      AND EXISTS (SELECT 1 FROM subscriptions WHERE telegram_id = $1 AND client_uuid = $3)
+                    ''',
+                    connection_strings
+                )
+
+    subscription_cache.clear()
+    if connection_strings:
+        user_cache.clear()
+
+
+async def get_expired_subscriptions(inbound_id: int, now_ms: int, after_telegram_id: int, limit: int):
+    """Следующая пачка истекших включенных подписок (по частичному индексу, по возрастанию telegram_id)"""
+    pool = await get_pool()
+    return await pool.fetch(
+        '''
+        SELECT telegram_id, client_uuid, expiry_time FROM subscriptions
+        WHERE enabled AND expiry_time > 0 AND expiry_time < $2
+          AND inbound_id = $1 AND telegram_id > $3
+        ORDER BY telegram_id
+        LIMIT $4
+        ''',
+        inbound_id, now_ms, after_telegram_id, limit
+    )
+
+
+async def mark_subscription_missing(telegram_id: int, client_uuid: str):
+    """
+    Клиента нет на панели - подписка отключается и отмечается сверенной
+    Только если в ней все тот же UUID (клиент, созданный заново за это время, не трогается)
+    """
+    pool = await get_pool()
+    row = await pool.fetchrow(
+        '''
+        UPDATE subscriptions SET enabled = FALSE, updated_at = CURRENT_TIMESTAMP, synced_at = CURRENT_TIMESTAMP
+        WHERE telegram_id = $1 AND client_uuid = $2
+        RETURNING *
+        ''',
+        telegram_id, client_uuid
+    )
+    subscription_cache.invalidate(telegram_id)
+    return row
+
+
+async def is_subscription_expired(telegram_id: int, now_ms: int) -> bool:
+    """Истек ли срок подписки прямо сейчас (без кэша - перед отключением клиента на панели)"""
+    pool = await get_pool()
+    expiry_time = await pool.fetchval('SELECT expiry_time FROM subscriptions WHERE telegram_id = $1', telegram_id)
+    return bool(expiry_time) and expiry_time < now_ms
+
+
+async def disable_subscriptions(telegram_ids, now_ms: int):
+    """
+    Отмечает подписки отключенными одним запросом
+    Только если срок все еще истек на now_ms - продленная за это время подписка не трогается
+    """
+    if not telegram_ids:
+        return
+    pool = await get_pool()
+    await pool.execute(
+        '''
+        UPDATE subscriptions SET enabled = FALSE, updated_at = CURRENT_TIMESTAMP, synced_at = CURRENT_TIMESTAMP
+        WHERE telegram_id = ANY($1::bigint[]) AND expiry_time > 0 AND expiry_time < $2
+        ''',
+        telegram_ids, now_ms
+    )
+    for telegram_id in telegram_ids:
+        subscription_cache.invalidate(telegram_id)
+
+
+async def get_sweep_state(job: str):
+    """Состояние прохода (None если проход ни разу не запускался)"""
+    pool = await get_pool()
+    return await pool.fetchrow('SELECT * FROM sweep_state WHERE job = $1', job)
+
+
+async def start_sweep(job: str):
+    """Начинает новый проход с начала"""
+    pool = await get_pool()
+    await pool.execute(
+        '''
+        INSERT INTO sweep_state (job) VALUES ($1)
+        ON CONFLICT (job) DO UPDATE SET
+            cursor = 0, processed = 0, failed = 0,
+            started_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP, finished_at = NULL
+        ''',
+        job
+    )
+
+
+async def save_sweep_progress(job: str, cursor: int, processed: int, failed: int, finished: bool = False):
+    """Сохраняет прогресс после каждой пачки"""
+    pool = await get_pool()
+    await pool.execute(
+        '''
+        UPDATE sweep_state SET cursor = $2, processed = $3, failed = $4, updated_at = CURRENT_TIMESTAMP,
+            finished_at = CASE WHEN $5 THEN CURRENT_TIMESTAMP ELSE NULL END
+        WHERE job = $1
+        ''',
+        job, cursor, processed, failed, finished
+    )
+
+
+async def iter_upcoming_expiries(from_ms: int, to_ms: int):
+    """Потоково отдает (telegram_id, expiry_time) подписок, истекающих в интервале (по индексу expiry_time)"""
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            async for row in conn.cursor(
+                '''
+                SELECT telegram_id, expiry_time FROM subscriptions
+                WHERE expiry_time > $1 AND expiry_time <= $2 AND enabled
+                ''',
+                from_ms, to_ms, prefetch=1000
+            ):
+                yield row['telegram_id'], row['expiry_time']
+
+
+async def claim_expiry_reminder(telegram_id: int, expiry_time: int, offset_hours: int) -> bool:
+    """Отмечает напоминание отправленным. False - уже отправлено (другим процессом или до рестарта)"""
+    try:
+        pool = await get_pool()
+        claimed = await pool.fetchval(
+            '''
+            INSERT INTO expiry_reminders (telegram_id, expiry_time, offset_hours) VALUES ($1, $2, $3)
+            ON CONFLICT DO NOTHING
+            RETURNING TRUE
+            ''',
+            telegram_id, expiry_time, offset_hours
+        )
+        return bool(claimed)
+    except Exception as e:
+        logger.error(f"❌ Ошибка отметки напоминания {telegram_id}: {e}")
+        return False
+
+
+async def release_expiry_reminder(telegram_id: int, expiry_time: int, offset_hours: int):
+    """Снимает отметку напоминания, которое не удалось отправить"""
+    try:
+        pool = await get_pool()
+        await pool.execute(
+            'DELETE FROM expiry_reminders WHERE telegram_id = $1 AND expiry_time = $2 AND offset_hours = $3',
+            telegram_id, expiry_time, offset_hours
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка снятия отметки напоминания {telegram_id}: {e}")
+
+
+async def purge_expiry_reminders(before_ms: int):
+    """Удаляет отметки о напоминаниях для давно истекших подписок"""
+    pool = await get_pool()
+    await pool.execute('DELETE FROM expiry_reminders WHERE expiry_time < $1', before_ms)
+
+
+# 🔒 БЛОКИРОВКИ МЕЖДУ ПРОЦЕССАМИ
+@asynccontextmanager
+async def advisory_lock(key: int):
+    """
+    pg_try_advisory_lock на время блока (соединение держится, пока блок не завершится)
+    Отдает True, если блокировка взята, False - ее держит другой процесс
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        locked = await conn.fetchval('SELECT pg_try_advisory_lock($1)', key)
+        try:
+            yield locked
+        finally:
+            if locked:
+                await conn.execute('SELECT pg_advisory_unlock($1)', key)
+
+
+# 📈 ФУНКЦИИ ДЛЯ РАБОТЫ СО СТАТИСТИКОЙ ТРАФИКА
+async def get_traffic_counters() -> Dict[int, tuple]:
+    """Последние счетчики панели {telegram_id: (up, down)} - база для расчета приращений"""
+    pool = await get_pool()
+    rows = await pool.fetch('SELECT telegram_id, up, down FROM traffic_counters')
+    return {row['telegram_id']: (row['up'], row['down']) for row in rows}
+
+
+async def save_traffic_deltas(deltas, counters, buckets: Dict[str, object]):
+    """
+    Сохраняет сбор трафика одной транзакцией
+    deltas   - [(telegram_id, up, down)] приращения за интервал
+    counters - [(telegram_id, up, down)] новые значения счетчиков панели
+    buckets  - {"5m": datetime, "1h": datetime, "1d": datetime} текущие интервалы
+    Приращение сразу добавляется во все три разрешения (свертка без отдельной задачи)
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if counters:
+                await conn.executemany(
+                    '''
+                    INSERT INTO traffic_counters (telegram_id, up, down, updated_at)
+                    VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
+                    ON CONFLICT (telegram_id) DO UPDATE SET
+                        up = EXCLUDED.up, down = EXCLUDED.down, updated_at = CURRENT_TIMESTAMP
+                    ''',
+                    counters
+                )
+            if deltas:
+                telegram_ids, ups, downs = (list(column) for column in zip(*deltas))
+                await conn.execute(
+                    '''
+                    INSERT INTO traffic_stats (telegram_id, resolution, bucket, up, down)
+                    SELECT t.telegram_id, r.resolution, r.bucket, t.up, t.down
+                    FROM unnest($1::bigint[], $2::bigint[], $3::bigint[]) AS t(telegram_id, up, down)
+                    CROSS JOIN (VALUES ('5m', $4::timestamptz), ('1h', $5::timestamptz), ('1d', $6::timestamptz))
+                        AS r(resolution, bucket)
+                    ON CONFLICT (telegram_id, resolution, bucket) DO UPDATE SET
+                        up = traffic_stats.up + EXCLUDED.up,
+                        down = traffic_stats.down + EXCLUDED.down
+                    ''',
+                    telegram_ids, ups, downs, buckets["5m"], buckets["1h"], buckets["1d"]
+                )
+
+
+async def purge_traffic_stats(retention_days: Dict[str, int]) -> int:
+    """Удаляет точки старше срока хранения своего разрешения"""
+    pool = await get_pool()
+    deleted = 0
+    for resolution, days in retention_days.items():
+        result = await pool.execute(
+            '''
+            DELETE FROM traffic_stats
+            WHERE resolution = $1 AND bucket < CURRENT_TIMESTAMP - make_interval(days => $2)
+            ''',
+            resolution, days
+        )
+        deleted += int(result.split()[-1])
+    return deleted
+
+
+async def get_traffic_usage(telegram_id: int, since_day, today):
+    """
+    Трафик пользователя одним запросом по первичному ключу (суточные точки)
+    Возвращает (байт за сегодня, байт с since_day)
+    """
+    try:
+        pool = await get_pool()
+        row = await pool.fetchrow(
+            '''
+            SELECT COALESCE(SUM(up + down) FILTER (WHERE bucket >= $3), 0) AS today,
+                   COALESCE(SUM(up + down), 0) AS total
+            FROM traffic_stats
+            WHERE telegram_id = $1 AND resolution = '1d' AND bucket >= $2
+            ''',
+            telegram_id, since_day, today
+        )
+        return row['today'], row['total']
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения трафика {telegram_id}: {e}")
+        return None
+
+
+# 🔳 ФУНКЦИИ ДЛЯ РАБОТЫ С QR-КОДАМИ
+async def get_qr_code(digest: bytes) -> Optional[bytes]:
+    """PNG QR-кода по sha256 строки подключения"""
+    try:
+        pool = await get_pool()
+        return await pool.fetchval('SELECT png FROM qr_codes WHERE digest = $1', digest)
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения QR-кода: {e}")
+        return None
+
+
+async def save_qr_code(digest: bytes, png: bytes):
+    """Сохраняет PNG QR-кода (строка подключения та же - PNG тот же, повтор игнорируется)"""
+    try:
+        pool = await get_pool()
+        await pool.execute(
+            'INSERT INTO qr_codes (digest, png) VALUES ($1, $2) ON CONFLICT (digest) DO NOTHING',
+            digest, png
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения QR-кода: {e}")
+
+
 # 📊 ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ
 async def get_all_users():
     """ТОЧКА ВХОДА - получить всех пользователей"""
     try:
-        conn = await get_connection()
-        users = await conn.fetch('SELECT * FROM users')
-        await conn.close()
+        pool = await get_pool()
+        users = await pool.fetch('SELECT * FROM users')
         return users
     except Exception as e:
         logger.error(f"❌ Ошибка получения всех пользователей: {e}")
@@ -259,9 +1045,8 @@ async def get_all_users():
 async def get_users_count():
     """ТОЧКА ВХОДА - получить количество пользователей"""
     try:
-        conn = await get_connection()
-        count = await conn.fetchval('SELECT COUNT(*) FROM users')
-        await conn.close()
+        pool = await get_pool()
+        count = await pool.fetchval('SELECT COUNT(*) FROM users')
         return count
     except Exception as e:
         logger.error(f"❌ Ошибка получения количества пользователей: {e}")
@@ -0,0 +1,239 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from services.database import iter_upcoming_expiries, claim_expiry_reminder, release_expiry_reminder, \
+    purge_expiry_reminders
+from config import EXPIRY_REMINDER_HOURS, EXPIRY_RELOAD_INTERVAL, EXPIRY_REMINDER_RATE
+
+logger = logging.getLogger(__name__)
+
+HOUR_MS = 3600 * 1000
+
+# Запись кучи: (когда отправить ms, telegram_id, expiry_time ms, за сколько часов)
+Reminder = Tuple[int, int, int, int]
+
+
+def now_ms() -> int:
+    return int(datetime.now().timestamp() * 1000)
+
+
+class ExpiryNotifier:
+    """
+    НАПОМИНАНИЯ ОБ ОКОНЧАНИИ ПОДПИСКИ
+    • Ближайшие окончания загружаются из БД одним потоковым запросом
+    • Напоминания лежат в min-куче по времени отправки - одна задача спит до ближайшего
+    • create/renew обновляют срок через schedule() без опроса БД
+    • Отправка отмечается в БД - повторов нет ни после рестарта, ни при нескольких процессах
+    """
+
+    def __init__(self, offsets_hours: List[int], reload_interval: float = 21600, rate: float = 20):
+        self.offsets_hours = sorted(set(offsets_hours), reverse=True)
+        self.reload_interval = reload_interval
+        self.send_interval = 1.0 / rate if rate > 0 else 0.0
+
+        self._heap: List[Reminder] = []
+        # Актуальный срок по пользователю - записи кучи со старым сроком пропускаются
+        self._expiry: Dict[int, int] = {}
+        # Изменения, пришедшие во время загрузки из БД
+        self._changed_during_load: Optional[Dict[int, int]] = None
+        self._wakeup = asyncio.Event()
+        self._send: Optional[Callable[[int, int, int], Awaitable[Any]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+        # Счетчики
+        self.loads = 0
+        self.last_load_ms = 0
+        self.sent = 0
+        self.stale = 0
+        self.duplicates = 0
+        self.errors = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, send: Callable[[int, int, int], Awaitable[Any]]):
+        """
+        Запуск планировщика
+        send(telegram_id, offset_hours, expiry_time) - отправка напоминания пользователю
+        """
+        if self.running:
+            return
+        if not self.offsets_hours:
+            logger.warning("⚠️ EXPIRY_REMINDER_HOURS пуст - напоминания об окончании подписки не запущены")
+            return
+        self._send = send
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"✅ Напоминания об окончании подписки запущены (за {self.offsets_hours} ч)")
+
+    async def stop(self):
+        """Остановка при завершении бота"""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    # =============================================
+    # 📅 ПЛАНИРОВАНИЕ
+    # =============================================
+
+    def _push(self, telegram_id: int, expiry_time: int, current_ms: int):
+        for offset in self.offsets_hours:
+            fire_at = expiry_time - offset * HOUR_MS
+            # Прошедшие сроки не догоняем: сработает следующее напоминание
+            if fire_at > current_ms:
+                heapq.heappush(self._heap, (fire_at, telegram_id, expiry_time, offset))
+
+    def schedule(self, telegram_id: int, expiry_time: int):
+        """Новый срок подписки (после create/renew) - O(log n), без запросов к БД"""
+        if not self.running:
+            # Напоминания выключены - куча не должна расти
+            return
+        if self._changed_during_load is not None:
+            self._changed_during_load[telegram_id] = expiry_time
+
+        if not expiry_time:
+            # Бессрочная подписка - напоминать не о чем
+            self._expiry.pop(telegram_id, None)
+            return
+        if self._expiry.get(telegram_id) == expiry_time:
+            return
+
+        head = self._heap[0][0] if self._heap else None
+        self._expiry[telegram_id] = expiry_time
+        self._push(telegram_id, expiry_time, now_ms())
+        if self._heap and self._heap[0][0] != head:
+            self._wakeup.set()
+
+    async def load(self):
+        """Полная загрузка ближайших окончаний из БД одним потоковым запросом"""
+        started = time.monotonic()
+        current_ms = now_ms()
+        horizon_ms = current_ms + max(self.offsets_hours, default=0) * HOUR_MS + int(self.reload_interval * 1000)
+
+        expiry: Dict[int, int] = {}
+        self._changed_during_load = {}
+        try:
+            async for telegram_id, expiry_time in iter_upcoming_expiries(current_ms, horizon_ms):
+                expiry[telegram_id] = expiry_time
+            for telegram_id, expiry_time in self._changed_during_load.items():
+                if expiry_time:
+                    expiry[telegram_id] = expiry_time
+                else:
+                    expiry.pop(telegram_id, None)
+        finally:
+            self._changed_during_load = None
+
+        self._expiry = expiry
+        self._heap = []
+        for telegram_id, expiry_time in expiry.items():
+            self._push(telegram_id, expiry_time, current_ms)
+        self._wakeup.set()
+
+        await purge_expiry_reminders(current_ms - 30 * 24 * HOUR_MS)
+
+        self.loads += 1
+        self.last_load_ms = int((time.monotonic() - started) * 1000)
+        logger.info(
+            f"✅ Загружено окончаний подписок: {len(expiry)}, напоминаний в очереди: {len(self._heap)} "
+            f"({self.last_load_ms} мс)"
+        )
+
+    # =============================================
+    # ⏰ ОТПРАВКА
+    # =============================================
+
+    async def _run(self):
+        next_load = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_load:
+                    next_load = time.monotonic() + self.reload_interval
+                    await self.load()
+
+                self._wakeup.clear()
+                await self._send_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"❌ Ошибка планировщика напоминаний: {e}")
+
+            timeout = next_load - time.monotonic()
+            if self._heap:
+                timeout = min(timeout, (self._heap[0][0] - now_ms()) / 1000)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_due(self):
+        while self._heap and self._heap[0][0] <= now_ms():
+            _, telegram_id, expiry_time, offset = heapq.heappop(self._heap)
+
+            if self._expiry.get(telegram_id) != expiry_time:
+                # Подписку продлили после постановки напоминания
+                self.stale += 1
+                continue
+            if not await claim_expiry_reminder(telegram_id, expiry_time, offset):
+                self.duplicates += 1
+                continue
+
+            try:
+                await self._send(telegram_id, offset, expiry_time)
+                self.sent += 1
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"⚠️ Напоминание {telegram_id} не отправлено: {e}")
+                # Отметка только для отправленных - иначе напоминание считалось бы доставленным
+                await release_expiry_reminder(telegram_id, expiry_time, offset)
+            await asyncio.sleep(self.send_interval)
+
+    def get_stats(self) -> Dict:
+        """Счетчики планировщика"""
+        return {
+            "tracked": len(self._expiry),
+            "queued": len(self._heap),
+            "next_in_s": max(0, (self._heap[0][0] - now_ms()) // 1000) if self._heap else None,
+            "loads": self.loads,
+            "last_load_ms": self.last_load_ms,
+            "sent": self.sent,
+            "stale": self.stale,
+            "duplicates": self.duplicates,
+            "errors": self.errors
+        }
+
+
+# Глобальный экземпляр
+expiry_notifier = ExpiryNotifier(
+    EXPIRY_REMINDER_HOURS,
+    reload_interval=EXPIRY_RELOAD_INTERVAL,
+    rate=EXPIRY_REMINDER_RATE
+)
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.expiry_notifier import expiry_notifier
+
+async def send(telegram_id, offset_hours, expiry_time):
+    await bot.send_message(telegram_id, f"Подписка закончится через {offset_hours} ч")
+
+expiry_notifier.start(send)
+expiry_notifier.schedule(123456, expiry_time_ms)   # после создания/продления
+print(expiry_notifier.get_stats())
+
+# Настройки (.env):
+EXPIRY_REMINDERS_ENABLED=true
+EXPIRY_REMINDER_HOURS=72,24,2     # за сколько часов до окончания напоминать
+EXPIRY_RELOAD_INTERVAL=21600      # сек между полными загрузками из БД
+EXPIRY_REMINDER_RATE=20           # сообщений в секунду
+'''
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from services.database import get_expired_subscriptions, disable_subscriptions, is_subscription_expired, \
+    get_sweep_state, start_sweep, save_sweep_progress
+from services.inbound_cache import inbound_cache
+from services.rate_limit import RateLimiter
+from services.vpn_service import api_connect, disable_client, delete_client
+from config import INBOUND_ID, SWEEP_INTERVAL, SWEEP_ACTION, SWEEP_BATCH, SWEEP_CONCURRENCY, SWEEP_RATE
+
+logger = logging.getLogger(__name__)
+
+SWEEP_JOB = "expired_clients"
+
+
+class ExpirySweeper:
+    """
+    ОТКЛЮЧЕНИЕ ИСТЕКШИХ КЛИЕНТОВ НА ПАНЕЛИ
+    • Истекшие подписки выбираются пачками по частичному индексу
+    • Запросы к панели - с ограничением параллельности и частоты
+    • Прогресс (последний telegram_id) сохраняется после каждой пачки - после падения проход продолжается
+    • Один снимок инбаунда на проход: UUID и срок клиентов берутся из него, к панели - только изменения
+    • Продленные не отключаются: срок проверяется по снимку и по БД прямо перед изменением
+    action - "disable" (отключить) или "delete" (удалить клиента)
+    """
+
+    def __init__(self, inbound_id: int, interval: float = 3600, action: str = "disable",
+                 batch_size: int = 200, concurrency: int = 4, rate: float = 10):
+        self.inbound_id = inbound_id
+        self.interval = interval
+        self.action = action
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate, concurrency)
+        self._task: Optional[asyncio.Task] = None
+
+        # Счетчики
+        self.runs = 0
+        self.swept = 0
+        self.failed = 0
+        self.renewed = 0
+        self.errors = 0
+        self.last_duration = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Запуск в фоне (первый проход сразу - дозавершает прерванный)"""
+        if self.running:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"✅ Отключение истекших клиентов запущено (каждые {self.interval:.0f}с, {self.action})")
+
+    async def stop(self):
+        """Остановка при завершении бота (прогресс уже сохранен)"""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"❌ Ошибка отключения истекших клиентов: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def _sweep_client(self, api, snapshot, subscription, now_ms: int) -> Optional[bool]:
+        """
+        Отключает/удаляет одного клиента
+        True - подписку можно отметить отключенной, False - ошибка, None - клиента продлили, не трогаем
+        """
+        client = snapshot.get_client(str(subscription['telegram_id']))
+        if client is None or (self.action == "disable" and not client.enable):
+            # Клиента уже нет или он уже отключен - нужно только обновить БД
+            return True
+
+        if not client.expiry_time or client.expiry_time >= now_ms:
+            # На панели срок уже продлен, БД отстает
+            self.renewed += 1
+            return None
+
+        async with self.limiter.semaphore:
+            await self.limiter.wait()
+            try:
+                # Пользователь мог продлить подписку, пока клиент ждал своей очереди
+                if not await is_subscription_expired(subscription['telegram_id'], now_ms):
+                    self.renewed += 1
+                    return None
+
+                if self.action == "delete":
+                    await delete_client(api, client)
+                else:
+                    await disable_client(api, client, client.expiry_time)
+                return True
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось отключить клиента {client.email}: {e}")
+                return False
+
+    async def sweep(self) -> int:
+        """Один проход (или продолжение прерванного), возвращает число отключенных подписок"""
+        started = time.monotonic()
+
+        state = await get_sweep_state(SWEEP_JOB)
+        if state is None or state['finished_at'] is not None:
+            await start_sweep(SWEEP_JOB)
+            cursor, processed, failed = 0, 0, 0
+        else:
+            cursor, processed, failed = state['cursor'], state['processed'], state['failed']
+            logger.info(f"🔄 Продолжаем прерванный проход с telegram_id > {cursor} (обработано {processed})")
+
+        api = await api_connect()
+        if not api:
+            raise RuntimeError("API панели недоступен")
+
+        # Один свежий снимок на весь проход - не по скачиванию инбаунда на пачку
+        snapshot = await inbound_cache.get(self.inbound_id, force=True)
+
+        swept = 0
+        try:
+            while True:
+                now_ms = int(time.time() * 1000)
+                batch = await get_expired_subscriptions(self.inbound_id, now_ms, cursor, self.batch_size)
+                if not batch:
+                    break
+
+                results = await asyncio.gather(*(
+                    self._sweep_client(api, snapshot, subscription, now_ms) for subscription in batch
+                ))
+                done = [s['telegram_id'] for s, ok in zip(batch, results) if ok]
+                await disable_subscriptions(done, now_ms)
+
+                # Неудачные не повторяем в этом проходе - курсор идет дальше, следующий проход их подберет
+                cursor = batch[-1]['telegram_id']
+                processed += len(done)
+                failed += sum(1 for ok in results if ok is False)
+                swept += len(done)
+                await save_sweep_progress(SWEEP_JOB, cursor, processed, failed)
+
+            await save_sweep_progress(SWEEP_JOB, cursor, processed, failed, finished=True)
+        finally:
+            if swept:
+                inbound_cache.invalidate(self.inbound_id)
+
+        self.runs += 1
+        self.swept += swept
+        self.failed = failed
+        self.last_duration = time.monotonic() - started
+        logger.info(
+            f"✅ Проход отключения завершен: {processed} отключено, {failed} ошибок, "
+            f"{self.last_duration:.1f}с"
+        )
+        return swept
+
+    def get_stats(self) -> Dict:
+        """Счетчики прохода"""
+        return {
+            "runs": self.runs,
+            "swept": self.swept,
+            "last_failed": self.failed,
+            "renewed": self.renewed,
+            "errors": self.errors,
+            "last_duration_ms": int(self.last_duration * 1000)
+        }
+
+
+# Глобальный экземпляр
+expiry_sweeper = ExpirySweeper(
+    INBOUND_ID,
+    interval=SWEEP_INTERVAL,
+    action=SWEEP_ACTION,
+    batch_size=SWEEP_BATCH,
+    concurrency=SWEEP_CONCURRENCY,
+    rate=SWEEP_RATE
+)
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.expiry_sweeper import expiry_sweeper
+
+expiry_sweeper.start()                  # проход каждые SWEEP_INTERVAL секунд
+swept = await expiry_sweeper.sweep()    # разовый проход
+print(expiry_sweeper.get_stats())
+
+# Прогресс: SELECT * FROM sweep_state WHERE job = 'expired_clients';
+# finished_at IS NULL - проход прерван и продолжится со следующего запуска
+'''
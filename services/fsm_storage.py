@@ -0,0 +1,283 @@
+import asyncio
+import copy
+import json
+import logging
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from services.cache import TTLCache, MISSING
+from services.database import get_pool
+from config import FSM_STORAGE, FSM_STATE_TTL, FSM_CACHE_SIZE, FSM_CACHE_TTL, \
+    FSM_FLUSH_INTERVAL, FSM_FLUSH_BATCH
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять из БД простаивающие состояния
+FSM_CLEANUP_INTERVAL = 300
+
+# Запись состояния: (state, data)
+Entry = Tuple[Optional[str], Dict[str, Any]]
+
+
+class PostgresStorage(BaseStorage):
+    """
+    ХРАНИЛИЩЕ FSM В POSTGRES
+    • Состояния регистрации и оплаты переживают рестарт и общие для нескольких процессов
+    • Локальный кэш: чтение без запроса к БД, записи сразу видны этому процессу
+    • Записи копятся FSM_FLUSH_INTERVAL и уходят в БД одной пачкой
+    • Состояния без изменений дольше FSM_STATE_TTL удаляются
+    • Запись с несериализуемыми данными пропускается, остальная пачка сохраняется
+    """
+
+    def __init__(self, state_ttl: float = 86400, cache_size: int = 10000, cache_ttl: float = 5,
+                 flush_interval: float = 0.1, flush_batch: int = 500):
+        self.key_builder = DefaultKeyBuilder(prefix="fsm", with_destiny=True)
+        self.state_ttl = state_ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        self._cache = TTLCache("fsm", max_size=cache_size, ttl=cache_ttl)
+        # Записи, еще не сохраненные в БД (всегда важнее кэша и БД)
+        self._dirty: Dict[str, Entry] = {}
+        self._flush_event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_cleanup = time.monotonic()
+
+        # Счетчики
+        self.db_reads = 0
+        self.writes = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+        self.bad_entries = 0
+        self.expired = 0
+
+    # =============================================
+    # 📖 ЧТЕНИЕ / ЗАПИСЬ
+    # =============================================
+
+    async def _load(self, key: StorageKey) -> Entry:
+        storage_key = self.key_builder.build(key)
+
+        entry = self._dirty.get(storage_key)
+        if entry is not None:
+            return entry
+
+        entry = self._cache.get(storage_key)
+        if entry is not MISSING:
+            return entry
+
+        generation = self._cache.generation
+        pool = await get_pool()
+        row = await pool.fetchrow(
+            '''
+            SELECT state, data FROM fsm_states
+            WHERE key = $1 AND updated_at > CURRENT_TIMESTAMP - make_interval(secs => $2)
+            ''',
+            storage_key, self.state_ttl
+        )
+        self.db_reads += 1
+
+        entry = (row['state'], json.loads(row['data'])) if row else (None, {})
+        self._cache.set(storage_key, entry, generation=generation)
+        return entry
+
+    async def _write(self, key: StorageKey, state: Any = MISSING, data: Any = MISSING):
+        current_state, current_data = await self._load(key)
+        entry = (
+            current_state if state is MISSING else state,
+            current_data if data is MISSING else copy.deepcopy(dict(data))
+        )
+
+        storage_key = self.key_builder.build(key)
+        self._dirty[storage_key] = entry
+        # Инвалидация отбрасывает чтение из БД, начатое до этой записи
+        self._cache.invalidate(storage_key)
+        self._cache.set(storage_key, entry)
+        self.writes += 1
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run_flusher())
+        self._flush_event.set()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._write(key, data=data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(key)
+        return copy.deepcopy(data)
+
+    # =============================================
+    # 💾 СОХРАНЕНИЕ ПАЧКАМИ
+    # =============================================
+
+    async def _run_flusher(self):
+        while True:
+            await self._flush_event.wait()
+            # Копим записи, пока пачка не наберется
+            if len(self._dirty) < self.flush_batch:
+                await asyncio.sleep(self.flush_interval)
+            self._flush_event.clear()
+
+            try:
+                flushed = await self.flush()
+            except Exception as e:
+                # Неожиданная ошибка не останавливает фоновое сохранение
+                logger.error(f"❌ Ошибка фонового сохранения состояний FSM: {e}")
+                flushed = False
+            if not flushed:
+                # БД недоступна - повторим позже, записи остаются в памяти
+                self._flush_event.set()
+                await asyncio.sleep(1)
+                continue
+
+            if time.monotonic() - self._last_cleanup > FSM_CLEANUP_INTERVAL:
+                await self.cleanup()
+
+    async def flush(self) -> bool:
+        """Сохраняет накопленные записи одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return True
+
+            batch, self._dirty = self._dirty, {}
+            upserts = []
+            deletes = []
+            for storage_key, (state, data) in list(batch.items()):
+                if state is None and not data:
+                    deletes.append(storage_key)
+                    continue
+                try:
+                    upserts.append((storage_key, state, json.dumps(data, ensure_ascii=False)))
+                except Exception as e:
+                    # Несериализуемые данные не сохранятся и при повторе - пропускаем только эту запись
+                    self.bad_entries += 1
+                    del batch[storage_key]
+                    logger.error(f"❌ Состояние FSM {storage_key} не сохранено, данные не сериализуются в JSON: {e}")
+
+            try:
+                pool = await get_pool()
+                async with pool.acquire() as conn:
+                    async with conn.transaction():
+                        if upserts:
+                            await conn.executemany(
+                                '''
+                                INSERT INTO fsm_states (key, state, data, updated_at)
+                                VALUES ($1, $2, $3::jsonb, CURRENT_TIMESTAMP)
+                                ON CONFLICT (key) DO UPDATE SET
+                                    state = EXCLUDED.state,
+                                    data = EXCLUDED.data,
+                                    updated_at = CURRENT_TIMESTAMP
+                                ''',
+                                upserts
+                            )
+                        if deletes:
+                            await conn.execute(
+                                'DELETE FROM fsm_states WHERE key = ANY($1::varchar[])',
+                                deletes
+                            )
+                self.flushes += 1
+                self.flushed_rows += len(batch)
+                return True
+
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"❌ Ошибка сохранения состояний FSM ({len(batch)} шт.): {e}")
+                self._requeue(batch)
+                return False
+            except BaseException:
+                # Отмена посреди записи (close() при остановке бота) - пачка сохранится финальным flush()
+                self._requeue(batch)
+                raise
+
+    def _requeue(self, batch: Dict[str, Entry]):
+        """Возвращает записи, которые не были перезаписаны за время сохранения"""
+        for storage_key, entry in batch.items():
+            self._dirty.setdefault(storage_key, entry)
+
+    async def cleanup(self) -> int:
+        """Удаляет состояния без изменений дольше state_ttl"""
+        self._last_cleanup = time.monotonic()
+        try:
+            pool = await get_pool()
+            result = await pool.execute(
+                'DELETE FROM fsm_states WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => $1)',
+                self.state_ttl
+            )
+            deleted = int(result.split()[-1])
+            self.expired += deleted
+            if deleted:
+                logger.info(f"✅ Удалено простаивающих состояний FSM: {deleted}")
+            return deleted
+        except Exception as e:
+            logger.error(f"❌ Ошибка очистки состояний FSM: {e}")
+            return 0
+
+    async def close(self) -> None:
+        """Сохраняет оставшиеся записи (вызывать до close_database)"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+    def get_stats(self) -> Dict:
+        """Счетчики хранилища FSM"""
+        return {
+            "cache": self._cache.get_stats(),
+            "pending": len(self._dirty),
+            "db_reads": self.db_reads,
+            "writes": self.writes,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "flush_errors": self.flush_errors,
+            "bad_entries": self.bad_entries,
+            "expired": self.expired
+        }
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE"""
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return PostgresStorage(
+        state_ttl=FSM_STATE_TTL,
+        cache_size=FSM_CACHE_SIZE,
+        cache_ttl=FSM_CACHE_TTL,
+        flush_interval=FSM_FLUSH_INTERVAL,
+        flush_batch=FSM_FLUSH_BATCH
+    )
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.fsm_storage import create_fsm_storage
+
+storage = create_fsm_storage()
+dp = Dispatcher(storage=storage)
+...
+await storage.close()   # до close_database()
+
+# Настройки (.env):
+FSM_STORAGE=postgres        # postgres / memory
+FSM_STATE_TTL=86400         # сек простоя до удаления состояния
+FSM_CACHE_SIZE=10000        # состояний в локальном кэше
+FSM_CACHE_TTL=5             # сек доверия локальному кэшу (при нескольких процессах)
+FSM_FLUSH_INTERVAL=0.1      # сек накопления записей в пачку
+FSM_FLUSH_BATCH=500         # записей, при которых пачка пишется сразу
+'''
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from services.xui_client import xui_panel
+from services.inbound_profile import InboundProfile, get_inbound_profile
+from config import INBOUND_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class InboundSnapshot:
+    """Снимок инбаунда с индексом клиентов email -> client"""
+
+    def __init__(self, inbound):
+        self.inbound = inbound
+        self.fetched_at = time.monotonic()
+        self.clients_by_email: Dict[str, object] = {}
+        self._profile: Optional[InboundProfile] = None
+
+        settings = getattr(inbound, 'settings', None)
+        for client in (getattr(settings, 'clients', None) or []):
+            email = getattr(client, 'email', None)
+            if email:
+                self.clients_by_email[email] = client
+
+    def get_client(self, email: str):
+        """Поиск клиента по email за O(1)"""
+        return self.clients_by_email.get(email)
+
+    @property
+    def profile(self) -> InboundProfile:
+        """Профиль подключения (общий для снимков с одинаковыми настройками)"""
+        if self._profile is None:
+            self._profile = get_inbound_profile(self.inbound)
+        return self._profile
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+class InboundCache:
+    """
+    КЭШ СНИМКОВ ИНБАУНДОВ
+    • Короткий TTL вместо скачивания инбаунда на каждый запрос
+    • Явная инвалидация после add/update клиента
+    • Single-flight: параллельные запросы ждут одну загрузку
+    """
+
+    def __init__(self, ttl: float = 30.0):
+        self.ttl = ttl
+        self._snapshots: Dict[int, InboundSnapshot] = {}
+        self._inflight: Dict[int, asyncio.Future] = {}
+        # Растет при инвалидации - загрузка, начатая до изменения, не попадет в кэш
+        self._generation = 0
+
+        # Счетчики
+        self.hits = 0
+        self.downloads = 0
+        self.shared_waits = 0
+        self.invalidations = 0
+
+    async def get(self, inbound_id: int, force: bool = False) -> Optional[InboundSnapshot]:
+        """Возвращает актуальный снимок инбаунда (скачивает при необходимости)"""
+        snapshot = self._snapshots.get(inbound_id)
+        if not force and snapshot and snapshot.age < self.ttl:
+            self.hits += 1
+            return snapshot
+
+        inflight = self._inflight.get(inbound_id)
+        if inflight is not None:
+            self.shared_waits += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[inbound_id] = future
+        generation = self._generation
+        try:
+            snapshot = await self._download(inbound_id)
+            if generation == self._generation:
+                self._snapshots[inbound_id] = snapshot
+            future.set_result(snapshot)
+            return snapshot
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Исключение уже передано ожидающим, помечаем как полученное
+                future.exception()
+            raise
+        finally:
+            if self._inflight.get(inbound_id) is future:
+                del self._inflight[inbound_id]
+
+    async def _download(self, inbound_id: int) -> InboundSnapshot:
+        inbound = await xui_panel.request(lambda a: a.inbound.get_by_id(inbound_id))
+        self.downloads += 1
+        snapshot = InboundSnapshot(inbound)
+        logger.info(f"✅ Снимок инбаунда {inbound_id} обновлен: {len(snapshot.clients_by_email)} клиентов")
+        return snapshot
+
+    def invalidate(self, inbound_id: int = None):
+        """Сбрасывает снимок после изменения клиентов на панели"""
+        self.invalidations += 1
+        self._generation += 1
+        if inbound_id is None:
+            self._snapshots.clear()
+            self._inflight.clear()
+        else:
+            self._snapshots.pop(inbound_id, None)
+            self._inflight.pop(inbound_id, None)
+
+    def get_stats(self) -> Dict:
+        """Счетчики использования кэша инбаундов"""
+        return {
+            "hits": self.hits,
+            "downloads": self.downloads,
+            "shared_waits": self.shared_waits,
+            "invalidations": self.invalidations
+        }
+
+
+# Глобальный экземпляр
+inbound_cache = InboundCache(ttl=INBOUND_CACHE_TTL)
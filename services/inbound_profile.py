@@ -0,0 +1,87 @@
+import hashlib
+import logging
+import zlib
+from typing import Dict, List, Tuple
+
+from config import XUI_EXTERNAL_IP, SERVER_PORT
+
+logger = logging.getLogger(__name__)
+
+
+def get_settings_hash(inbound) -> str:
+    """Версия настроек подключения инбаунда (меняется при смене ключа, SNI, shortId, remark)"""
+    stream_settings = inbound.stream_settings.model_dump_json(by_alias=True)
+    return hashlib.sha1(f"{stream_settings}|{inbound.remark}".encode()).hexdigest()
+
+
+class InboundProfile:
+    """
+    ПРОФИЛЬ ПОДКЛЮЧЕНИЯ ИНБАУНДА
+    • reality_settings разбираются один раз на версию настроек
+    • Строка подключения собирается из заранее готовых частей - в render() только подстановка
+    • Несколько serverNames/shortIds: вариант выбирается по email и не меняется между вызовами
+    """
+
+    def __init__(self, inbound, settings_hash: str):
+        self.inbound_id = inbound.id
+        self.settings_hash = settings_hash
+
+        reality = inbound.stream_settings.reality_settings
+        public_key = reality.get("settings").get("publicKey")
+        server_names = reality.get("serverNames")
+        short_ids = reality.get("shortIds")
+        if not server_names or not short_ids:
+            raise ValueError(f"В инбаунде {inbound.id} нет serverNames/shortIds")
+
+        # Все сочетания SNI и shortId - готовые куски строки между UUID и email
+        self.variants: List[Tuple[str, str]] = [(name, short_id) for name in server_names for short_id in short_ids]
+        self._prefix = "vless://"
+        self._middles = [
+            f"@{XUI_EXTERNAL_IP}:{SERVER_PORT}"
+            f"?type=tcp&security=reality&pbk={public_key}&fp=firefox&sni={name}"
+            f"&sid={short_id}&spx=%2F#{inbound.remark}-"
+            for name, short_id in self.variants
+        ]
+
+    def _variant_index(self, email: str) -> int:
+        if len(self._middles) == 1:
+            return 0
+        return zlib.crc32(email.encode()) % len(self._middles)
+
+    def get_variant(self, email: str) -> Tuple[str, str]:
+        """(serverName, shortId), выбранные для пользователя"""
+        return self.variants[self._variant_index(email)]
+
+    def render(self, email: str, client_uuid: str) -> str:
+        """Строка подключения клиента"""
+        return self._prefix + client_uuid + self._middles[self._variant_index(email)] + email
+
+
+# Последний профиль по инбаунду: новый разбирается только при смене хэша настроек
+_profiles: Dict[int, InboundProfile] = {}
+
+
+def get_inbound_profile(inbound) -> InboundProfile:
+    """Профиль инбаунда из кэша (разбор настроек - только для новой версии)"""
+    settings_hash = get_settings_hash(inbound)
+    profile = _profiles.get(inbound.id)
+    if profile is None or profile.settings_hash != settings_hash:
+        profile = InboundProfile(inbound, settings_hash)
+        _profiles[inbound.id] = profile
+        logger.info(
+            f"✅ Профиль подключения инбаунда {inbound.id} обновлен "
+            f"({len(profile.variants)} вариантов SNI/shortId)"
+        )
+    return profile
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.inbound_profile import get_inbound_profile
+
+profile = get_inbound_profile(snapshot.inbound)   # или snapshot.profile - один разбор на снимок
+connection_string = profile.render("123456", client_uuid)
+
+# Экспорт всех клиентов инбаунда - один профиль на все строки
+strings = {email: snapshot.profile.render(email, client.id) for email, client in snapshot.clients_by_email.items()}
+'''
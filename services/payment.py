@@ -1,12 +1,36 @@
+import asyncio
+import hashlib
+import hmac
+import json
 import logging
-import requests
 import uuid
 import os
-from typing import Dict, Optional, List
+import time
+import aiohttp
+from typing import Dict, Optional, List, Tuple, Any, Callable, Awaitable
 from dataclasses import dataclass
 
+from services.rate_limit import RateLimiter
+
 logger = logging.getLogger(__name__)
 
+# Настройки HTTP-клиента платежей (общие значения по умолчанию)
+PAYMENT_HTTP_TIMEOUT = float(os.getenv('PAYMENT_HTTP_TIMEOUT', '10'))
+PAYMENT_HTTP_MAX_CONNECTIONS = int(os.getenv('PAYMENT_HTTP_MAX_CONNECTIONS', '10'))
+PAYMENT_HTTP_POOL_SIZE = int(os.getenv('PAYMENT_HTTP_POOL_SIZE', '50'))
+PAYMENT_HTTP_KEEPALIVE = float(os.getenv('PAYMENT_HTTP_KEEPALIVE', '30'))
+
+# Настройки фонового опроса неподтвержденных платежей
+PAYMENT_POLL_ENABLED = os.getenv('PAYMENT_POLL_ENABLED', 'True').lower() == 'true'
+PAYMENT_POLL_TICK = float(os.getenv('PAYMENT_POLL_TICK', '5'))  # сек между проходами
+PAYMENT_POLL_MIN_INTERVAL = float(os.getenv('PAYMENT_POLL_MIN_INTERVAL', '10'))  # сек между проверками свежего платежа
+PAYMENT_POLL_MAX_INTERVAL = float(os.getenv('PAYMENT_POLL_MAX_INTERVAL', '300'))  # сек между проверками старого платежа
+PAYMENT_POLL_CONCURRENCY = int(os.getenv('PAYMENT_POLL_CONCURRENCY', '5'))  # параллельных проверок на провайдера
+PAYMENT_POLL_RATE = float(os.getenv('PAYMENT_POLL_RATE', '5'))  # запросов в секунду на провайдера
+PAYMENT_POLL_BATCH = int(os.getenv('PAYMENT_POLL_BATCH', '500'))  # платежей на страницу чтения из БД
+PAYMENT_EXPIRE_AFTER = float(os.getenv('PAYMENT_EXPIRE_AFTER', '7200'))  # сек до истечения брошенного счета
+PAYMENT_ACTIVATION_TIMEOUT = float(os.getenv('PAYMENT_ACTIVATION_TIMEOUT', '600'))  # сек до повторной активации зависшего платежа
+
 
 @dataclass
 class PaymentItem:
@@ -32,10 +56,36 @@ class PaymentConfig:
 class BasePaymentProvider:
     """Базовый класс для всех платежных провайдеров"""
 
-    def __init__(self, name: str, enabled: bool = True):
+    def __init__(self, name: str, enabled: bool = True, timeout: float = PAYMENT_HTTP_TIMEOUT,
+                 max_connections: int = PAYMENT_HTTP_MAX_CONNECTIONS):
         self.name = name
         self.enabled = enabled
 
+        # Общая HTTP-сессия выдается UniversalPaymentManager
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._semaphore = asyncio.Semaphore(max_connections)
+
+    def bind_session(self, session: Optional[aiohttp.ClientSession]):
+        """Подключение общей HTTP-сессии менеджера"""
+        self.session = session
+
+    async def _request(self, method: str, url: str, **kwargs) -> Tuple[int, Any]:
+        """
+        Неблокирующий HTTP-запрос через общую сессию
+        Возвращает (status, json или текст ответа)
+        """
+        if self.session is None or self.session.closed:
+            raise RuntimeError("HTTP-сессия платежей не создана")
+
+        async with self._semaphore:
+            async with self.session.request(method, url, timeout=self.timeout, **kwargs) as response:
+                text = await response.text()
+                try:
+                    return response.status, json.loads(text)
+                except ValueError:
+                    return response.status, text
+
     async def create_payment(self, config: PaymentConfig, user_data: Dict) -> Optional[Dict]:
         """Создание платежа - должен быть реализован в дочерних классах"""
         raise NotImplementedError
@@ -44,12 +94,36 @@ class BasePaymentProvider:
         """Проверка статуса платежа - должен быть реализован в дочерних классах"""
         raise NotImplementedError
 
+    def parse_notification(self, payload: Dict) -> Optional[Dict]:
+        """
+        Разбор HTTP-уведомления провайдера - должен быть реализован в дочерних классах
+        Возвращает {payment_id, paid, metadata} или None если формат не распознан
+        """
+        raise NotImplementedError
+
+    async def verify_notification(self, payload: Dict, notification: Dict) -> bool:
+        """Проверка подлинности уведомления - должен быть реализован в дочерних классах"""
+        raise NotImplementedError
+
+
+def parse_yookassa_notification(payload: Dict) -> Optional[Dict]:
+    """Разбор уведомления в формате ЮKassa (используется ЮMoney и картами)"""
+    payment = payload.get("object")
+    if payload.get("type") != "notification" or not isinstance(payment, dict) or not payment.get("id"):
+        return None
+
+    return {
+        "payment_id": str(payment["id"]),
+        "paid": payload.get("event") == "payment.succeeded" and payment.get("status") == "succeeded",
+        "metadata": payment.get("metadata") or {}
+    }
+
 
 class YooMoneyProvider(BasePaymentProvider):
     """Универсальный провайдер ЮMoney"""
 
-    def __init__(self, shop_id: str, secret_key: str):
-        super().__init__("ЮMoney")
+    def __init__(self, shop_id: str, secret_key: str, timeout: float = PAYMENT_HTTP_TIMEOUT):
+        super().__init__("ЮMoney", timeout=timeout)
         self.shop_id = shop_id
         self.secret_key = secret_key
         self.base_url = "https://yoomoney.ru/api/v4"
@@ -78,15 +152,14 @@ class YooMoneyProvider(BasePaymentProvider):
             # Добавляем пользовательские данные в metadata
             payload["metadata"].update(user_data)
 
-            response = requests.post(
+            status, data = await self._request(
+                "POST",
                 f"{self.base_url}/payments",
                 json=payload,
-                headers=headers,
-                timeout=10
+                headers=headers
             )
 
-            if response.status_code == 200:
-                data = response.json()
+            if status == 200:
                 return {
                     'payment_id': data['id'],
                     'confirmation_url': data['confirmation']['confirmation_url'],
@@ -94,7 +167,7 @@ class YooMoneyProvider(BasePaymentProvider):
                     'provider': 'yoomoney'
                 }
             else:
-                logger.error(f"❌ ЮMoney API error: {response.text}")
+                logger.error(f"❌ ЮMoney API error: {data}")
                 return None
 
         except Exception as e:
@@ -108,14 +181,13 @@ class YooMoneyProvider(BasePaymentProvider):
                 "Content-Type": "application/json"
             }
 
-            response = requests.get(
+            status, data = await self._request(
+                "GET",
                 f"{self.base_url}/payments/{payment_id}",
-                headers=headers,
-                timeout=10
+                headers=headers
             )
 
-            if response.status_code == 200:
-                data = response.json()
+            if status == 200:
                 return data['status'] == 'succeeded'
             return False
 
@@ -123,12 +195,21 @@ class YooMoneyProvider(BasePaymentProvider):
             logger.error(f"❌ ЮMoney check error: {e}")
             return False
 
+    def parse_notification(self, payload: Dict) -> Optional[Dict]:
+        return parse_yookassa_notification(payload)
+
+    async def verify_notification(self, payload: Dict, notification: Dict) -> bool:
+        # Уведомления не подписаны - подтверждаем статус запросом к API
+        if not notification["paid"]:
+            return True
+        return await self.check_payment(notification["payment_id"])
+
 
 class SBPProvider(BasePaymentProvider):
     """Универсальный провайдер СБП"""
 
-    def __init__(self, merchant_id: str, secret_key: str):
-        super().__init__("СБП")
+    def __init__(self, merchant_id: str, secret_key: str, timeout: float = PAYMENT_HTTP_TIMEOUT):
+        super().__init__("СБП", timeout=timeout)
         self.merchant_id = merchant_id
         self.secret_key = secret_key
         self.base_url = "https://securepay.tinkoff.ru/v2"
@@ -175,7 +256,6 @@ class SBPProvider(BasePaymentProvider):
             }
 
             # Подпись запроса
-            import hashlib
             sign_data = "".join([
                 str(payload["Amount"]),
                 payload["OrderId"],
@@ -186,14 +266,13 @@ class SBPProvider(BasePaymentProvider):
             ])
             payload["Token"] = hashlib.sha256(sign_data.encode()).hexdigest()
 
-            response = requests.post(
+            status, data = await self._request(
+                "POST",
                 f"{self.base_url}/Init",
-                json=payload,
-                timeout=10
+                json=payload
             )
 
-            if response.status_code == 200:
-                data = response.json()
+            if status == 200:
                 if data['Success']:
                     return {
                         'payment_id': data['PaymentId'],
@@ -214,18 +293,16 @@ class SBPProvider(BasePaymentProvider):
                 "PaymentId": payment_id
             }
 
-            import hashlib
             sign_data = payload["TerminalKey"] + payload["PaymentId"] + self.secret_key
             payload["Token"] = hashlib.sha256(sign_data.encode()).hexdigest()
 
-            response = requests.post(
+            status, data = await self._request(
+                "POST",
                 f"{self.base_url}/GetState",
-                json=payload,
-                timeout=10
+                json=payload
             )
 
-            if response.status_code == 200:
-                data = response.json()
+            if status == 200:
                 return data['Success'] and data['Status'] == 'CONFIRMED'
             return False
 
@@ -233,19 +310,50 @@ class SBPProvider(BasePaymentProvider):
             logger.error(f"❌ СБП check error: {e}")
             return False
 
+    def make_notification_token(self, payload: Dict) -> str:
+        """Подпись уведомления Tinkoff: значения корневых полей + Password, отсортированные по ключу"""
+        params = {
+            key: value for key, value in payload.items()
+            if key != "Token" and not isinstance(value, (dict, list))
+        }
+        params["Password"] = self.secret_key
+
+        def to_str(value):
+            if isinstance(value, bool):
+                return "true" if value else "false"
+            return str(value)
+
+        sign_data = "".join(to_str(params[key]) for key in sorted(params))
+        return hashlib.sha256(sign_data.encode()).hexdigest()
+
+    def parse_notification(self, payload: Dict) -> Optional[Dict]:
+        if not payload.get("PaymentId") or not payload.get("Token"):
+            return None
+
+        return {
+            "payment_id": str(payload["PaymentId"]),
+            "paid": bool(payload.get("Success")) and payload.get("Status") == "CONFIRMED",
+            "metadata": payload.get("Data") or {}
+        }
+
+    async def verify_notification(self, payload: Dict, notification: Dict) -> bool:
+        if payload.get("TerminalKey") != self.merchant_id:
+            return False
+        return hmac.compare_digest(self.make_notification_token(payload), str(payload.get("Token")))
+
 
 class BankCardProvider(BasePaymentProvider):
     """Универсальный провайдер банковских карт"""
 
-    def __init__(self, shop_id: str, secret_key: str):
-        super().__init__("Банковская карта")
+    def __init__(self, shop_id: str, secret_key: str, timeout: float = PAYMENT_HTTP_TIMEOUT):
+        super().__init__("Банковская карта", timeout=timeout)
         self.shop_id = shop_id
         self.secret_key = secret_key
         self.base_url = "https://api.yookassa.ru/v3"
 
     async def create_payment(self, config: PaymentConfig, user_data: Dict) -> Optional[Dict]:
         try:
-            auth = (self.shop_id, self.secret_key)
+            auth = aiohttp.BasicAuth(self.shop_id, self.secret_key)
             headers = {
                 "Idempotence-Key": str(uuid.uuid4()),
                 "Content-Type": "application/json"
@@ -271,16 +379,15 @@ class BankCardProvider(BasePaymentProvider):
             # Добавляем пользовательские данные
             payload["metadata"].update(user_data)
 
-            response = requests.post(
+            status, data = await self._request(
+                "POST",
                 f"{self.base_url}/payments",
                 json=payload,
                 headers=headers,
-                auth=auth,
-                timeout=10
+                auth=auth
             )
 
-            if response.status_code == 200:
-                data = response.json()
+            if status == 200:
                 return {
                     'payment_id': data['id'],
                     'confirmation_url': data['confirmation']['confirmation_url'],
@@ -295,16 +402,15 @@ class BankCardProvider(BasePaymentProvider):
 
     async def check_payment(self, payment_id: str) -> bool:
         try:
-            auth = (self.shop_id, self.secret_key)
+            auth = aiohttp.BasicAuth(self.shop_id, self.secret_key)
 
-            response = requests.get(
+            status, data = await self._request(
+                "GET",
                 f"{self.base_url}/payments/{payment_id}",
-                auth=auth,
-                timeout=10
+                auth=auth
             )
 
-            if response.status_code == 200:
-                data = response.json()
+            if status == 200:
                 return data['status'] == 'succeeded'
             return False
 
@@ -312,6 +418,15 @@ class BankCardProvider(BasePaymentProvider):
             logger.error(f"❌ Bank card check error: {e}")
             return False
 
+    def parse_notification(self, payload: Dict) -> Optional[Dict]:
+        return parse_yookassa_notification(payload)
+
+    async def verify_notification(self, payload: Dict, notification: Dict) -> bool:
+        # Уведомления не подписаны - подтверждаем статус запросом к API
+        if not notification["paid"]:
+            return True
+        return await self.check_payment(notification["payment_id"])
+
 
 class UniversalPaymentManager:
     """Универсальный менеджер платежей для любого проекта"""
@@ -322,23 +437,66 @@ class UniversalPaymentManager:
         # Динамическая инициализация провайдеров из переменных окружения
         self.providers = {}
 
+        # Общая HTTP-сессия (keep-alive) для всех провайдеров
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._session_lock = asyncio.Lock()
+
         # ЮMoney
         yoomoney_shop_id = os.getenv('YOOMONEY_SHOP_ID')
         yoomoney_secret = os.getenv('YOOMONEY_SECRET_KEY')
         if yoomoney_shop_id and yoomoney_secret:
-            self.providers['yoomoney'] = YooMoneyProvider(yoomoney_shop_id, yoomoney_secret)
+            self.providers['yoomoney'] = YooMoneyProvider(
+                yoomoney_shop_id, yoomoney_secret,
+                timeout=float(os.getenv('YOOMONEY_TIMEOUT', PAYMENT_HTTP_TIMEOUT))
+            )
 
         # СБП
         sbp_merchant_id = os.getenv('SBP_MERCHANT_ID')
         sbp_secret = os.getenv('SBP_SECRET_KEY')
         if sbp_merchant_id and sbp_secret:
-            self.providers['sbp'] = SBPProvider(sbp_merchant_id, sbp_secret)
+            self.providers['sbp'] = SBPProvider(
+                sbp_merchant_id, sbp_secret,
+                timeout=float(os.getenv('SBP_TIMEOUT', PAYMENT_HTTP_TIMEOUT))
+            )
 
         # Банковские карты
         card_shop_id = os.getenv('CARD_SHOP_ID')
         card_secret = os.getenv('CARD_SECRET_KEY')
         if card_shop_id and card_secret:
-            self.providers['card'] = BankCardProvider(card_shop_id, card_secret)
+            self.providers['card'] = BankCardProvider(
+                card_shop_id, card_secret,
+                timeout=float(os.getenv('CARD_TIMEOUT', PAYMENT_HTTP_TIMEOUT))
+            )
+
+    async def start(self):
+        """Создает общую HTTP-сессию (вызывается при запуске бота или лениво)"""
+        if self.session is not None and not self.session.closed:
+            return
+
+        async with self._session_lock:
+            if self.session is not None and not self.session.closed:
+                return
+
+            connector = aiohttp.TCPConnector(
+                limit=PAYMENT_HTTP_POOL_SIZE,
+                limit_per_host=PAYMENT_HTTP_MAX_CONNECTIONS,
+                keepalive_timeout=PAYMENT_HTTP_KEEPALIVE
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+            for provider in self.providers.values():
+                provider.bind_session(self.session)
+            logger.info("✅ HTTP-сессия платежей создана")
+
+    async def close(self):
+        """Закрывает общую HTTP-сессию при остановке бота"""
+        if self.session is None:
+            return
+
+        for provider in self.providers.values():
+            provider.bind_session(None)
+        await self.session.close()
+        self.session = None
+        logger.info("✅ HTTP-сессия платежей закрыта")
 
     def is_enabled(self) -> bool:
         """Проверка включена ли платежная система"""
@@ -369,6 +527,7 @@ class UniversalPaymentManager:
             logger.warning(f"⚠️ Payment provider {provider} not available")
             return None
 
+        await self.start()
         result = await self.providers[provider].create_payment(config, user_data)
 
         if result:
@@ -384,13 +543,217 @@ class UniversalPaymentManager:
         if not self.is_enabled() or provider not in self.providers:
             return False
 
+        await self.start()
         return await self.providers[provider].check_payment(payment_id)
 
+    async def process_notification(self, provider: str, payload: Dict) -> Optional[Dict]:
+        """
+        Проверка и разбор HTTP-уведомления провайдера
+        Возвращает {payment_id, provider, paid, telegram_id, action} или None если уведомление отклонено
+        telegram_id/action берутся из метаданных уведомления и могут отсутствовать
+        """
+        if provider not in self.providers:
+            logger.warning(f"⚠️ Notification for unknown provider {provider}")
+            return None
+
+        provider_obj = self.providers[provider]
+        notification = provider_obj.parse_notification(payload)
+        if not notification:
+            logger.warning(f"⚠️ Unrecognized {provider} notification")
+            return None
+
+        await self.start()
+        if not await provider_obj.verify_notification(payload, notification):
+            logger.warning(f"⚠️ {provider} notification {notification['payment_id']} failed verification")
+            return None
+
+        context = notification["metadata"]
+        telegram_id = context.get("telegram_id")
+
+        return {
+            "payment_id": notification["payment_id"],
+            "provider": provider,
+            "paid": notification["paid"],
+            "telegram_id": int(telegram_id) if telegram_id else None,
+            "action": context.get("action")
+        }
+
 
 # Глобальный экземпляр для удобства
 payment_manager = UniversalPaymentManager()
 
 
+class PaymentStatusPoller:
+    """
+    ФОНОВЫЙ ОПРОС НЕПОДТВЕРЖДЕННЫХ ПЛАТЕЖЕЙ
+    • Проверяет все pending-платежи (страницами по id) пачками по провайдерам
+    • Чем старше платеж, тем реже проверка
+    • Брошенные счета истекают после последней проверки у провайдера
+    • Частота запросов к провайдеру ограничена независимо от числа ожидающих
+    """
+
+    def __init__(self, manager: UniversalPaymentManager):
+        self.manager = manager
+        self._task: Optional[asyncio.Task] = None
+        self._on_paid: Optional[Callable[[str, str], Awaitable[Any]]] = None
+        self._last_checked: Dict[Tuple[str, str], float] = {}
+        self._limiters: Dict[str, RateLimiter] = {}
+
+        # Счетчики
+        self.checks = 0
+        self.confirmed = 0
+        self.expired = 0
+        self.errors = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, on_paid: Callable[[str, str], Awaitable[Any]]):
+        """
+        Запуск опроса
+        on_paid(provider, payment_id) - вызывается для каждого подтвержденного платежа
+        """
+        if self.running:
+            return
+        self._on_paid = on_paid
+        self._task = asyncio.create_task(self._run())
+        logger.info("✅ Фоновый опрос платежей запущен")
+
+    async def stop(self):
+        """Остановка опроса при завершении бота"""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("✅ Фоновый опрос платежей остановлен")
+
+    @staticmethod
+    def check_interval(age: float) -> float:
+        """Интервал между проверками растет с возрастом платежа (10% возраста)"""
+        return min(max(age * 0.1, PAYMENT_POLL_MIN_INTERVAL), PAYMENT_POLL_MAX_INTERVAL)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"❌ Ошибка опроса платежей: {e}")
+            await asyncio.sleep(PAYMENT_POLL_TICK)
+
+    async def poll_once(self):
+        """Один проход: последняя проверка брошенных счетов + проверка платежей, которым пора"""
+        from services.database import get_pending_payments, get_stale_pending_payments, get_stuck_activations
+
+        # Активации, прерванные падением/рестартом, запускаются заново
+        for payment in await get_stuck_activations(PAYMENT_ACTIVATION_TIMEOUT):
+            logger.warning(f"⚠️ Повторная активация зависшего платежа {payment['provider']}:{payment['provider_payment_id']}")
+            await self._activate(payment['provider'], payment['provider_payment_id'])
+
+        # Брошенный счет истекает только если провайдер и в последний раз не подтвердил оплату
+        stale = await get_stale_pending_payments(PAYMENT_EXPIRE_AFTER, PAYMENT_POLL_BATCH)
+        await self._check_all(stale, final=True)
+
+        # Все pending-платежи страницами по id - новые не теряются за старыми
+        alive = set()
+        due = []
+        after_id = 0
+        now = time.monotonic()
+        while True:
+            page = await get_pending_payments(after_id, PAYMENT_POLL_BATCH)
+            for payment in page:
+                key = (payment['provider'], payment['provider_payment_id'])
+                alive.add(key)
+                last = self._last_checked.get(key)
+                if last is None or now - last >= self.check_interval(payment['age']):
+                    due.append(payment)
+            if len(page) < PAYMENT_POLL_BATCH:
+                break
+            after_id = page[-1]['id']
+
+        # Забываем платежи, подтвержденные вебхуком или кнопкой
+        self._last_checked = {key: at for key, at in self._last_checked.items() if key in alive}
+
+        await self._check_all(due)
+
+    async def _check_all(self, payments: List, final: bool = False):
+        by_provider: Dict[str, List] = {}
+        for payment in payments:
+            by_provider.setdefault(payment['provider'], []).append(payment)
+        if not by_provider:
+            return
+
+        await self.manager.start()
+        await asyncio.gather(*(
+            self._check_provider(provider, provider_payments, final)
+            for provider, provider_payments in by_provider.items()
+        ))
+
+    async def _check_provider(self, provider: str, payments: List, final: bool = False):
+        """final=True - последняя проверка перед истечением: не оплачен -> expired"""
+        from services.database import expire_payment
+
+        limiter = self._limiters.get(provider)
+        if limiter is None:
+            limiter = RateLimiter(PAYMENT_POLL_RATE, PAYMENT_POLL_CONCURRENCY)
+            self._limiters[provider] = limiter
+
+        async def check(payment):
+            payment_id = payment['provider_payment_id']
+            async with limiter.semaphore:
+                await limiter.wait()
+                self._last_checked[(provider, payment_id)] = time.monotonic()
+                self.checks += 1
+                paid = await self.manager.check_payment(payment_id, provider)
+            if paid:
+                await self._confirm(provider, payment_id)
+            elif final and await expire_payment(provider, payment_id):
+                # Поздний вебхук или кнопка еще переведут истекший счет в paid
+                self._last_checked.pop((provider, payment_id), None)
+                self.expired += 1
+                logger.info(f"✅ Счет {provider}:{payment_id} истек без оплаты")
+
+        await asyncio.gather(*(check(payment) for payment in payments))
+
+    async def _confirm(self, provider: str, payment_id: str):
+        from services.database import mark_payment_paid
+
+        self._last_checked.pop((provider, payment_id), None)
+        if not await mark_payment_paid(provider, payment_id):
+            return
+        self.confirmed += 1
+        logger.info(f"✅ Платеж {provider}:{payment_id} подтвержден фоновым опросом")
+        await self._activate(provider, payment_id)
+
+    async def _activate(self, provider: str, payment_id: str):
+        try:
+            await self._on_paid(provider, payment_id)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"❌ Ошибка активации платежа {provider}:{payment_id}: {e}")
+
+    def get_stats(self) -> Dict:
+        """Счетчики фонового опроса"""
+        return {
+            "tracked": len(self._last_checked),
+            "checks": self.checks,
+            "confirmed": self.confirmed,
+            "expired": self.expired,
+            "errors": self.errors
+        }
+
+
+# Глобальный экземпляр фонового опроса
+payment_poller = PaymentStatusPoller(payment_manager)
+
+
 # 📋 УНИВЕРСАЛЬНЫЕ ФУНКЦИИ ДЛЯ ЛЮБОГО ПРОЕКТА
 async def create_payment(provider: str, config: PaymentConfig, user_data: Dict) -> Optional[Dict]:
     """
@@ -412,6 +775,16 @@ async def check_payment(payment_id: str, provider: str) -> bool:
     return await payment_manager.check_payment(payment_id, provider)
 
 
+async def process_notification(provider: str, payload: Dict) -> Optional[Dict]:
+    """Проверка и разбор уведомления провайдера (webhook)"""
+    return await payment_manager.process_notification(provider, payload)
+
+
+def is_payment_polling() -> bool:
+    """Работает ли фоновый опрос (тогда хендлеры не обращаются к провайдерам)"""
+    return payment_poller.running
+
+
 def is_payment_enabled() -> bool:
     """Проверка доступности платежной системы"""
     return payment_manager.is_enabled()
@@ -464,6 +837,26 @@ SBP_SECRET_KEY=your_secret_key
 
 CARD_SHOP_ID=your_shop_id  
 CARD_SECRET_KEY=your_secret_key
+
+# HTTP-клиент (опционально)
+PAYMENT_HTTP_TIMEOUT=10           # таймаут по умолчанию, сек
+YOOMONEY_TIMEOUT=10               # таймауты отдельных провайдеров
+SBP_TIMEOUT=15
+CARD_TIMEOUT=10
+PAYMENT_HTTP_MAX_CONNECTIONS=10   # соединений на одного провайдера
+PAYMENT_HTTP_POOL_SIZE=50         # соединений всего
+PAYMENT_HTTP_KEEPALIVE=30         # сек жизни простаивающего соединения
+
+# Фоновый опрос неподтвержденных платежей (опционально)
+PAYMENT_POLL_ENABLED=true
+PAYMENT_POLL_TICK=5               # сек между проходами
+PAYMENT_POLL_MIN_INTERVAL=10      # сек между проверками свежего платежа
+PAYMENT_POLL_MAX_INTERVAL=300     # сек между проверками старого платежа
+PAYMENT_POLL_CONCURRENCY=5        # параллельных проверок на провайдера
+PAYMENT_POLL_RATE=5               # запросов в секунду на провайдера
+PAYMENT_POLL_BATCH=500            # платежей на страницу чтения из БД
+PAYMENT_EXPIRE_AFTER=7200         # сек до истечения брошенного счета
+PAYMENT_ACTIVATION_TIMEOUT=600    # сек до повторной активации зависшего платежа
 '''
 
 # Пример 1: VPN сервис
@@ -0,0 +1,128 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+from services.database import get_qr_code, save_qr_code
+from services.single_flight import SingleFlight
+from config import QR_CACHE_MAX_BYTES, QR_CACHE_PERSIST
+
+logger = logging.getLogger(__name__)
+
+
+def get_qr_digest(connection_string: str, variant: str = "") -> bytes:
+    """
+    Ключ кэша - sha256 строки подключения (сама строка в ключах не хранится)
+    variant - режим кодирования: PNG другого режима не отдается из кэша и БД
+    """
+    if variant:
+        connection_string = f"{variant}|{connection_string}"
+    return hashlib.sha256(connection_string.encode()).digest()
+
+
+class QRCodeCache:
+    """
+    КЭШ ГОТОВЫХ PNG QR-КОДОВ
+    • LRU, ограниченный суммарным размером PNG в байтах, а не числом записей
+    • Строка подключения не изменилась - PNG не кодируется заново
+    • persist=True - промах памяти проверяется в Postgres (PNG переживают рестарт)
+    • Параллельные промахи по одной строке ждут одно кодирование
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, persist: bool = False):
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self._data: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self.size_bytes = 0
+        self.flights = SingleFlight("qr_codes")
+
+        # Счетчики
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, digest: bytes) -> Optional[bytes]:
+        """PNG из памяти или None"""
+        png = self._data.get(digest)
+        if png is not None:
+            self._data.move_to_end(digest)
+        return png
+
+    def put(self, digest: bytes, png: bytes):
+        """Сохраняет PNG, вытесняя самые старые, пока не влезет в max_bytes"""
+        if len(png) > self.max_bytes:
+            return
+        previous = self._data.pop(digest, None)
+        if previous is not None:
+            self.size_bytes -= len(previous)
+        self._data[digest] = png
+        self.size_bytes += len(png)
+
+        while self.size_bytes > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.size_bytes -= len(evicted)
+            self.evictions += 1
+
+    async def get_or_render(self, connection_string: str,
+                            render: Callable[[str], Awaitable[bytes]], variant: str = "") -> bytes:
+        """PNG QR-кода: память -> Postgres (если persist) -> await render(connection_string)"""
+        digest = get_qr_digest(connection_string, variant)
+
+        png = self.get(digest)
+        if png is not None:
+            self.hits += 1
+            return png
+        return await self.flights.run(digest, lambda: self._load(digest, connection_string, render))
+
+    async def _load(self, digest: bytes, connection_string: str,
+                    render: Callable[[str], Awaitable[bytes]]) -> bytes:
+        if self.persist:
+            png = await get_qr_code(digest)
+            if png is not None:
+                self.db_hits += 1
+                self.put(digest, png)
+                return png
+
+        self.misses += 1
+        png = await render(connection_string)
+        self.put(digest, png)
+        if self.persist:
+            await save_qr_code(digest, png)
+        return png
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_stats(self) -> Dict:
+        """Счетчики попаданий и заполнение кэша"""
+        lookups = self.hits + self.db_hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.db_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions
+        }
+
+
+# Глобальный экземпляр
+qr_cache = QRCodeCache(max_bytes=QR_CACHE_MAX_BYTES, persist=QR_CACHE_PERSIST)
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.qr_cache import qr_cache
+from services.qr_renderer import qr_renderer
+
+png = await qr_cache.get_or_render(connection_string, qr_renderer.render, qr_renderer.variant)
+buffer = io.BytesIO(png)    # каждому вызывающему - свой BytesIO поверх тех же байт
+print(qr_cache.get_stats())
+
+# Настройки (.env):
+QR_CACHE_MAX_BYTES=16777216   # байт PNG в памяти (~1-2 КБ на QR-код)
+QR_CACHE_PERSIST=false        # true - PNG хранятся в таблице qr_codes
+'''
@@ -0,0 +1,214 @@
+import asyncio
+import io
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional
+
+import qrcode
+import qrcode.image.svg
+from PIL import Image
+
+from config import QR_RENDER_EXECUTOR, QR_RENDER_WORKERS, QR_RENDER_MAX_QUEUE, QR_RENDER_MODE, QR_TARGET_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+# 🔧 КОДИРОВАНИЕ (синхронное, выполняется в пуле - модуль легкий для импорта в процессе-воркере)
+QR_MODES = ("classic", "compact")
+
+
+def make_qr_matrix(connection_string, border=4):
+    """QR минимальной версии, в которую влезает строка (с рамкой border модулей)"""
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=border,
+    )
+    qr.add_data(connection_string)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def render_qrcode_png(connection_string):
+    """Кодирует строку подключения в PNG QR-кода (байты)"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(connection_string)
+    qr.make(fit=True)
+
+    # Создаем изображение в памяти
+    img = qr.make_image(fill_color="black", back_color="white")
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='PNG')
+    return img_buffer.getvalue()
+
+
+def render_qrcode_compact_png(connection_string, target_size=512):
+    """
+    Компактный PNG: размер модуля подбирается под target_size пикселей,
+    картинка собирается из матрицы целиком (1 пиксель на модуль + масштабирование), 1-бит
+    """
+    matrix = make_qr_matrix(connection_string)
+    modules = len(matrix)
+    box_size = max(1, target_size // modules)
+
+    pixels = bytes(0 if cell else 255 for row in matrix for cell in row)
+    img = Image.frombytes("L", (modules, modules), pixels).convert("1", dither=Image.Dither.NONE)
+    img = img.resize((modules * box_size, modules * box_size), Image.Resampling.NEAREST)
+
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='PNG', optimize=True)
+    return img_buffer.getvalue()
+
+
+def render_qrcode(connection_string, mode="classic", target_size=512):
+    """PNG QR-кода в выбранном режиме"""
+    if mode == "compact":
+        return render_qrcode_compact_png(connection_string, target_size)
+    return render_qrcode_png(connection_string)
+
+
+def render_qrcode_svg(connection_string):
+    """SVG QR-кода (один path, масштабируется без потерь) - для отправки документом"""
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=4,
+        image_factory=qrcode.image.svg.SvgPathImage,
+    )
+    qr.add_data(connection_string)
+    qr.make(fit=True)
+    return qr.make_image().to_string(encoding="unicode").encode()
+
+
+class QRRenderer:
+    """
+    КОДИРОВАНИЕ QR-КОДОВ ВНЕ ЦИКЛА СОБЫТИЙ
+    • executor: "thread" (пул потоков), "process" (пул процессов, не держит GIL цикла) или "inline"
+    • В пуле одновременно не больше max_queue задач - остальные ждут в asyncio, не копясь в очереди пула
+    • Пул создается при первом кодировании и закрывается при завершении бота
+    mode - "classic" (модуль 10 пикселей) или "compact" (размер под target_size пикселей)
+    """
+
+    def __init__(self, executor: str = "thread", workers: int = 2, max_queue: int = 32,
+                 mode: str = "classic", target_size: int = 512):
+        if executor not in ("thread", "process", "inline"):
+            raise ValueError(f"Неизвестный тип пула QR: {executor}")
+        if mode not in QR_MODES:
+            raise ValueError(f"Неизвестный режим QR: {mode}")
+        self.executor = executor
+        self.mode = mode
+        self.target_size = target_size
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool: Optional[Executor] = None
+        self._slots = asyncio.Semaphore(max_queue)
+        self._queued = 0
+
+        # Счетчики
+        self.renders = 0
+        self.waits = 0
+        self.peak_queue = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            if self.executor == "process":
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qr")
+            logger.info(f"✅ Пул кодирования QR запущен ({self.executor}, {self.workers} воркеров)")
+        return self._pool
+
+    @property
+    def variant(self) -> str:
+        """Режим кодирования (часть ключа кэша готовых PNG)"""
+        if self.mode == "compact":
+            return f"compact-{self.target_size}"
+        return self.mode
+
+    async def _run(self, func, *args):
+        if self.executor == "inline":
+            return func(*args)
+
+        if self._slots.locked():
+            self.waits += 1
+        async with self._slots:
+            self._queued += 1
+            self.peak_queue = max(self.peak_queue, self._queued)
+            started = time.monotonic()
+            try:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self._get_pool(), func, *args)
+                self.renders += 1
+                self.total_time += time.monotonic() - started
+                return result
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                self._queued -= 1
+
+    async def render(self, connection_string: str) -> bytes:
+        """PNG QR-кода; цикл событий свободен, пока идет кодирование"""
+        return await self._run(render_qrcode, connection_string, self.mode, self.target_size)
+
+    async def render_svg(self, connection_string: str) -> bytes:
+        """SVG QR-кода для отправки документом"""
+        return await self._run(render_qrcode_svg, connection_string)
+
+    def close(self):
+        """Останавливает пул при завершении бота"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def get_stats(self) -> Dict:
+        """Счетчики пула кодирования"""
+        return {
+            "executor": self.executor,
+            "mode": self.variant,
+            "workers": self.workers,
+            "queued": self._queued,
+            "peak_queue": self.peak_queue,
+            "max_queue": self.max_queue,
+            "renders": self.renders,
+            "waits": self.waits,
+            "errors": self.errors,
+            "avg_ms": round(self.total_time / self.renders * 1000, 1) if self.renders else 0.0
+        }
+
+
+# Глобальный экземпляр
+qr_renderer = QRRenderer(
+    executor=QR_RENDER_EXECUTOR,
+    workers=QR_RENDER_WORKERS,
+    max_queue=QR_RENDER_MAX_QUEUE,
+    mode=QR_RENDER_MODE,
+    target_size=QR_TARGET_SIZE
+)
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.qr_renderer import qr_renderer
+
+png = await qr_renderer.render(connection_string)   # кодирование в пуле
+svg = await qr_renderer.render_svg(connection_string)
+await bot.send_document(chat_id, BufferedInputFile(svg, filename="qrcode.svg"))
+print(qr_renderer.get_stats())
+qr_renderer.close()                                 # при завершении бота
+
+# Настройки (.env):
+QR_RENDER_EXECUTOR=thread   # thread / process / inline (прямо в цикле событий)
+QR_RENDER_WORKERS=2         # воркеров пула
+QR_RENDER_MAX_QUEUE=32      # задач в пуле одновременно, остальные ждут
+QR_RENDER_MODE=classic      # classic / compact
+QR_TARGET_SIZE=512          # пикселей стороны QR в режиме compact (не больше)
+'''
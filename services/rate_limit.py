@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    Ограничение исходящих запросов к внешнему сервису
+    • semaphore - не больше concurrency запросов одновременно
+    • wait() - не чаще rate запросов в секунду
+    """
+
+    def __init__(self, rate: float, concurrency: int):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._next_slot = 0.0
+
+    async def wait(self):
+        """Ждет свободный слот (вызывать внутри semaphore)"""
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.rate_limit import RateLimiter
+
+limiter = RateLimiter(rate=5, concurrency=2)
+
+async with limiter.semaphore:
+    await limiter.wait()
+    await call_external_api()
+'''
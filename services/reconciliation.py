@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from services.database import get_db_timestamp, get_inbound_subscriptions, apply_subscription_sync
+from services.inbound_cache import inbound_cache
+from config import INBOUND_ID, RECONCILE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionReconciler:
+    """
+    ПЕРИОДИЧЕСКАЯ СВЕРКА ПАНЕЛИ И БД
+    • Один запрос инбаунда к панели за интервал вместо запросов по каждому пользователю
+    • Расхождения (UUID, срок, enable, лимит) ищутся за один проход
+    • Изменения пишутся пачкой одной транзакцией
+    • Строки, измененные ботом во время сверки, не перезаписываются устаревшим снимком
+    """
+
+    def __init__(self, inbound_id: int, interval: float = 600):
+        self.inbound_id = inbound_id
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+        # Счетчики
+        self.runs = 0
+        self.errors = 0
+        self.last_duration = 0.0
+        self.last_drift: Dict[str, int] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Запуск сверки в фоне (первый проход сразу)"""
+        if self.running:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"✅ Сверка панели и БД запущена (каждые {self.interval:.0f}с)")
+
+    async def stop(self):
+        """Остановка при завершении бота"""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"❌ Ошибка сверки панели и БД: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def reconcile(self) -> Dict[str, int]:
+        """Один проход сверки, возвращает число расхождений по видам"""
+        started = time.monotonic()
+
+        # Сначала БД, потом панель: запись, успевшая в панель до снимка, в снимке уже есть.
+        # Строки, измененные после started_at, сверка не перезаписывает (снимок мог устареть)
+        started_at = await get_db_timestamp()
+        rows = {row['telegram_id']: row for row in await get_inbound_subscriptions(self.inbound_id)}
+        snapshot = await inbound_cache.get(self.inbound_id, force=True)
+
+        drift = {"uuid": 0, "expiry": 0, "enable": 0, "limit": 0, "missing_in_db": 0, "missing_on_panel": 0}
+        upserts = []
+        unchanged_ids = []
+        connection_strings = []
+        seen = set()
+
+        for email, client in snapshot.clients_by_email.items():
+            # Клиенты бота называются telegram_id, остальные клиенты панели не трогаем
+            if not email.isdigit():
+                continue
+            telegram_id = int(email)
+            seen.add(telegram_id)
+
+            values = (telegram_id, client.id, self.inbound_id,
+                      client.expiry_time or 0, bool(client.enable), client.total_gb or 0)
+            row = rows.get(telegram_id)
+
+            if row is None:
+                drift["missing_in_db"] += 1
+                upserts.append(values)
+                continue
+
+            changed = False
+            if row['client_uuid'] != client.id:
+                drift["uuid"] += 1
+                changed = True
+                connection_strings.append(
+                    (telegram_id, snapshot.profile.render(email, client.id), client.id)
+                )
+            if row['expiry_time'] != values[3]:
+                drift["expiry"] += 1
+                changed = True
+            if row['enabled'] != values[4]:
+                drift["enable"] += 1
+                changed = True
+            if row['total_gb'] != values[5]:
+                drift["limit"] += 1
+                changed = True
+
+            if changed:
+                upserts.append(values)
+            else:
+                unchanged_ids.append(telegram_id)
+
+        missing_ids = [
+            telegram_id for telegram_id, row in rows.items()
+            if telegram_id not in seen and row['enabled']
+        ]
+        drift["missing_on_panel"] = len(missing_ids)
+
+        await apply_subscription_sync(upserts, unchanged_ids, missing_ids, connection_strings, started_at)
+
+        self.runs += 1
+        self.last_duration = time.monotonic() - started
+        self.last_drift = drift
+        logger.info(
+            f"✅ Сверка панели и БД: {len(seen)} клиентов, расхождения {drift}, "
+            f"{self.last_duration * 1000:.0f} мс"
+        )
+        return drift
+
+    def get_stats(self) -> Dict:
+        """Счетчики сверки"""
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "last_duration_ms": int(self.last_duration * 1000),
+            "last_drift": dict(self.last_drift)
+        }
+
+
+# Глобальный экземпляр
+subscription_reconciler = SubscriptionReconciler(INBOUND_ID, interval=RECONCILE_INTERVAL)
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.reconciliation import subscription_reconciler
+
+subscription_reconciler.start()          # фоновая сверка каждые RECONCILE_INTERVAL секунд
+drift = await subscription_reconciler.reconcile()   # разовая сверка
+print(subscription_reconciler.get_stats())
+await subscription_reconciler.stop()
+'''
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    ОДНО ВЫПОЛНЕНИЕ НА КЛЮЧ
+    Параллельные вызовы с одинаковым ключом ждут первое выполнение и получают его результат.
+    Выполнение идет отдельной задачей - отмена одного ожидающего не прерывает остальных.
+    """
+
+    def __init__(self, name: str, max_keys: int = 10000):
+        self.name = name
+        self.max_keys = max_keys
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+        # Счетчики
+        self.executions = 0
+        self.shared = 0
+        self.overflows = 0
+        self.peak = 0
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет func() или присоединяется к уже идущему выполнению с тем же ключом"""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+            return await asyncio.shield(task)
+
+        if len(self._inflight) >= self.max_keys:
+            # Таблица переполнена - выполняем без объединения, но не растем без ограничений
+            self.overflows += 1
+            logger.warning(f"⚠️ Таблица выполнений {self.name} переполнена ({self.max_keys})")
+            return await func()
+
+        task = asyncio.create_task(func())
+        self._inflight[key] = task
+        self.executions += 1
+        self.peak = max(self.peak, len(self._inflight))
+        task.add_done_callback(lambda done: self._release(key, done))
+        return await asyncio.shield(task)
+
+    def _release(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def get_stats(self) -> Dict:
+        """Счетчики объединенных вызовов"""
+        return {
+            "name": self.name,
+            "inflight": len(self._inflight),
+            "max_keys": self.max_keys,
+            "peak": self.peak,
+            "executions": self.executions,
+            "shared": self.shared,
+            "overflows": self.overflows
+        }
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.single_flight import SingleFlight
+
+flights = SingleFlight("actions", max_keys=10000)
+
+# Два быстрых нажатия - одно выполнение, один результат на двоих
+result = await flights.run(("trial", telegram_id), lambda: activate_trial(telegram_id))
+
+print(flights.get_stats())
+'''
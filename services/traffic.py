@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from services.database import get_traffic_counters, save_traffic_deltas, purge_traffic_stats, \
+    get_traffic_usage, advisory_lock
+from services.inbound_cache import inbound_cache
+from config import INBOUND_ID, TRAFFIC_COLLECT_INTERVAL, \
+    TRAFFIC_RETENTION_5M_DAYS, TRAFFIC_RETENTION_1H_DAYS, TRAFFIC_RETENTION_1D_DAYS
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять устаревшие точки
+TRAFFIC_PURGE_INTERVAL = 3600
+
+# Ключ pg_advisory_lock сбора: при нескольких процессах собирает только один
+TRAFFIC_COLLECT_LOCK = 0x74726166
+
+
+# 🔧 ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ (синхронные)
+def get_buckets(now: datetime) -> Dict[str, datetime]:
+    """Начала текущих интервалов 5m / 1h / 1d (UTC)"""
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    return {
+        "5m": hour.replace(minute=now.minute - now.minute % 5),
+        "1h": hour,
+        "1d": hour.replace(hour=0)
+    }
+
+
+def format_traffic(size_bytes: int) -> str:
+    """Человекочитаемый объем трафика"""
+    size = float(size_bytes)
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.2f} ГБ"
+
+
+async def fetch_panel_stats(inbound_id: int):
+    """Счетчики всех клиентов инбаунда одним запросом к панели"""
+    snapshot = await inbound_cache.get(inbound_id, force=True)
+    return snapshot.inbound.client_stats or []
+
+
+class TrafficCollector:
+    """
+    СБОР СТАТИСТИКИ ТРАФИКА
+    • Счетчики up/down всех клиентов инбаунда - одним запросом
+    • В БД пишутся приращения сразу в разрешения 5m / 1h / 1d
+    • Старые точки удаляются по сроку хранения своего разрешения
+    • Несколько процессов: сбор идет под pg_advisory_lock, база счетчиков читается из БД каждый сбор
+    fetch_stats - источник счетчиков (по умолчанию панель, для проверки - фейковая панель)
+    """
+
+    def __init__(self, inbound_id: int, interval: float = 300,
+                 fetch_stats: Callable[[int], Awaitable[list]] = fetch_panel_stats):
+        self.inbound_id = inbound_id
+        self.interval = interval
+        self.fetch_stats = fetch_stats
+        self.retention_days = {
+            "5m": TRAFFIC_RETENTION_5M_DAYS,
+            "1h": TRAFFIC_RETENTION_1H_DAYS,
+            "1d": TRAFFIC_RETENTION_1D_DAYS
+        }
+
+        self._counters: Optional[Dict[int, Tuple[int, int]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+
+        # Счетчики
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.resets = 0
+        self.last_duration = 0.0
+        self.last_clients = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Запуск сбора в фоне"""
+        if self.running:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"✅ Сбор трафика запущен (каждые {self.interval:.0f}с)")
+
+    async def stop(self):
+        """Остановка при завершении бота"""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.collect()
+                if time.monotonic() - self._last_purge > TRAFFIC_PURGE_INTERVAL:
+                    self._last_purge = time.monotonic()
+                    deleted = await purge_traffic_stats(self.retention_days)
+                    logger.info(f"✅ Удалено устаревших точек трафика: {deleted}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"❌ Ошибка сбора трафика: {e}")
+            await asyncio.sleep(self.interval)
+
+    def compute_deltas(self, stats, baseline: bool = False) -> Tuple[List[tuple], List[tuple]]:
+        """
+        Приращения относительно прошлых счетчиков
+        Счетчик меньше прошлого - панель его сбросила, приращение = текущее значение
+        baseline=True - самый первый сбор: счетчики только запоминаются
+        """
+        deltas = []
+        counters = []
+        for stat in stats:
+            email = stat.email or ""
+            # Клиенты бота называются telegram_id
+            if not email.isdigit():
+                continue
+            telegram_id = int(email)
+            up, down = stat.up or 0, stat.down or 0
+
+            previous = self._counters.get(telegram_id)
+            if previous == (up, down):
+                continue
+            counters.append((telegram_id, up, down))
+
+            if previous is None:
+                if baseline:
+                    # Накопленный до начала сбора трафик в ряд не попадает
+                    continue
+                # Новый клиент - весь его трафик появился за этот интервал
+                previous = (0, 0)
+            prev_up, prev_down = previous
+            if up < prev_up or down < prev_down:
+                self.resets += 1
+                delta_up, delta_down = up, down
+            else:
+                delta_up, delta_down = up - prev_up, down - prev_down
+            if delta_up or delta_down:
+                deltas.append((telegram_id, delta_up, delta_down))
+
+        return deltas, counters
+
+    async def collect(self) -> int:
+        """Один сбор, возвращает число клиентов с трафиком за интервал (0 - собирает другой процесс)"""
+        async with advisory_lock(TRAFFIC_COLLECT_LOCK) as locked:
+            if not locked:
+                self.skipped += 1
+                logger.info("⚠️ Трафик собирает другой процесс - сбор пропущен")
+                return 0
+            return await self._collect()
+
+    async def _collect(self) -> int:
+        started = time.monotonic()
+        # База - последние сохраненные счетчики: прошлый сбор мог сделать другой процесс
+        self._counters = await get_traffic_counters()
+
+        stats = await self.fetch_stats(self.inbound_id)
+        deltas, counters = self.compute_deltas(stats, baseline=not self._counters)
+        await save_traffic_deltas(deltas, counters, get_buckets(datetime.now(timezone.utc)))
+
+        for telegram_id, up, down in counters:
+            self._counters[telegram_id] = (up, down)
+
+        self.runs += 1
+        self.last_clients = len(deltas)
+        self.last_duration = time.monotonic() - started
+        logger.info(
+            f"✅ Трафик собран: {len(stats)} клиентов, {len(deltas)} с трафиком, "
+            f"{self.last_duration * 1000:.0f} мс"
+        )
+        return len(deltas)
+
+    def get_stats(self) -> Dict:
+        """Счетчики сборщика"""
+        return {
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "resets": self.resets,
+            "last_clients": self.last_clients,
+            "last_duration_ms": int(self.last_duration * 1000)
+        }
+
+
+async def get_user_traffic(telegram_id: int, days: int = 30) -> Optional[Dict]:
+    """ТОЧКА ВХОДА - трафик пользователя за сегодня и за days дней"""
+    today = get_buckets(datetime.now(timezone.utc))["1d"]
+    usage = await get_traffic_usage(telegram_id, today - timedelta(days=days - 1), today)
+    if usage is None:
+        return None
+    today_bytes, total_bytes = usage
+    return {"today": today_bytes, "total": total_bytes, "days": days}
+
+
+# Глобальный экземпляр
+traffic_collector = TrafficCollector(INBOUND_ID, interval=TRAFFIC_COLLECT_INTERVAL)
+
+
+### КАК ИСПОЛЬЗОВАТЬ ###
+'''
+from services.traffic import traffic_collector, get_user_traffic, format_traffic, TrafficCollector
+
+traffic_collector.start()                   # сбор каждые TRAFFIC_COLLECT_INTERVAL секунд
+usage = await get_user_traffic(123456)      # {"today": байт, "total": байт, "days": 30}
+print(format_traffic(usage["total"]))
+
+# Проверка с фейковой панелью (без 3x-ui): счетчики отдает любая корутина
+from py3xui import Client
+
+async def fake_panel(inbound_id):
+    return [Client(email="123456", id="uuid", enable=True, up=1024, down=4096)]
+
+collector = TrafficCollector(1, fetch_stats=fake_panel)
+await collector.collect()   # первый сбор на пустой БД - только база счетчиков
+await collector.collect()   # дальше в traffic_stats пишутся приращения
+'''
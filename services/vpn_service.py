@@ -1,12 +1,21 @@
+import asyncio
 import logging
+import time
 import uuid
-import qrcode
 import io
-from datetime import datetime, timedelta
-from py3xui import AsyncApi, Client
-from services.database import save_connection_string
-from config import XUI_PANEL_URL, XUI_USERNAME, XUI_PASSWORD, INBOUND_ID, \
-    DATA_LIMIT_GB, EXPIRY_TIME, XUI_EXTERNAL_IP, SERVER_PORT, TRIAL_DAYS
+from datetime import datetime, timedelta, timezone
+import httpx
+from py3xui import Client
+from services.database import save_connection_string, save_subscription, get_subscription, mark_subscription_missing
+from services.xui_client import xui_panel
+from services.inbound_cache import inbound_cache
+from services.qr_cache import qr_cache
+from services.qr_renderer import qr_renderer
+from services.client_batcher import client_batcher
+from services.expiry_notifier import expiry_notifier
+from config import INBOUND_ID, \
+    DATA_LIMIT_GB, EXPIRY_TIME, TRIAL_DAYS, \
+    XUI_CONFIRM_DEADLINE, XUI_CONFIRM_INITIAL_DELAY, XUI_CONFIRM_MAX_DELAY, SUBSCRIPTION_STALE_AFTER
 
 logger = logging.getLogger(__name__)
 
@@ -42,43 +51,33 @@ def get_expiry_date(expire_ms):
         return 0  # Если срок истек
 
 
-def get_connection_string(email, inbound, client_uuid):
-    """Просто генерирует строку подключения"""
-    public_key = inbound.stream_settings.reality_settings.get("settings").get("publicKey")
-    website_name = inbound.stream_settings.reality_settings.get("serverNames")[0]
-    short_id = inbound.stream_settings.reality_settings.get("shortIds")[0]
-    remark = inbound.remark
-
-    connection_string = (
-        f"vless://{client_uuid}@{XUI_EXTERNAL_IP}:{SERVER_PORT}"
-        f"?type=tcp&security=reality&pbk={public_key}&fp=firefox&sni={website_name}"
-        f"&sid={short_id}&spx=%2F#{remark}-{email}"
-    )
-    return connection_string
+def get_subscription_status(subscription):
+    """Статус VPN по локальной подписке (без обращения к панели)"""
+    expiry_time = subscription['expiry_time']
+    not_expired = expiry_time == 0 or expiry_time > int(datetime.now().timestamp() * 1000)
+    return {
+        "success": True,
+        "client_id": subscription['client_uuid'],
+        "lease_is_active": subscription['enabled'] and not_expired,
+        "expiry_days": get_expiry_date(expiry_time)
+    }
 
 
-def create_qrcode(connection_string, email):
-    """Создает QR-код в памяти (без сохранения файла)"""
-    try:
-        # Создаем QR-код в памяти
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(connection_string)
-        qr.make(fit=True)
+def is_subscription_stale(subscription):
+    """Пора ли сверить подписку с панелью"""
+    age = datetime.now(timezone.utc) - subscription['synced_at']
+    return age.total_seconds() > SUBSCRIPTION_STALE_AFTER
 
-        # Создаем изображение в памяти
-        img = qr.make_image(fill_color="black", back_color="white")
 
-        # Сохраняем в BytesIO (память)
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='PNG')
-        img_buffer.seek(0)
-
-        return img_buffer
+async def create_qrcode(connection_string, email):
+    """
+    Создает QR-код в памяти (без сохранения файла)
+    Готовый PNG берется из qr_cache - повторно кодируется только новая строка подключения (в пуле qr_renderer)
+    """
+    try:
+        png = await qr_cache.get_or_render(connection_string, qr_renderer.render, qr_renderer.variant)
+        # Свой BytesIO на каждый вызов - байты PNG общие, не копируются
+        return io.BytesIO(png)
     except Exception as e:
         logger.error(f"❌ Ошибка создания QR-кода: {e}")
         return None
@@ -86,23 +85,21 @@ def create_qrcode(connection_string, email):
 
 # 🔄 АСИНХРОННЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С API
 async def api_connect():
-    """Асинхронное подключение к API"""
-    try:
-        api = AsyncApi(XUI_PANEL_URL, XUI_USERNAME, XUI_PASSWORD)
-        await api.login()
-        logger.info("✅ Успешная асинхронная авторизация в 3x-ui")
-        return api
-    except Exception as e:
-        logger.error(f"❌ Ошибка асинхронной авторизации в 3x-ui: {e}")
-        return None
+    """Асинхронное подключение к API - общий клиент панели, логин только при необходимости"""
+    if await xui_panel.connect():
+        return xui_panel
+    return None
 
 
-async def get_inbound(api, inbound_id):
-    """Асинхронное получение инбаунда"""
+async def get_inbound(inbound_id, force=False):
+    """
+    Асинхронное получение снимка инбаунда (из кэша, скачивается не чаще TTL)
+    force=True - принудительно скачать свежие данные
+    """
     try:
-        inbound = await api.inbound.get_by_id(inbound_id)
+        snapshot = await inbound_cache.get(inbound_id, force=force)
         logger.info("✅ Успешное получение данных об инбаунде")
-        return inbound
+        return snapshot
     except Exception as e:
         logger.error(f"❌ Ошибка получения данных об инбаунде: {e}")
         return None
@@ -111,7 +108,7 @@ async def get_inbound(api, inbound_id):
 async def get_client_by_email(api, email):
     """Асинхронный поиск клиента по email"""
     try:
-        client = await api.client.get_by_email(email)
+        client = await api.request(lambda a: a.client.get_by_email(email))
         logger.info(f"✅ Клиент {email} найден")
         return client
     except Exception as e:
@@ -119,37 +116,77 @@ async def get_client_by_email(api, email):
         return None
 
 
-async def add_client(api, email, inbound_id, expiry_time, total_gb):
-    """Асинхронное создание клиента"""
+def is_ambiguous_add_error(error: Exception) -> bool:
+    """
+    Ошибка, после которой клиент мог создаться: таймаут, обрыв соединения, 5xx панели
+    Отказ панели (4xx, success=false - например, дубликат email) однозначен
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError, ConnectionError))
+
+
+async def add_client(api, email, inbound_id, expiry_time, total_gb, client_uuid=None):
+    """
+    Асинхронное создание клиента
+    Возвращает отправленного клиента (UUID генерируем сами - панель его не меняет)
+    None - ответ неоднозначен (таймаут/обрыв), клиент мог создаться; отказ панели пробрасывается
+    При XUI_ADD_BATCH_WINDOW > 0 параллельные создания уходят на панель пачкой (client_batcher)
+    """
+    new_client = Client(
+        id=client_uuid or str(uuid.uuid4()),
+        email=email,
+        enable=True,
+        flow="xtls-rprx-vision",
+        expiry_time=expiry_time,
+        total_gb=total_gb
+    )
     try:
-        new_client = Client(
-            id=str(uuid.uuid4()),
-            email=email,
-            enable=True,
-            flow="xtls-rprx-vision",
-            expiry_time=expiry_time,
-            total_gb=total_gb
-        )
-        client = await api.client.add(inbound_id, [new_client])
-        logger.info(f"✅ Клиент {email} добавлен")
-        return client
+        await client_batcher.add(inbound_id, new_client)
     except Exception as e:
-        logger.error(f"❌ Ошибка добавления клиента: {e}")
+        if not is_ambiguous_add_error(e):
+            logger.error(f"❌ Панель отклонила клиента {email}: {e}")
+            raise
+        logger.warning(f"⚠️ Ответ на добавление клиента {email} не получен: {e}")
         return None
+    logger.info(f"✅ Клиент {email} добавлен")
+    return new_client
+
+
+async def wait_client_confirmation(api, email, deadline=XUI_CONFIRM_DEADLINE):
+    """
+    Ожидание появления клиента на панели
+    Опрашивается только этот клиент (get_by_email), паузы растут экспоненциально до deadline
+    Возвращает (client или None, затраченные секунды)
+    """
+    started = time.monotonic()
+    delay = XUI_CONFIRM_INITIAL_DELAY
+    attempt = 0
+
+    while True:
+        attempt += 1
+        client = await get_client_by_email(api, email)
+        elapsed = time.monotonic() - started
+        if client:
+            logger.info(f"✅ Клиент {email} подтвержден панелью за {elapsed:.2f}с (попытка {attempt})")
+            return client, elapsed
 
+        if elapsed + delay > deadline:
+            logger.warning(f"⚠️ Клиент {email} не подтвержден за {elapsed:.2f}с ({attempt} попыток)")
+            return None, elapsed
 
-async def get_client_from_inbound(inbound, email):
-    """Поиск клиента в инбаунде по email"""
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, XUI_CONFIRM_MAX_DELAY)
+
+
+async def get_client_from_inbound(snapshot, email):
+    """Поиск клиента в снимке инбаунда по email (по индексу, без перебора)"""
     try:
-        if not inbound or not hasattr(inbound, 'settings') or not inbound.settings.clients:
+        if not snapshot or not snapshot.clients_by_email:
             logger.error("❌ Инбаунд не содержит клиентов")
             return None
 
-        client = None
-        for c in inbound.settings.clients:
-            if hasattr(c, 'email') and c.email == email:
-                client = c
-                break
+        client = snapshot.get_client(email)
 
         if client:
             logger.info(f"✅ Найден клиент с ID: {client.id}")
@@ -163,24 +200,40 @@ async def get_client_from_inbound(inbound, email):
         return None
 
 
+async def get_inbound_with_client(inbound_id, email):
+    """
+    Снимок инбаунда и клиент из него по email
+    Снимок из кэша может отставать на TTL - если клиента в нем нет, один раз скачивается свежий
+    """
+    snapshot = await get_inbound(inbound_id)
+    client = snapshot.get_client(email) if snapshot else None
+    if client is None:
+        snapshot = await get_inbound(inbound_id, force=True)
+        client = await get_client_from_inbound(snapshot, email)
+    return snapshot, client
+
+
 async def update_client(api, email, expiry_time, total_gb):
     """Асинхронное обновление клиента"""
     try:
         # Получаем клиента по email
-        client_by_email = await api.client.get_by_email(email)
+        client_by_email = await api.request(lambda a: a.client.get_by_email(email))
         if not client_by_email:
             raise ValueError(f"Клиент {email} не найден для обновления")
 
         # Получаем inbound чтобы найти UUID клиента
-        inbound = await get_inbound(api, INBOUND_ID)
-        client_in_inbound = await get_client_from_inbound(inbound, email)
+        _, client_in_inbound = await get_inbound_with_client(INBOUND_ID, email)
+        if not client_in_inbound:
+            raise ValueError(f"Клиент {email} не найден в инбаунде {INBOUND_ID}")
 
-        # Обновляем данные
+        # Обновляем данные (клиент мог быть отключен при истечении - включаем обратно)
         client_by_email.total_gb = total_gb
         client_by_email.expiry_time = expiry_time
+        client_by_email.enable = True
         client_by_email.id = client_in_inbound.id  # Устанавливаем правильный UUID
 
-        await api.client.update(client_by_email.id, client_by_email)
+        await api.request(lambda a: a.client.update(client_by_email.id, client_by_email))
+        inbound_cache.invalidate(INBOUND_ID)
         logger.info(f"✅ Клиент {email} обновлен")
         return client_by_email
     except Exception as e:
@@ -188,6 +241,29 @@ async def update_client(api, email, expiry_time, total_gb):
         return None
 
 
+async def disable_client(api, client, expiry_time):
+    """
+    Асинхронное отключение клиента (клиент из снимка инбаунда)
+    expiry_time - срок, только что прочитанный с панели: старый срок из снимка не записывается обратно
+    """
+    disabled = client.model_copy(update={"enable": False, "expiry_time": expiry_time})
+    await api.request(lambda a: a.client.update(disabled.id, disabled))
+    logger.info(f"✅ Клиент {client.email} отключен")
+
+
+async def delete_client(api, client):
+    """
+    Асинхронное удаление клиента с панели по email
+    client.delete(inbound_id, uuid) в py3xui ищет email по полному списку клиентов на каждый вызов -
+    endpoint удаления принимает email напрямую
+    """
+    await api.request(
+        lambda a: a.client._post(a.client._url(f"panel/api/clients/del/{client.email}"),
+                                 {"Accept": "application/json"}, {})
+    )
+    logger.info(f"✅ Клиент {client.email} удален")
+
+
 # ⭐⭐ ТОЧКИ ВХОДА ⭐⭐
 async def create_vpn_account(telegram_id: int, is_trial: bool = False):
     """ТОЧКА ВХОДА - создать VPN аккаунт - ПОЛНОСТЬЮ ИСПРАВЛЕННАЯ ВЕРСИЯ"""
@@ -213,14 +289,15 @@ async def create_vpn_account(telegram_id: int, is_trial: bool = False):
         existing_client = await get_client_by_email(api, email)
 
         # Получаем inbound для данных подключения
-        inbound = await get_inbound(api, INBOUND_ID)
-        if not inbound:
+        # Клиент есть на панели - снимок из кэша мог его еще не видеть, тогда берется свежий
+        if existing_client:
+            snapshot, client_in_inbound = await get_inbound_with_client(INBOUND_ID, email)
+        else:
+            snapshot, client_in_inbound = await get_inbound(INBOUND_ID), None
+        if not snapshot:
             logger.error("❌ Не удалось получить inbound")
             return {"success": False, "error": "Inbound не найден"}
 
-        # 🔴 ИСПРАВЛЕНИЕ: Получаем клиента из инбаунда
-        client_in_inbound = await get_client_from_inbound(inbound, email)
-
         if existing_client and client_in_inbound:
             logger.info(f"⚠️ Клиент {email} уже существует - возвращаем данные подключения")
 
@@ -228,11 +305,16 @@ async def create_vpn_account(telegram_id: int, is_trial: bool = False):
             existing_expiry_days = get_expiry_date(existing_client.expiry_time)
 
             # Генерируем connection_string для существующего клиента
-            connection_string = get_connection_string(email, inbound, client_in_inbound.id)
-            qrcode_buffer = create_qrcode(connection_string, email)
+            connection_string = snapshot.profile.render(email, client_in_inbound.id)
+            qrcode_buffer = await create_qrcode(connection_string, email)
 
-            # Сохраняем connection_string в БД
+            # Сохраняем connection_string и подписку в БД
             await save_connection_string(telegram_id, connection_string)
+            await save_subscription(
+                telegram_id, client_in_inbound.id, INBOUND_ID,
+                existing_client.expiry_time, existing_client.total_gb, existing_client.enable
+            )
+            expiry_notifier.schedule(telegram_id, existing_client.expiry_time)
             logger.info(f"✅ Connection_string сохранен в БД для {telegram_id}")
 
             return {
@@ -245,68 +327,51 @@ async def create_vpn_account(telegram_id: int, is_trial: bool = False):
                 "connection_string": connection_string
             }
 
-        # Если клиента нет - создаем нового
-        client = await add_client(api, email, INBOUND_ID, expiry_time, total_gb)
-        if not client:
-            logger.error("❌ Не удалось создать клиента")
+        # Если клиента нет - создаем нового (UUID генерируем сами, он же пойдет в ссылку)
+        client_uuid = str(uuid.uuid4())
+        started = time.monotonic()
+        try:
+            client = await add_client(api, email, INBOUND_ID, expiry_time, total_gb, client_uuid=client_uuid)
+        except Exception:
+            # Панель однозначно отказала - опрашивать нечего
             return {"success": False, "error": "Не удалось создать клиента"}
 
-        # 🔴 ИСПРАВЛЕНИЕ: Даем время X-UI обновиться и несколько попыток найти клиента
-        import asyncio
-        await asyncio.sleep(2)  # Ждем 2 секунды для обновления панели
-
-        # 🔴 ИСПРАВЛЕНИЕ: Несколько попыток найти созданного клиента
-        client_in_inbound = None
-        for attempt in range(3):
-            inbound = await get_inbound(api, INBOUND_ID)
-            client_in_inbound = await get_client_from_inbound(inbound, email)
-
-            if client_in_inbound:
-                logger.info(f"✅ Клиент найден на попытке {attempt + 1}")
-                break
-            else:
-                logger.warning(f"⚠️ Клиент не найден, попытка {attempt + 1}, ждем 1 секунду")
-                await asyncio.sleep(1)
-
-        if not client_in_inbound:
-            logger.error("❌ Не удалось найти созданного клиента после нескольких попыток")
-            # 🔴 ИСПРАВЛЕНИЕ: Все равно возвращаем успех, так как клиент создан
-            # Генерируем временный connection_string
-            temp_client_id = str(uuid.uuid4())
-            connection_string = get_connection_string(email, inbound, temp_client_id)
-            qrcode_buffer = create_qrcode(connection_string, email)
-
-            # Сохраняем connection_string в БД
-            await save_connection_string(telegram_id, connection_string)
-            logger.info(f"✅ Connection_string сохранен в БД для {telegram_id}")
-
-            return {
-                "success": True,
-                "client_id": temp_client_id,
-                "lease_is_active": True,
-                "qrcode_buffer": qrcode_buffer,
-                "expiry_time": expiry_time,
-                "expiry_days": expiry_days,
-                "connection_string": connection_string,
-                "note": "Клиент создан, но требуется перезагрузка панели для полной синхронизации"
-            }
-
-        # Если клиент найден - продолжаем как обычно
-        connection_string = get_connection_string(email, inbound, client_in_inbound.id)
-        qrcode_buffer = create_qrcode(connection_string, email)
-
-        # Сохраняем connection_string в БД
+        if client:
+            # Панель ответила success - подтверждение не требует дополнительных запросов
+            confirmed_by = "add_response"
+            confirmation_latency = time.monotonic() - started
+        else:
+            # Ответ add неоднозначен (таймаут/обрыв) - клиент мог создаться, опрашиваем только его
+            confirmed_client = None
+            if not existing_client:
+                confirmed_client, _ = await wait_client_confirmation(api, email)
+            if not confirmed_client:
+                logger.error("❌ Не удалось создать клиента")
+                return {"success": False, "error": "Не удалось создать клиента"}
+            confirmed_by = "polling"
+            confirmation_latency = time.monotonic() - started
+
+        logger.info(f"⏱️ Клиент {email} подтвержден ({confirmed_by}) за {confirmation_latency * 1000:.0f} мс")
+
+        connection_string = snapshot.profile.render(email, client_uuid)
+        qrcode_buffer = await create_qrcode(connection_string, email)
+
+        # Сохраняем connection_string и подписку в БД
         await save_connection_string(telegram_id, connection_string)
+        await save_subscription(telegram_id, client_uuid, INBOUND_ID, expiry_time, total_gb)
+        expiry_notifier.schedule(telegram_id, expiry_time)
         logger.info(f"✅ Connection_string сохранен в БД для {telegram_id}")
 
         return {
             "success": True,
-            "client_id": client_in_inbound.id,
+            "client_id": client_uuid,
             "lease_is_active": True,
             "qrcode_buffer": qrcode_buffer,
             "expiry_time": expiry_time,
             "expiry_days": expiry_days,
-            "connection_string": connection_string
+            "connection_string": connection_string,
+            "confirmed_by": confirmed_by,
+            "confirmation_ms": int(confirmation_latency * 1000)
         }
 
     except Exception as e:
@@ -315,22 +380,50 @@ async def create_vpn_account(telegram_id: int, is_trial: bool = False):
 
 
 async def get_vpn_status(telegram_id: int):
-    """ТОЧКА ВХОДА - получить статус VPN"""
+    """
+    ТОЧКА ВХОДА - получить статус VPN
+    Отвечает из локальной подписки, панель спрашивается только когда подписка устарела
+    Панель не ответила - последние известные данные; клиента нет на панели - подписка отключается
+    """
     try:
         email = str(telegram_id)
 
+        subscription = await get_subscription(telegram_id)
+        if subscription and not is_subscription_stale(subscription):
+            return get_subscription_status(subscription)
+
         api = await api_connect()
         if not api:
-            return None
+            # Панель недоступна - отвечаем последними известными данными
+            return get_subscription_status(subscription) if subscription else None
+        try:
+            client = await api.request(lambda a: a.client.get_by_email(email))
+        except Exception as e:
+            logger.warning(f"⚠️ Панель не ответила о клиенте {email}, статус из БД: {e}")
+            return get_subscription_status(subscription) if subscription else None
 
-        # Получаем клиента
-        client = await get_client_by_email(api, email)
         if not client:
-            return None
+            # Панель ответила, что клиента нет (удален) - подписка больше не активна
+            logger.info(f"⚠️ Клиента {email} нет на панели - подписка отключена")
+            if not subscription:
+                return None
+            # UUID успел смениться (клиент создан заново) - отвечаем свежей подпиской
+            subscription = await mark_subscription_missing(telegram_id, subscription['client_uuid']) \
+                or await get_subscription(telegram_id)
+            return get_subscription_status(subscription) if subscription else None
 
         # Получаем inbound для дополнительной информации
-        inbound = await get_inbound(api, INBOUND_ID)
-        client_in_inbound = await get_client_from_inbound(inbound, email)
+        _, client_in_inbound = await get_inbound_with_client(INBOUND_ID, email)
+        if not client_in_inbound:
+            # Клиент есть, но инбаунд не скачался - отвечаем последними известными данными
+            return get_subscription_status(subscription) if subscription else None
+
+        # Сверка с панелью: обновляем локальную подписку
+        await save_subscription(
+            telegram_id, client_in_inbound.id, INBOUND_ID,
+            client.expiry_time, client.total_gb, client.enable
+        )
+        expiry_notifier.schedule(telegram_id, client.expiry_time)
 
         expiry_days = get_expiry_date(client.expiry_time)
 
@@ -360,8 +453,9 @@ async def renew_vpn_account(telegram_id: int):
         # Проверяем существование клиента
         client = await get_client_by_email(api, email)
         if not client:
-            logger.info(f"⚠️ Клиент {email} не найден для продления")
-            return None
+            # Клиент удален (например, отключением истекших с SWEEP_ACTION=delete) - создаем заново
+            logger.info(f"⚠️ Клиент {email} не найден для продления - создаем нового")
+            return await create_vpn_account(telegram_id)
 
         # Обновляем клиента
         updated_client = await update_client(api, email, expiry_time, total_gb)
@@ -369,14 +463,21 @@ async def renew_vpn_account(telegram_id: int):
             return None
 
         # Получаем обновленные данные для подключения
-        inbound = await get_inbound(api, INBOUND_ID)
-        client_in_inbound = await get_client_from_inbound(inbound, email)
+        snapshot, client_in_inbound = await get_inbound_with_client(INBOUND_ID, email)
+        if not client_in_inbound:
+            logger.error(f"❌ Клиент {email} продлен, но не найден в инбаунде")
+            return None
 
-        connection_string = get_connection_string(email, inbound, client_in_inbound.id)
-        qrcode_buffer = create_qrcode(connection_string, email)
+        connection_string = snapshot.profile.render(email, client_in_inbound.id)
+        qrcode_buffer = await create_qrcode(connection_string, email)
 
-        # Сохраняем connection_string в БД
+        # Сохраняем connection_string и подписку в БД
         await save_connection_string(telegram_id, connection_string)
+        await save_subscription(
+            telegram_id, client_in_inbound.id, INBOUND_ID, expiry_time, total_gb, updated_client.enable
+        )
+        # Новый срок - старые напоминания отменяются, новые ставятся без запроса к БД
+        expiry_notifier.schedule(telegram_id, expiry_time)
 
         return {
             "success": True,
@@ -407,7 +508,7 @@ result = await renew_vpn_account(123456)
 if result:
     print(f"VPN создан: {result['connection_string']}")
 
-# Проверить статус
+# Проверить статус (из таблицы subscriptions, панель - раз в SUBSCRIPTION_STALE_AFTER)
 status = await get_vpn_status(123456)
 if status:
     print(f"Осталось дней: {status['expiry_days']}")
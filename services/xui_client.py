@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+import httpx
+from py3xui import AsyncApi
+from config import XUI_PANEL_URL, XUI_USERNAME, XUI_PASSWORD, \
+    XUI_MAX_CONCURRENCY, XUI_SESSION_TTL
+
+logger = logging.getLogger(__name__)
+
+# HTTP-коды, которыми 3x-ui отвечает на запросы с протухшей сессией
+AUTH_ERROR_CODES = (401, 403, 404)
+
+
+class XUIPanelClient:
+    """
+    ДОЛГОЖИВУЩИЙ КЛИЕНТ ПАНЕЛИ 3x-ui
+    Логинится один раз, переиспользует cookie сессии,
+    сам переавторизуется при истечении сессии и ограничивает число параллельных запросов
+    """
+
+    def __init__(self, host: str, username: str, password: str,
+                 max_concurrency: int = 10, session_ttl: float = 3000):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.session_ttl = session_ttl
+
+        self._api: AsyncApi = None
+        self._logged_in_at = 0.0
+        self._session_version = 0
+        self._login_lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+        # Счетчики
+        self.logins = 0
+        self.relogins = 0
+        self.requests = 0
+        self.errors = 0
+
+    def _session_expired(self) -> bool:
+        if self._api is None or not self._api.session:
+            return True
+        return time.monotonic() - self._logged_in_at > self.session_ttl
+
+    async def _login(self, seen_version: int = None) -> AsyncApi:
+        """
+        Авторизация в панели (одна на всех ожидающих)
+        seen_version - версия сессии, на которой получили ошибку авторизации
+        """
+        async with self._login_lock:
+            # Кто-то уже обновил сессию, пока мы ждали блокировку
+            if seen_version is not None and seen_version != self._session_version:
+                return self._api
+            if seen_version is None and not self._session_expired():
+                return self._api
+
+            if self._api is None:
+                self._api = AsyncApi(self.host, self.username, self.password)
+            else:
+                self.relogins += 1
+
+            await self._api.login()
+            self._logged_in_at = time.monotonic()
+            self._session_version += 1
+            self.logins += 1
+            logger.info("✅ Успешная асинхронная авторизация в 3x-ui")
+            return self._api
+
+    async def connect(self) -> bool:
+        """Проверяет/устанавливает сессию с панелью"""
+        try:
+            await self._login()
+            return True
+        except Exception as e:
+            logger.error(f"❌ Ошибка асинхронной авторизации в 3x-ui: {e}")
+            return False
+
+    @staticmethod
+    def _is_auth_error(error: Exception) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in AUTH_ERROR_CODES
+        # Протухшая сессия редиректит на HTML-страницу логина
+        return isinstance(error, json.JSONDecodeError)
+
+    async def request(self, operation: Callable[[AsyncApi], Awaitable[Any]]) -> Any:
+        """
+        Выполняет операцию с API панели
+        operation - корутина-функция, получающая авторизованный AsyncApi
+
+        Пример: await xui_panel.request(lambda api: api.inbound.get_by_id(1))
+        """
+        async with self._semaphore:
+            api = await self._login()
+            version = self._session_version
+            self.requests += 1
+            try:
+                return await operation(api)
+            except Exception as e:
+                if not self._is_auth_error(e):
+                    self.errors += 1
+                    raise
+                logger.warning(f"⚠️ Сессия 3x-ui истекла, повторная авторизация: {e}")
+
+            api = await self._login(seen_version=version)
+            self.requests += 1
+            try:
+                return await operation(api)
+            except Exception:
+                self.errors += 1
+                raise
+
+    async def close(self):
+        """Сбрасывает сессию при остановке бота"""
+        self._api = None
+        self._logged_in_at = 0.0
+
+    def get_stats(self) -> Dict:
+        """Счетчики логинов и запросов к панели"""
+        return {
+            "logins": self.logins,
+            "relogins": self.relogins,
+            "requests": self.requests,
+            "errors": self.errors
+        }
+
+
+# Глобальный экземпляр для всех вызовов панели
+xui_panel = XUIPanelClient(
+    XUI_PANEL_URL, XUI_USERNAME, XUI_PASSWORD,
+    max_concurrency=XUI_MAX_CONCURRENCY,
+    session_ttl=XUI_SESSION_TTL
+)